@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Process-wide record of recent authentication failures, to avoid locking the account
+
+When the password in ``ARCHER2_PASS_<USERNAME>`` is wrong or expired, every transport goes through the whole
+authentication sequence again, and the repeated failures can get the account locked. The :class:`AuthFailureCache`
+remembers the failures of each ``(host, username)`` pair, and further logins fail at once, without contacting the host,
+for a time doubling with each consecutive failure. A different password is not held back by the failures of the
+previous one.
+"""
+import hashlib
+import threading
+import time
+
+from paramiko.ssh_exception import AuthenticationException
+
+__all__ = ('AuthFailureCache', 'AuthenticationBackoff', 'AUTH_FAILURES')
+
+
+class AuthenticationBackoff(AuthenticationException):
+    """A login is not attempted because the previous ones failed"""
+
+
+class AuthFailureCache:
+    """Thread-safe backoff after authentication failures, by host, username and password"""
+
+    #: Seconds during which logins are refused after the first failure, doubled by each further consecutive failure
+    BACKOFF = 60.0
+    #: Longest backoff, in seconds
+    MAX_BACKOFF = 3600.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._failures = {}
+
+    @staticmethod
+    def _key(host, username, password):
+        digest = hashlib.sha256((password or '').encode()).hexdigest()[:16]
+        return (host, username, digest)
+
+    def check(self, host, username, password=None):
+        """
+        Check that a login may be attempted
+
+        :raises AuthenticationBackoff: if a login with the same credentials failed recently
+        """
+        with self._lock:
+            entry = self._failures.get(self._key(host, username, password))
+        if entry is None:
+            return
+        failures, blocked_until, message = entry
+        remaining = blocked_until - time.monotonic()
+        if remaining > 0:
+            raise AuthenticationBackoff(
+                'Not logging in to {} as {} for another {:.0f} s after {} failed attempt(s): {}'.format(
+                    host, username, remaining, failures, message
+                )
+            )
+
+    def record_failure(self, host, username, password=None, message=''):
+        """
+        Record a failed login
+
+        :return: the number of seconds during which logins are refused
+        """
+        key = self._key(host, username, password)
+        with self._lock:
+            failures = self._failures.get(key, (0, 0, ''))[0] + 1
+            backoff = min(self.BACKOFF * 2**(failures - 1), self.MAX_BACKOFF)
+            self._failures[key] = (failures, time.monotonic() + backoff, message)
+        return backoff
+
+    def record_success(self, host, username, password=None):
+        with self._lock:
+            self._failures.pop(self._key(host, username, password), None)
+
+    def forget(self):
+        with self._lock:
+            self._failures.clear()
+
+
+#: Authentication failures of this process
+AUTH_FAILURES = AuthFailureCache()
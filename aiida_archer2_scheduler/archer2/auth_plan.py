@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent record of the authentication steps that worked for each host
+
+Logging into ARCHER2 needs both a public key and the password. Finding the right key can take many round trips, each
+of them counting against the ``MaxAuthTries`` of the login node. The :class:`AuthPlanStore` remembers, for each
+``(host, username)`` pair, the steps that led to a successful login so that they can be tried first next time.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+__all__ = ('AuthPlanStore', 'auth_config_digest', 'DEFAULT_AUTH_PLAN_FILE')
+
+#: Default location of the plan file, can be overridden with the ``ARCHER2_AUTH_PLAN_FILE`` environmental variable
+DEFAULT_AUTH_PLAN_FILE = os.path.join('~', '.cache', 'aiida-archer2-scheduler', 'auth_plans.json')
+
+
+def auth_config_digest(*items):
+    """Return a short digest of the authentication configuration
+
+    A plan recorded under a different digest is not used, so any change to the key files given, the key lookup
+    settings or the client class invalidates it.
+    """
+    return hashlib.sha256(json.dumps([str(item) for item in items]).encode()).hexdigest()[:16]
+
+
+def _file_signature(path):
+    """Return the (mtime, size) signature of a file, or None if it cannot be read"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+class AuthPlanStore:
+    """Per ``(host, username)`` record of the authentication steps that succeeded last time
+
+    Each plan is a list of steps, where a step is either ``{'method': 'password'}`` or a public key step::
+
+        {'method': 'publickey', 'source': 'file', 'name': '/home/user/.ssh/id_archer2', 'key_class': 'RSAKey'}
+
+    Key steps backed by a file also record the signature of the file, so that a plan is discarded as soon as the
+    key is replaced. Only paths, fingerprints and method names are stored - never any secret.
+    """
+
+    def __init__(self, path=None):
+        """
+        Instantiate the store
+
+        :param path: the JSON file to persist the plans in. Defaults to ``ARCHER2_AUTH_PLAN_FILE`` or
+           :data:`DEFAULT_AUTH_PLAN_FILE`.
+        """
+        if path is None:
+            path = os.environ.get('ARCHER2_AUTH_PLAN_FILE', DEFAULT_AUTH_PLAN_FILE)
+        self.path = os.path.expanduser(path)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _entry_name(host, username):
+        return '{}@{}'.format(username, host)
+
+    def _read(self):
+        """Read all plans from the file, an unreadable file is treated as empty"""
+        try:
+            with open(self.path, 'r') as handle:
+                data = json.load(handle)
+        except (OSError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def _write(self, data):
+        """Atomically replace the plan file"""
+        dirname = os.path.dirname(self.path)
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.auth_plans')
+        try:
+            with os.fdopen(fd, 'w') as handle:
+                json.dump(data, handle, indent=1, sort_keys=True)
+            os.replace(tmpname, self.path)
+        except BaseException:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+            raise
+
+    def get(self, host, username, digest):
+        """
+        Return the remembered plan
+
+        :param host: the host name connected to
+        :param username: the user name
+        :param digest: digest of the current authentication configuration, see :func:`auth_config_digest`
+        :return: a list of steps, or None if there is no valid plan
+        """
+        with self._lock:
+            entry = self._read().get(self._entry_name(host, username))
+        if not entry or entry.get('digest') != digest:
+            return None
+        steps = entry.get('steps') or None
+        for step in steps or []:
+            if step.get('source') == 'file' and _file_signature(step['name']) != step.get('signature'):
+                return None
+        return steps
+
+    def put(self, host, username, digest, steps):
+        """
+        Record the steps that lead to a successful login
+
+        :param host: the host name connected to
+        :param username: the user name
+        :param digest: digest of the current authentication configuration
+        :param steps: list of steps as described in the class documentation
+        """
+        steps = [dict(step) for step in steps]
+        for step in steps:
+            if step.get('source') == 'file':
+                step['signature'] = _file_signature(step['name'])
+        name = self._entry_name(host, username)
+        with self._lock:
+            data = self._read()
+            if data.get(name) == {'digest': digest, 'steps': steps}:
+                return
+            data[name] = {'digest': digest, 'steps': steps}
+            try:
+                self._write(data)
+            except OSError:
+                # Failing to record the plan must never prevent a login
+                pass
+
+    def invalidate(self, host, username):
+        """Forget the plan of a given host and username"""
+        name = self._entry_name(host, username)
+        with self._lock:
+            data = self._read()
+            if data.pop(name, None) is not None:
+                try:
+                    self._write(data)
+                except OSError:
+                    pass
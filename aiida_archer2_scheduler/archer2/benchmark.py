@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+"""
+Offline benchmarks of the transport and the scheduler against a fake ARCHER2 login node
+
+The benchmarks connect to a :class:`~aiida_archer2_scheduler.archer2.fake_server.FakeArcher2Server` on the loopback
+interface, optionally with an injected latency, and time logging in (with and without a remembered authentication
+plan, for both login orders), folder uploads and downloads in each transfer mode, and polling a queue of 10000 jobs.
+The time to import the plugins is measured in new interpreters, and checked against :data:`IMPORT_BUDGET`.
+The results are saved as JSON, and can be compared with those of a previous run to catch regressions::
+
+    python -m aiida_archer2_scheduler.archer2.benchmark --latency 0.02 --output after.json --baseline before.json
+"""
+import argparse
+from datetime import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import paramiko
+from paramiko.ecdsakey import ECDSAKey
+
+from .auth_backoff import AuthFailureCache
+from .auth_plan import AuthPlanStore
+from .fake_server import FakeArcher2Server
+from .ssh_archer2 import SshTransport, SshTransport4C
+from .ssh_client import Archer2SSHClient
+
+__all__ = (
+    'BenchmarkEnvironment', 'BENCHMARKS', 'run_benchmarks', 'save_results', 'compare_results', 'measure_import',
+    'IMPORT_BUDGET'
+)
+
+
+def _timed(function, repeat, setup=None):
+    """Return the durations of ``repeat`` calls of a function, ``setup`` being called untimed before each of them"""
+    runs = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        runs.append(time.perf_counter() - start)
+    return runs
+
+
+def _summary(runs, **extra):
+    result = {'median': statistics.median(runs), 'min': min(runs), 'runs': runs}
+    result.update(extra)
+    return result
+
+
+class BenchmarkEnvironment:
+    """Fake login nodes for both login orders, a user key, an isolated authentication plan store and record of
+    authentication failures
+
+    Use it as a context manager, everything is removed on exit.
+    """
+
+    def __init__(self, latency=0.0, password='secret'):
+        """
+        :param latency: round-trip time added to the connections, in seconds
+        :param password: the password of the user
+        """
+        self.latency = latency
+        self.password = password
+        self.directory = None
+        self.servers = {}
+        self.key_filename = None
+        self._saved_plan_store = None
+        self._saved_auth_failures = None
+
+    def __enter__(self):
+        self.directory = tempfile.mkdtemp(prefix='archer2-benchmark-')
+        key = ECDSAKey.generate()
+        self.key_filename = os.path.join(self.directory, 'id_archer2')
+        key.write_private_key_file(self.key_filename)
+        for password_first in (False, True):
+            home = os.path.join(self.directory, '4c' if password_first else 'main')
+            os.makedirs(home)
+            server = FakeArcher2Server(
+                home, password=self.password, password_first=password_first, latency=self.latency
+            )
+            server.authorize_key(key)
+            self.servers[password_first] = server.start()
+        self._saved_plan_store = Archer2SSHClient.auth_plan_store
+        Archer2SSHClient.auth_plan_store = AuthPlanStore(os.path.join(self.directory, 'auth_plans.json'))
+        self._saved_auth_failures = SshTransport.auth_failures
+        SshTransport.auth_failures = AuthFailureCache()
+        return self
+
+    def __exit__(self, *args):
+        Archer2SSHClient.auth_plan_store = self._saved_plan_store
+        SshTransport.auth_failures = self._saved_auth_failures
+        for server in self.servers.values():
+            server.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def server(self, transport_class=SshTransport):
+        """The server matching the login order of a transport class"""
+        return self.servers[transport_class.CLIENT_CLASS.PASSWORD_FIRST]
+
+    def make_transport(self, transport_class=SshTransport, **options):
+        """Return an unopened transport to the fake login node matching its login order"""
+        server = self.server(transport_class)
+        transport = transport_class(
+            machine='127.0.0.1',
+            username=server.username,
+            port=server.port,
+            key_filename=self.key_filename,
+            look_for_keys=False,
+            allow_agent=False,
+            key_policy='AutoAddPolicy',
+            **options
+        )
+        # The password is only read from the environment for ARCHER2 host names
+        transport._connect_args['password'] = self.password  # pylint: disable=protected-access
+        return transport
+
+    def forget_plans(self):
+        Archer2SSHClient.auth_plan_store.invalidate('127.0.0.1', self.servers[False].username)
+
+    def make_tree(self, name, files, size):
+        """Create a local folder of ``files`` files of ``size`` bytes, spread over ten subfolders"""
+        root = os.path.join(self.directory, name)
+        for index in range(files):
+            folder = os.path.join(root, 'sub{}'.format(index % 10))
+            os.makedirs(folder, exist_ok=True)
+            with open(os.path.join(folder, 'file{}'.format(index)), 'wb') as handle:
+                handle.write(os.urandom(size))
+        return root
+
+
+def bench_connect(env, repeat, **kwargs):
+    """Open and close a transport, with the authentication plan remembered or forgotten, for both login orders"""
+    results = {}
+    for label, transport_class in (('archer2', SshTransport), ('4c', SshTransport4C)):
+        server = env.server(transport_class)
+        for plan in ('cold', 'warm'):
+
+            def connect(transport_class=transport_class):
+                transport = env.make_transport(transport_class)
+                transport.open()
+                transport.close()
+
+            if plan == 'warm':
+                connect()
+            attempts = len(server.auth_attempts)
+            runs = _timed(connect, repeat, env.forget_plans if plan == 'cold' else None)
+            results['connect_{}_{}'.format(label, plan)] = _summary(
+                runs, auth_attempts=(len(server.auth_attempts) - attempts) / repeat
+            )
+    return results
+
+
+def bench_exec(env, repeat, **kwargs):
+    """Run a trivial command, one round trip"""
+    transport = env.make_transport()
+    with transport:
+        return {'exec_true': _summary(_timed(lambda: transport.exec_command_wait('true'), repeat))}
+
+
+TREE_MODES = (('sftp', {}), ('sftp_4_workers', {'transfer_workers': 4}), ('tar', {'tree_transfer': 'tar'}),
+              ('tar.gz', {'tree_transfer': 'tar.gz'}))
+
+
+def bench_tree(env, repeat, files=200, file_size=16 * 1024, **kwargs):
+    """Upload then download a folder in each transfer mode"""
+    local = env.make_tree('tree', files, file_size)
+    remote = os.path.join(env.server().home, 'tree')
+    back = os.path.join(env.directory, 'tree_back')
+    results = {}
+    for label, options in TREE_MODES:
+        transport = env.make_transport(**options)
+        with transport:
+            runs = _timed(
+                lambda transport=transport: transport.puttree(local, remote), repeat,
+                lambda: shutil.rmtree(remote, ignore_errors=True)
+            )
+            results['upload_tree_{}'.format(label)] = _summary(runs, files=files, bytes=files * file_size)
+            runs = _timed(
+                lambda transport=transport: transport.gettree(remote, back), repeat,
+                lambda: shutil.rmtree(back, ignore_errors=True)
+            )
+            results['download_tree_{}'.format(label)] = _summary(runs, files=files, bytes=files * file_size)
+    return results
+
+
+def bench_poll(env, repeat, jobs=10000, **kwargs):
+    """Poll the state of a queue of ``jobs`` jobs, by job ID and by user"""
+    from .slurm_archer2 import Archer2SlurmScheduler
+
+    server = env.server()
+    job_ids = server.slurm.populate(jobs)
+    transport = env.make_transport()
+    with transport:
+        scheduler = Archer2SlurmScheduler()
+        scheduler.set_transport(transport)
+        polled = {}
+
+        def poll_jobs():
+            polled['jobs'] = len(scheduler.get_jobs(jobs=job_ids, as_dict=True))
+
+        def poll_user():
+            polled['user'] = len(scheduler.get_jobs(user=server.username, as_dict=True))
+
+        results = {
+            'poll_jobs': _summary(_timed(poll_jobs, repeat), jobs=jobs),
+            'poll_user': _summary(_timed(poll_user, repeat), jobs=jobs),
+        }
+    if polled != {'jobs': jobs, 'user': jobs}:
+        raise RuntimeError('Polling returned {} jobs instead of {}'.format(polled, jobs))
+    return results
+
+
+#: The modules loaded through the entry points of each plugin, and the AiiDA module they build on
+PLUGIN_MODULES = {
+    'archer2.ssh': ('aiida_archer2_scheduler.archer2.ssh_archer2', 'aiida.transports.plugins.ssh'),
+    'archer2.slurm': ('aiida_archer2_scheduler.archer2.slurm_archer2', 'aiida.schedulers.plugins.slurm'),
+}
+
+#: Seconds each plugin may take to import, on top of the AiiDA module it builds on
+IMPORT_BUDGET = 0.25
+
+_IMPORT_SCRIPT = """
+import gc, importlib, json, sys, time
+importlib.import_module(sys.argv[2])
+gc.collect()
+gc.disable()
+before = set(sys.modules)
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds, 'modules': sorted(set(sys.modules) - before)}))
+"""
+
+
+def measure_import(module, base):
+    """
+    Import a module in a new interpreter, once the module it builds on is imported
+
+    The garbage collector is disabled during the import, so that a collection of the objects of the base module is not
+    counted.
+
+    :return: the seconds taken by the import, and the list of the modules it loaded
+    """
+    output = subprocess.run([sys.executable, '-c', _IMPORT_SCRIPT, module, base],
+                            check=True,
+                            stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    result = json.loads(output.splitlines()[-1])
+    return result['seconds'], result['modules']
+
+
+def bench_import(env, repeat, **kwargs):
+    """Import each plugin in a new interpreter"""
+    results = {}
+    for name, (module, base) in PLUGIN_MODULES.items():
+        runs = []
+        for _ in range(repeat):
+            seconds, modules = measure_import(module, base)
+            runs.append(seconds)
+        results['import_{}'.format(name)] = _summary(runs, modules=len(modules), budget=IMPORT_BUDGET)
+    return results
+
+
+#: The benchmarks by name
+BENCHMARKS = {
+    'connect': bench_connect,
+    'exec': bench_exec,
+    'tree': bench_tree,
+    'poll': bench_poll,
+    'import': bench_import
+}
+
+
+def run_benchmarks(latency=0.0, repeat=5, names=None, **parameters):
+    """
+    Run benchmarks against fake login nodes
+
+    :param latency: round-trip time added to the connections, in seconds
+    :param repeat: number of timed runs of each benchmark
+    :param names: the names of the :data:`BENCHMARKS` to run, all by default
+    :param parameters: passed to the benchmarks, e.g. ``jobs``, ``files`` and ``file_size``
+    :return: dictionary with the ``meta`` data of the run and the ``results`` of each benchmark, with the median and
+        minimum duration in seconds and the duration of each run
+    """
+    results = {}
+    with BenchmarkEnvironment(latency) as env:
+        for name in names or BENCHMARKS:
+            results.update(BENCHMARKS[name](env, repeat, **parameters))
+    return {
+        'meta': {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'latency': latency,
+            'repeat': repeat,
+            'parameters': parameters,
+            'python': platform.python_version(),
+            'paramiko': paramiko.__version__,
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+
+
+def save_results(results, path):
+    with open(path, 'w') as handle:
+        json.dump(results, handle, indent=2)
+
+
+def compare_results(results, baseline, tolerance=0.2):
+    """
+    Compare the median durations of two runs
+
+    :param results: the new results, as returned by :func:`run_benchmarks`
+    :param baseline: the results to compare with
+    :param tolerance: relative slow down above which a benchmark is reported as a regression
+    :return: list of ``(name, baseline median, new median, ratio, regressed)`` tuples for the benchmarks in both runs
+    """
+    comparison = []
+    for name, result in results['results'].items():
+        previous = baseline['results'].get(name)
+        if previous is None:
+            continue
+        ratio = result['median'] / previous['median'] if previous['median'] else float('inf')
+        comparison.append((name, previous['median'], result['median'], ratio, ratio > 1 + tolerance))
+    return comparison
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--latency', type=float, default=0.0, help='round-trip time added, in seconds')
+    parser.add_argument('--repeat', type=int, default=5, help='number of runs of each benchmark')
+    parser.add_argument('--only', action='append', choices=sorted(BENCHMARKS), help='run only these benchmarks')
+    parser.add_argument('--jobs', type=int, default=10000, help='number of jobs in the queue polled')
+    parser.add_argument('--files', type=int, default=200, help='number of files in the folder transferred')
+    parser.add_argument('--file-size', type=int, default=16 * 1024, help='size of each file transferred, in bytes')
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with the results saved in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative slow down reported as a regression')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(
+        args.latency, args.repeat, args.only, jobs=args.jobs, files=args.files, file_size=args.file_size
+    )
+    if args.output:
+        save_results(results, args.output)
+    over_budget = 0
+    for name, result in results['results'].items():
+        flag = ''
+        if result['median'] > result.get('budget', float('inf')):
+            over_budget += 1
+            flag = ' OVER BUDGET ({} s)'.format(result['budget'])
+        print('{:32} {:10.4f} s (min {:.4f} s){}'.format(name, result['median'], result['min'], flag))
+    if not args.baseline:
+        return 1 if over_budget else 0
+    with open(args.baseline) as handle:
+        baseline = json.load(handle)
+    for name in ('latency', 'parameters'):
+        if baseline['meta'].get(name) != results['meta'][name]:
+            print('Warning: the baseline was run with {} {}'.format(name, baseline['meta'].get(name)))
+    regressions = 0
+    print('\n{:32} {:>10} {:>10} {:>8}'.format('Compared with ' + args.baseline, 'before', 'after', 'ratio'))
+    for name, before, after, ratio, regressed in compare_results(results, baseline, args.tolerance):
+        regressions += regressed
+        flag = ' REGRESSION' if regressed else ''
+        print('{:32} {:10.4f} {:10.4f} {:8.2f}{}'.format(name, before, after, ratio, flag))
+    return 1 if regressions or over_budget else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Run several shell commands in a single remote invocation
+
+Each ``exec_command_wait`` opens a channel and waits for a full round trip to the login node. The helpers here build a
+single script running a list of commands one after the other, and split its output back into the exit status, stdout
+and stderr of each command. The output of each command is framed by a header line holding its length in bytes, so any
+content - including binary data or text looking like a header - is demultiplexed correctly.
+"""
+import uuid
+
+from aiida.common.escaping import escape_for_bash
+
+__all__ = ('build_batch_script', 'parse_batch_output')
+
+
+def build_batch_script(commands, stop_on_error=False):
+    """
+    Build the script running the commands
+
+    :param commands: list of commands, each either a string or a ``(command, workdir)`` tuple. The commands are
+        assumed to be already escaped.
+    :param stop_on_error: if True, do not run the commands following one that failed
+    :return: a tuple of the script and the marker used to frame the output of each command
+    """
+    marker = '__ARCHER2_BATCH_{}__'.format(uuid.uuid4().hex)
+    lines = [
+        '_archer2_dir=$(mktemp -d) || exit 1',
+        "trap 'rm -rf \"$_archer2_dir\"' EXIT",
+    ]
+    for index, command in enumerate(commands):
+        if isinstance(command, (tuple, list)):
+            command, workdir = command
+        else:
+            workdir = None
+        if workdir is not None:
+            command = 'cd {} && ( {} )'.format(escape_for_bash(workdir), command)
+        lines.append('( {} ) >"$_archer2_dir/out" 2>"$_archer2_dir/err" </dev/null'.format(command))
+        lines.append('_archer2_ret=$?')
+        lines.append(
+            "printf '\\n{} {} %d %d %d\\n' \"$_archer2_ret\" "
+            '"$(wc -c <"$_archer2_dir/out")" "$(wc -c <"$_archer2_dir/err")"'.format(marker, index)
+        )
+        lines.append('cat "$_archer2_dir/out" "$_archer2_dir/err"')
+        if stop_on_error:
+            lines.append('[ "$_archer2_ret" -eq 0 ] || exit 0')
+    return '\n'.join(lines) + '\n', marker
+
+
+def parse_batch_output(stdout, marker, ncommands):
+    """
+    Split the output of a batch script
+
+    :param stdout: the stdout of the script, as bytes
+    :param marker: the marker returned by :func:`build_batch_script`
+    :param ncommands: the number of commands in the batch
+    :return: list of ``(retval, stdout, stderr)`` tuples as bytes, one per command. Commands that did not run have a
+        ``retval`` of None.
+    """
+    results = [(None, b'', b'')] * ncommands
+    header = b'\n' + marker.encode() + b' '
+    position = 0
+    while True:
+        start = stdout.find(header, position)
+        if start < 0:
+            break
+        line_end = stdout.find(b'\n', start + 1)
+        if line_end < 0:
+            break
+        fields = stdout[start + 1:line_end].split()
+        index, retval, nout, nerr = (int(field) for field in fields[1:5])
+        out_start = line_end + 1
+        err_start = out_start + nout
+        position = err_start + nerr
+        results[index] = (retval, stdout[out_start:err_start], stdout[err_start:position])
+    return results
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Pool of authenticated SSH connections shared between transports
+
+ARCHER2 throttles accounts that open too many logins, and each login (key plus password) takes seconds. With the pool
+enabled, the transports of a daemon worker that connect to the same machine as the same user share one authenticated
+paramiko ``Transport``, each of them only opening its own SFTP and exec channels over it.
+"""
+import threading
+import time
+
+__all__ = ('ConnectionPool', 'PooledConnection', 'CONNECTION_POOL')
+
+
+class PooledConnection:
+    """An authenticated ``SSHClient`` held by the pool, together with the proxies it was opened through"""
+
+    def __init__(self, key, client, proxies=None):
+        self.key = key
+        self.client = client
+        self.proxies = proxies or []
+        self.users = 0
+        self.channels = 0
+        self.last_used = time.monotonic()
+
+    @property
+    def is_active(self):
+        """Whether the underlying transport is still connected"""
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def close(self):
+        """Close the connection and its proxies"""
+        self.client.close()
+        for proxy in self.proxies:
+            proxy.close()
+        self.proxies = []
+
+
+class ConnectionPool:
+    """Thread-safe pool of SSH connections keyed by machine and username
+
+    The server limits the number of channels open at once on a connection (``MaxSessions``, 10 by default for OpenSSH).
+    Each user of a connection states how many channels it may hold at the same time - its SFTP channel, the SFTP
+    channels of its parallel transfers and an exec channel - and is only given a connection with that many channels
+    to spare under ``max_channels_per_connection``, more connections being opened when none has. Connections that have been unused for more than ``idle_timeout`` seconds are closed, and connections that
+    dropped are replaced by new ones transparently.
+    """
+
+    def __init__(self, max_channels_per_connection=10, idle_timeout=300):
+        """
+        :param max_channels_per_connection: maximum number of channels open at once on a single connection
+        :param idle_timeout: seconds after which an unused connection is closed
+        """
+        self.max_channels_per_connection = max_channels_per_connection
+        self.idle_timeout = idle_timeout
+        self._connections = {}
+        self._lock = threading.RLock()
+        self._connecting = {}
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._connecting.setdefault(key, threading.Lock())
+
+    def acquire(self, key, connect, channels=1):
+        """
+        Get a connection for the given key
+
+        :param key: hashable identifying the connection, e.g. ``(machine, username, port)``
+        :param connect: callable returning a connected ``(client, proxies)`` tuple, called if no connection can be
+            reused
+        :param channels: maximum number of channels the caller holds open at once on the connection
+        :return: a :class:`PooledConnection`, to be returned with :meth:`release`
+        """
+        self.evict_idle()
+        # Serialise logins for the same key, so that a burst of transports opens a single connection
+        with self._key_lock(key):
+            with self._lock:
+                for connection in list(self._connections.get(key, [])):
+                    if not connection.is_active:
+                        self._discard(connection)
+                        continue
+                    if connection.channels + channels <= self.max_channels_per_connection:
+                        connection.users += 1
+                        connection.channels += channels
+                        connection.last_used = time.monotonic()
+                        return connection
+
+            client, proxies = connect()
+            connection = PooledConnection(key, client, proxies)
+            connection.users = 1
+            connection.channels = channels
+            with self._lock:
+                self._connections.setdefault(key, []).append(connection)
+            return connection
+
+    def reconnect(self, connection, connect, channels=1):
+        """
+        Replace a connection that dropped while in use
+
+        The caller's share of the dropped connection is moved to a new connection, obtained as in :meth:`acquire`.
+        """
+        self.release(connection, channels)
+        with self._lock:
+            if not connection.is_active:
+                self._discard(connection)
+        return self.acquire(connection.key, connect, channels)
+
+    def release(self, connection, channels=1):
+        """Give back a connection obtained from :meth:`acquire` with the same number of ``channels``"""
+        with self._lock:
+            connection.users = max(connection.users - 1, 0)
+            connection.channels = max(connection.channels - channels, 0)
+            connection.last_used = time.monotonic()
+        self.evict_idle()
+
+    def _discard(self, connection):
+        """Remove a connection from the pool and close it, must be called with the lock held"""
+        connections = self._connections.get(connection.key, [])
+        if connection in connections:
+            connections.remove(connection)
+        if not connections:
+            self._connections.pop(connection.key, None)
+        try:
+            connection.close()
+        except Exception:  # pylint: disable=broad-except
+            pass
+
+    def evict_idle(self, idle_timeout=None):
+        """
+        Close the connections that have not been used for a while
+
+        :param idle_timeout: override the pool's idle timeout, 0 closes all unused connections
+        """
+        idle_timeout = self.idle_timeout if idle_timeout is None else idle_timeout
+        now = time.monotonic()
+        with self._lock:
+            for connections in list(self._connections.values()):
+                for connection in list(connections):
+                    if connection.users == 0 and (
+                        now - connection.last_used >= idle_timeout or not connection.is_active
+                    ):
+                        self._discard(connection)
+
+    def close_all(self):
+        """Close all connections, including those in use"""
+        with self._lock:
+            for connections in list(self._connections.values()):
+                for connection in list(connections):
+                    self._discard(connection)
+
+    def stats(self):
+        """Return the number of connections and users per key"""
+        with self._lock:
+            return {
+                key: [connection.users for connection in connections]
+                for key, connections in self._connections.items()
+            }
+
+
+#: The pool shared by all transports of this process
+CONNECTION_POOL = ConnectionPool()
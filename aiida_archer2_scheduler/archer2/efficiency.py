@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Efficiency of finished jobs, from the Slurm accounting
+
+``sacct`` reports one line for the allocation of a job and one for each of its steps. The helpers here parse the CPU
+time, elapsed time, memory and energy of those lines into a compact :class:`JobEfficiency` per job, telling how much
+of the node-hours charged was actually used.
+"""
+import re
+
+__all__ = ('JobEfficiency', 'SACCT_EFFICIENCY_FIELDS', 'parse_duration', 'parse_quantity', 'aggregate_sacct')
+
+#: The sacct fields needed to build a :class:`JobEfficiency`
+SACCT_EFFICIENCY_FIELDS = ('JobID', 'State', 'NNodes', 'AllocCPUS', 'Elapsed', 'TotalCPU', 'MaxRSS', 'ConsumedEnergy')
+
+_DURATION_REGEXP = re.compile(r'^(?:(?:(?P<days>\d+)-)?(?P<hours>\d+):)?(?P<minutes>\d+):(?P<seconds>\d+(?:\.\d+)?)$')
+_QUANTITY_REGEXP = re.compile(r'^(?P<value>[\d.]+)(?P<unit>[KMGTP]?)$')
+_UNITS = 'KMGTP'
+
+
+def parse_duration(value):
+    """Parse a sacct duration, ``[[days-]hours:]minutes:seconds[.fraction]``, into seconds - None if empty"""
+    match = _DURATION_REGEXP.match(value.strip())
+    if match is None:
+        return None
+    days, hours, minutes, seconds = match.group('days', 'hours', 'minutes', 'seconds')
+    return int(days or 0) * 86400 + int(hours or 0) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def parse_quantity(value, base=1024):
+    """Parse a sacct quantity with an optional ``K``, ``M``, ``G``... suffix - None if empty"""
+    match = _QUANTITY_REGEXP.match(value.strip())
+    if match is None:
+        return None
+    unit = match.group('unit')
+    return float(match.group('value')) * base**(_UNITS.index(unit) + 1 if unit else 0)
+
+
+class JobEfficiency:
+    """Accounting summary of a finished job"""
+
+    __slots__ = ('job_id', 'state', 'nodes', 'cpus', 'elapsed', 'total_cpu', 'max_rss', 'energy')
+
+    def __init__(self, job_id, state=None, nodes=0, cpus=0, elapsed=0.0, total_cpu=0.0, max_rss=None, energy=None):
+        self.job_id = job_id
+        self.state = state
+        self.nodes = nodes
+        self.cpus = cpus
+        self.elapsed = elapsed
+        self.total_cpu = total_cpu
+        self.max_rss = max_rss
+        self.energy = energy
+
+    def __repr__(self):
+        return '<JobEfficiency {}: {:.0%} CPU over {} nodes for {:.0f} s>'.format(
+            self.job_id, self.cpu_efficiency or 0, self.nodes, self.elapsed
+        )
+
+    @property
+    def cpu_efficiency(self):
+        """Fraction of the CPU time allocated that was used, None if the job did not run"""
+        if not self.elapsed or not self.cpus:
+            return None
+        return self.total_cpu / (self.elapsed * self.cpus)
+
+    @property
+    def node_hours(self):
+        return self.nodes * self.elapsed / 3600
+
+    def as_dict(self):
+        """Return the record as a dictionary, with the CPU efficiency and node-hours"""
+        record = {name: getattr(self, name) for name in self.__slots__}
+        record['cpu_efficiency'] = self.cpu_efficiency
+        record['node_hours'] = self.node_hours
+        return record
+
+
+def aggregate_sacct(records):
+    """
+    Build the efficiency of each job from the sacct lines of its allocation and steps
+
+    The allocation line gives the state, size and elapsed time of the job. The CPU time is that of the allocation if
+    reported, otherwise the sum over the steps, and the memory is the largest of any step. Energy is in joules.
+
+    :param records: iterable of dictionaries with the :data:`SACCT_EFFICIENCY_FIELDS` as keys
+    :return: dictionary of job ID to :class:`JobEfficiency`
+    """
+    jobs = {}
+    step_cpu = {}
+    for record in records:
+        job_id, _, step = record['JobID'].partition('.')
+        job = jobs.get(job_id)
+        if job is None:
+            job = jobs[job_id] = JobEfficiency(job_id)
+        total_cpu = parse_duration(record.get('TotalCPU', '')) or 0.0
+        max_rss = parse_quantity(record.get('MaxRSS', ''))
+        if max_rss is not None:
+            job.max_rss = max(job.max_rss or 0, max_rss)
+        if step:
+            step_cpu[job_id] = step_cpu.get(job_id, 0.0) + total_cpu
+            continue
+        job.state = record.get('State', '').split(' ')[0] or None
+        job.nodes = int(record.get('NNodes') or 0)
+        job.cpus = int(record.get('AllocCPUS') or 0)
+        job.elapsed = parse_duration(record.get('Elapsed', '')) or 0.0
+        job.total_cpu = total_cpu
+        job.energy = parse_quantity(record.get('ConsumedEnergy', ''), base=1000)
+    for job_id, total_cpu in step_cpu.items():
+        if not jobs[job_id].total_cpu:
+            jobs[job_id].total_cpu = total_cpu
+    return jobs
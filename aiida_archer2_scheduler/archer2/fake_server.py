@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+"""
+In-process SSH and SFTP server behaving like an ARCHER2 login node, for benchmarks
+
+The :class:`FakeArcher2Server` listens on the loopback interface and, like ARCHER2, only lets a user in after both a
+public key and the password were accepted - the key first on the main system, the password first on the 4-cabinet
+system. Commands run in a local shell whose ``PATH`` starts with the fake Slurm commands of
+:mod:`~aiida_archer2_scheduler.archer2.fake_slurm`, and SFTP requests are served from the local filesystem. A
+round-trip latency can be injected, to see the effect of the distance to the real login nodes.
+"""
+from collections import deque
+import logging
+import os
+import socket
+import subprocess
+import threading
+import time
+
+import paramiko
+from paramiko import SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface
+from paramiko.ecdsakey import ECDSAKey
+
+from .fake_slurm import FakeSlurm, install_commands
+
+__all__ = ('FakeArcher2Server',)
+
+PUBLICKEY = 'publickey'
+PASSWORD = 'password'
+
+# Clients closing their connections are logged as errors by the server side of paramiko
+LOG_CHANNEL = __name__ + '.paramiko'
+logging.getLogger(LOG_CHANNEL).addHandler(logging.NullHandler())
+logging.getLogger(LOG_CHANNEL).propagate = False
+
+
+class _Archer2ServerInterface(paramiko.ServerInterface):
+    """Authentication and channel requests of a single connection"""
+
+    def __init__(self, server):
+        self.server = server
+        self.done = []
+
+    def _order(self):
+        return [PASSWORD, PUBLICKEY] if self.server.password_first else [PUBLICKEY, PASSWORD]
+
+    def _step(self, method, accepted):
+        accepted = accepted and method == self._order()[len(self.done)]
+        self.server.auth_attempts.append((method, accepted))
+        if not accepted:
+            return paramiko.AUTH_FAILED
+        self.done.append(method)
+        if len(self.done) == len(self._order()):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_PARTIALLY_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return ','.join(method for method in self._order() if method not in self.done)
+
+    def check_auth_password(self, username, password):
+        return self._step(PASSWORD, username == self.server.username and password == self.server.password)
+
+    def check_auth_publickey(self, username, key):
+        accepted = username == self.server.username and key.get_base64() in self.server.authorized_keys
+        return self._step(PUBLICKEY, accepted)
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self.server.run_command, args=(channel, command.decode()), daemon=True)
+        thread.start()
+        return True
+
+
+class _LocalSFTPHandle(SFTPHandle):
+
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as exc:
+            return SFTPServer.convert_errno(exc.errno)
+
+    def chattr(self, attr):
+        try:
+            SFTPServer.set_file_attr(self.filename, attr)
+            return paramiko.SFTP_OK
+        except OSError as exc:
+            return SFTPServer.convert_errno(exc.errno)
+
+
+class _LocalSFTPServer(SFTPServerInterface):
+    """SFTP requests served from the local filesystem, relative paths being taken from the home directory"""
+
+    def __init__(self, server, *args, home='/', **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.home = home
+
+    def _path(self, path):
+        return os.path.normpath(os.path.join(self.home, path))
+
+    def _call(self, function, *args):
+        try:
+            function(*args)
+        except OSError as exc:
+            return SFTPServer.convert_errno(exc.errno)
+        return paramiko.SFTP_OK
+
+    def canonicalize(self, path):
+        return self._path(path)
+
+    def list_folder(self, path):
+        path = self._path(path)
+        try:
+            entries = []
+            for name in os.listdir(path):
+                attr = SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)))
+                attr.filename = name
+                entries.append(attr)
+            return entries
+        except OSError as exc:
+            return SFTPServer.convert_errno(exc.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as exc:
+            return SFTPServer.convert_errno(exc.errno)
+
+    def lstat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(self._path(path)))
+        except OSError as exc:
+            return SFTPServer.convert_errno(exc.errno)
+
+    def open(self, path, flags, attr):
+        path = self._path(path)
+        try:
+            mode = getattr(attr, 'st_mode', None)
+            descriptor = os.open(path, flags, mode if mode is not None else 0o666)
+        except OSError as exc:
+            return SFTPServer.convert_errno(exc.errno)
+        if flags & os.O_CREAT and attr is not None:
+            attr._flags &= ~attr.FLAG_PERMISSIONS  # pylint: disable=protected-access
+            SFTPServer.set_file_attr(path, attr)
+        if flags & os.O_WRONLY:
+            file_mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            file_mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            file_mode = 'rb'
+        handle = _LocalSFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(descriptor, file_mode)
+        return handle
+
+    def remove(self, path):
+        return self._call(os.remove, self._path(path))
+
+    def rename(self, oldpath, newpath):
+        if os.path.exists(self._path(newpath)):
+            return paramiko.SFTP_FAILURE
+        return self._call(os.rename, self._path(oldpath), self._path(newpath))
+
+    def posix_rename(self, oldpath, newpath):
+        return self._call(os.replace, self._path(oldpath), self._path(newpath))
+
+    def mkdir(self, path, attr):
+        return self._call(os.mkdir, self._path(path))
+
+    def rmdir(self, path):
+        return self._call(os.rmdir, self._path(path))
+
+    def chattr(self, path, attr):
+        return self._call(SFTPServer.set_file_attr, self._path(path), attr)
+
+    def symlink(self, target_path, path):
+        return self._call(os.symlink, target_path, self._path(path))
+
+    def readlink(self, path):
+        try:
+            return os.readlink(self._path(path))
+        except OSError as exc:
+            return SFTPServer.convert_errno(exc.errno)
+
+
+def _relay(source, destination, delay):
+    """Forward the data received on a socket to another one, each chunk being held back for ``delay`` seconds"""
+    pending = deque()
+    condition = threading.Condition()
+
+    def receive():
+        try:
+            while True:
+                data = source.recv(65536)
+                with condition:
+                    pending.append((time.monotonic() + delay, data))
+                    condition.notify()
+                if not data:
+                    return
+        except OSError:
+            with condition:
+                pending.append((time.monotonic(), b''))
+                condition.notify()
+
+    threading.Thread(target=receive, daemon=True).start()
+    try:
+        while True:
+            with condition:
+                while not pending:
+                    condition.wait()
+                due, data = pending[0]
+                wait = due - time.monotonic()
+                if wait > 0:
+                    condition.wait(wait)
+                    continue
+                pending.popleft()
+            if not data:
+                break
+            destination.sendall(data)
+    except OSError:
+        pass
+    finally:
+        for sock in (source, destination):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class FakeArcher2Server:
+    """SSH server on the loopback interface, mimicking an ARCHER2 login node
+
+    Use it as a context manager, or call :meth:`start` and :meth:`stop`::
+
+        with FakeArcher2Server(home, password='secret', latency=0.02) as server:
+            server.authorize_key(key)
+            server.slurm.populate(10000)
+            ...  # connect to 127.0.0.1 on server.port
+    """
+
+    def __init__(self, home, username='user', password='secret', password_first=False, latency=0.0, host_key=None):
+        """
+        :param home: the directory in which commands run and relative SFTP paths are resolved
+        :param username: the only user accepted
+        :param password: the password of the user
+        :param password_first: if True, the password must be given before the key, as on the 4-cabinet system
+        :param latency: round-trip time added to the connections, in seconds
+        :param host_key: the private host key, a new ECDSA key by default
+        """
+        self.home = os.path.abspath(home)
+        self.username = username
+        self.password = password
+        self.password_first = password_first
+        self.latency = latency
+        self.host_key = host_key or ECDSAKey.generate()
+        self.authorized_keys = set()
+        #: ``(method, accepted)`` of every authentication attempt, in order
+        self.auth_attempts = []
+        #: Number of commands executed
+        self.commands = 0
+        self.port = None
+
+        slurm_dir = os.path.join(self.home, '.fake_slurm')
+        state = os.path.join(slurm_dir, 'jobs.json')
+        install_commands(os.path.join(slurm_dir, 'bin'), state, username)
+        self.slurm = FakeSlurm(state, username)
+        self.environment = dict(
+            os.environ, PATH=os.path.join(slurm_dir, 'bin') + os.pathsep + os.environ.get('PATH', ''), HOME=self.home
+        )
+        # Commands are run through a login shell, which resets the PATH
+        with open(os.path.join(self.home, '.bash_profile'), 'w') as handle:
+            handle.write('export PATH={}:$PATH\n'.format(os.path.join(slurm_dir, 'bin')))
+
+        self._socket = None
+        self._transports = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def authorize_key(self, key):
+        """Accept a public key for the user"""
+        self.authorized_keys.add(key.get_base64())
+
+    def start(self):
+        """Start listening on a free port of the loopback interface"""
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(128)
+        self.port = self._socket.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self
+
+    def stop(self):
+        """Stop listening and close the connections"""
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+        with self._lock:
+            transports, self._transports = self._transports, []
+        for transport in transports:
+            transport.close()
+
+    def _accept(self):
+        while self._socket is not None:
+            try:
+                client, _ = self._socket.accept()
+            except OSError:
+                return
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.latency:
+                # Half of the round trip on each way
+                client_side, server_side = socket.socketpair()
+                for source, destination in ((client, client_side), (client_side, client)):
+                    threading.Thread(target=_relay, args=(source, destination, self.latency / 2), daemon=True).start()
+                client = server_side
+            threading.Thread(target=self._serve, args=(client,), daemon=True).start()
+
+    def _serve(self, sock):
+        transport = paramiko.Transport(sock)
+        transport.set_log_channel(LOG_CHANNEL)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler('sftp', SFTPServer, _LocalSFTPServer, home=self.home)
+        with self._lock:
+            self._transports.append(transport)
+        try:
+            transport.start_server(server=_Archer2ServerInterface(self))
+        except (paramiko.SSHException, EOFError, OSError):
+            transport.close()
+
+    def run_command(self, channel, command):
+        """Run a command in a local shell, streaming its standard input and outputs through the channel"""
+        self.commands += 1
+        try:
+            process = subprocess.Popen(  # pylint: disable=consider-using-with
+                ['bash', '-c', command],
+                cwd=self.home,
+                env=self.environment,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+
+            def feed():
+                try:
+                    while True:
+                        data = channel.recv(65536)
+                        if not data:
+                            break
+                        process.stdin.write(data)
+                    process.stdin.close()
+                except (OSError, EOFError):
+                    pass
+
+            def send_stderr():
+                for data in iter(lambda: process.stderr.read1(65536), b''):
+                    channel.sendall_stderr(data)
+
+            threading.Thread(target=feed, daemon=True).start()
+            stderr = threading.Thread(target=send_stderr, daemon=True)
+            stderr.start()
+            for data in iter(lambda: process.stdout.read1(65536), b''):
+                channel.sendall(data)
+            stderr.join()
+            channel.send_exit_status(process.wait())
+        except (OSError, EOFError, paramiko.SSHException):
+            pass
+        finally:
+            channel.close()
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+Stand-in for the Slurm commands of ARCHER2, used by the benchmark server
+
+The jobs are kept in a JSON file, and ``sbatch``, ``squeue``, ``scancel`` and ``sacct`` read and update it, printing
+their output in the formats the scheduler plugin asks for. This module only uses the standard library, as it is run
+as a script - ``python fake_slurm.py <state file> <command> <arguments>`` - by wrappers placed on the ``PATH`` of the
+fake login node.
+"""
+import fcntl
+import json
+import os
+import re
+import sys
+import time
+
+__all__ = ('FakeSlurm', 'install_commands')
+
+COMMANDS = ('sbatch', 'squeue', 'scancel', 'sacct')
+
+#: Running and pending states, listed by squeue
+ACTIVE_STATES = ('PD', 'R', 'CG')
+#: squeue code of each state, as reported by sacct
+STATE_NAMES = {
+    'PD': 'PENDING',
+    'R': 'RUNNING',
+    'CG': 'COMPLETING',
+    'CD': 'COMPLETED',
+    'F': 'FAILED',
+    'CA': 'CANCELLED',
+    'TO': 'TIMEOUT'
+}
+
+_SBATCH_OPTION_REGEXP = re.compile(r'^#SBATCH\s+--(?P<name>[\w-]+)(?:[= ](?P<value>\S+))?')
+
+
+def _format_time(seconds):
+    """Format seconds as ``[days-]hours:minutes:seconds``"""
+    seconds = int(seconds)
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    text = '{:02d}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+    return '{}-{}'.format(days, text) if days else text
+
+
+def _parse_time(value):
+    """Parse a Slurm time limit into seconds"""
+    days, _, rest = value.rpartition('-')
+    parts = [int(part) for part in rest.split(':')]
+    while len(parts) < 3:
+        parts.insert(0, 0)
+    return int(days or 0) * 86400 + parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+
+def _timestamp(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(seconds))
+
+
+class FakeSlurm:
+    """Queue of jobs stored in a JSON file, locked while it is updated"""
+
+    def __init__(self, path, username='user'):
+        self.path = path
+        self.username = username
+
+    def _locked(self, update):
+        """Call ``update`` with the state while holding the lock, writing it back if the call returns True"""
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.path) as handle:
+                    state = json.load(handle)
+            except (OSError, ValueError):
+                state = {'next_id': 1000000, 'jobs': {}}
+            result, changed = update(state)
+            if changed:
+                with open(self.path + '.tmp', 'w') as handle:
+                    json.dump(state, handle)
+                os.replace(self.path + '.tmp', self.path)
+            return result
+
+    def _new_job(self, state, name, nodes=1, time_limit=3600, partition='standard', workdir='', status='PD'):
+        job_id = str(state['next_id'])
+        state['next_id'] += 1
+        now = time.time()
+        state['jobs'][job_id] = {
+            'name': name,
+            'state': status,
+            'nodes': nodes,
+            'cpus': nodes * 128,
+            'partition': partition,
+            'time_limit': time_limit,
+            'submitted': now,
+            'started': now if status != 'PD' else None,
+            'workdir': workdir,
+        }
+        return job_id
+
+    def populate(self, count, running=0.3, finished=0.0, nodes=1):
+        """
+        Add ``count`` jobs, a fraction of them running and a fraction finished
+
+        :return: the list of the IDs of the new jobs
+        """
+
+        def update(state):
+            ids = []
+            for index in range(count):
+                if index < count * finished:
+                    status = 'CD'
+                elif index < count * (finished + running):
+                    status = 'R'
+                else:
+                    status = 'PD'
+                ids.append(self._new_job(state, 'aiida-{}'.format(index), nodes=nodes, status=status))
+            return ids, True
+
+        return self._locked(update)
+
+    def set_state(self, job_ids, status):
+        """Change the state of jobs, e.g. to mark them as finished"""
+
+        def update(state):
+            for job_id in job_ids:
+                job = state['jobs'][job_id]
+                job['state'] = status
+                if status != 'PD' and job['started'] is None:
+                    job['started'] = time.time()
+            return None, True
+
+        self._locked(update)
+
+    def sbatch(self, args):
+        options = {}
+        script = None
+        for arg in args:
+            if arg.startswith('--'):
+                name, _, value = arg[2:].partition('=')
+                options[name] = value
+            else:
+                script = arg
+        if script is None:
+            return 1, '', 'sbatch: error: no batch script given\n'
+        try:
+            with open(script) as handle:
+                for line in handle:
+                    match = _SBATCH_OPTION_REGEXP.match(line)
+                    if match:
+                        options.setdefault(match.group('name'), (match.group('value') or '').strip('"\''))
+        except OSError as exc:
+            return 1, '', 'sbatch: error: Unable to open file {}: {}\n'.format(script, exc)
+
+        nodes = int(options.get('nodes', 1))
+        time_limit = _parse_time(options['time']) if options.get('time') else 3600
+        partition = options.get('partition', 'standard')
+        if 'test-only' in options:
+            start = time.time() + 60 * nodes + time_limit / 10
+            job_id = self._locked(lambda state: (state['next_id'], False))
+            message = 'sbatch: Job {} to start at {} using {} processors on nodes nid[001000-{:06d}] in partition {}\n'
+            return 0, '', message.format(job_id, _timestamp(start), nodes * 128, 1000 + nodes - 1, partition)
+
+        name = options.get('job-name', os.path.basename(script))
+        workdir = os.path.dirname(os.path.abspath(script))
+        job_id = self._locked(lambda state: (self._new_job(state, name, nodes, time_limit, partition, workdir), True))
+        if 'parsable' in options:
+            return 0, job_id + '\n', ''
+        return 0, 'Submitted batch job {}\n'.format(job_id), ''
+
+    def squeue(self, args):
+        fmt = '%.18i %.9P %.8j %.8u %.2t %.10M %.6D %R'
+        job_ids = None
+        header = True
+        user = None
+        iterator = iter(args)
+        for arg in iterator:
+            if arg in ('-o', '--format'):
+                fmt = next(iterator)
+            elif arg.startswith('--format='):
+                fmt = arg[len('--format='):]
+            elif arg.startswith('-o'):
+                fmt = arg[2:]
+            elif arg.startswith('--jobs='):
+                job_ids = set(arg[len('--jobs='):].split(','))
+            elif arg == '--noheader':
+                header = False
+            elif arg.startswith('-u'):
+                user = arg[2:] or next(iterator)
+            elif arg == '--steps':
+                return 0, '', ''
+        state = self._locked(lambda state: (state, False))
+        now = time.time()
+        lines = []
+        if header:
+            lines.append(fmt)
+        for job_id, job in state['jobs'].items():
+            if job['state'] not in ACTIVE_STATES:
+                continue
+            if job_ids is not None and job_id not in job_ids:
+                continue
+            if user is not None and user != self.username:
+                continue
+            running = job['started'] is not None
+            values = {
+                'i': job_id,
+                't': job['state'],
+                'r': 'None' if running else 'Priority',
+                'B': 'nid001000' if running else 'n/a',
+                'u': self.username,
+                'D': str(job['nodes']),
+                'C': str(job['cpus']),
+                'R': 'nid[001000-{:06d}]'.format(1000 + job['nodes'] - 1) if running else '(Priority)',
+                'P': job['partition'],
+                'l': _format_time(job['time_limit']),
+                'M': _format_time(now - job['started']) if running else '0:00',
+                'S': _timestamp(job['started']) if running else 'N/A',
+                'j': job['name'],
+                'V': _timestamp(job['submitted']),
+                'Z': job['workdir'],
+            }
+            lines.append(re.sub(r'%\.?\d*(\w)', lambda match, values=values: values.get(match.group(1), ''), fmt))
+        return 0, ''.join(line + '\n' for line in lines), ''
+
+    def scancel(self, args):
+        job_ids = [arg for arg in args if not arg.startswith('-')]
+
+        def update(state):
+            for job_id in job_ids:
+                if job_id in state['jobs'] and state['jobs'][job_id]['state'] in ACTIVE_STATES:
+                    state['jobs'][job_id]['state'] = 'CA'
+            return None, True
+
+        self._locked(update)
+        return 0, '', ''
+
+    def sacct(self, args):
+        fields = ['JobID', 'JobName', 'State']
+        job_ids = None
+        allocations = False
+        for arg in args:
+            if arg.startswith('--format='):
+                fields = arg[len('--format='):].split(',')
+            elif arg.startswith('--jobs='):
+                job_ids = set(arg[len('--jobs='):].split(','))
+            elif arg == '--allocations':
+                allocations = True
+        state = self._locked(lambda state: (state, False))
+        now = time.time()
+        lines = []
+        for job_id, job in state['jobs'].items():
+            if (job_ids is not None and job_id not in job_ids) or job['started'] is None:
+                continue
+            elapsed = min(now - job['started'], job['time_limit'])
+            cpus = job['cpus']
+            record = {
+                'JobID': job_id,
+                'JobName': job['name'],
+                'State': STATE_NAMES[job['state']],
+                'NNodes': str(job['nodes']),
+                'AllocCPUS': str(cpus),
+                'Elapsed': _format_time(elapsed),
+                'TotalCPU': '',
+                'MaxRSS': '',
+                'ConsumedEnergy': '{:.0f}'.format(elapsed * job['nodes'] * 350),
+                'Timelimit': _format_time(job['time_limit']),
+                'Partition': job['partition'],
+                'Submit': _timestamp(job['submitted']),
+                'Start': _timestamp(job['started']),
+                'WorkDir': job['workdir'],
+            }
+            lines.append('|'.join(record.get(field, '') for field in fields))
+            if not allocations:
+                record.update({
+                    'JobID': job_id + '.0',
+                    'JobName': 'vasp_std',
+                    'TotalCPU': _format_time(elapsed * cpus * 0.8),
+                    'MaxRSS': '{}K'.format(1024 * 1024 * 180),
+                    'ConsumedEnergy': '',
+                })
+                lines.append('|'.join(record.get(field, '') for field in fields))
+        return 0, ''.join(line + '\n' for line in lines), ''
+
+    def run(self, command, args):
+        """Run a command, returning its exit status, standard output and standard error"""
+        return getattr(self, command)(args)
+
+
+def install_commands(bin_dir, state_path, username, python=sys.executable):
+    """
+    Write the wrappers of the Slurm commands, and of ``whoami``, into a directory to be put on the ``PATH``
+
+    :param bin_dir: the directory, created if needed
+    :param state_path: the JSON file holding the jobs
+    :param username: the name of the user owning the jobs
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    wrappers = {
+        command: '#!/bin/sh\nexec "{}" -S "{}" "{}" "{}" {} "$@"\n'.format(
+            python, os.path.abspath(__file__), state_path, username, command
+        ) for command in COMMANDS
+    }
+    wrappers['whoami'] = '#!/bin/sh\necho {}\n'.format(username)
+    for command, content in wrappers.items():
+        path = os.path.join(bin_dir, command)
+        with open(path, 'w') as handle:
+            handle.write(content)
+        os.chmod(path, 0o755)
+
+
+def main(argv):
+    state_path, username, command = argv[:3]
+    retval, stdout, stderr = FakeSlurm(state_path, username).run(command, argv[3:])
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    return retval
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Counts, bytes and latency of the operations of the transport and the scheduler
+
+When the daemon slows down, the time may go into SSH handshakes, authentication attempts, SFTP requests or ``squeue``
+calls. Methods decorated with :func:`instrumented` record, per operation type, the number of calls and failures, the
+bytes moved and a latency histogram into the process-wide :data:`METRICS`. Recording is off by default, and a disabled
+decorator costs a single attribute check. It is turned on with the ``ARCHER2_METRICS`` environmental variable or
+:func:`enable_metrics`, or temporarily for the operations run inside :func:`profile`.
+
+The metrics are exported as a Prometheus textfile (for the node exporter textfile collector) or as a JSON snapshot.
+"""
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+
+__all__ = (
+    'Metrics', 'METRICS', 'instrumented', 'enable_metrics', 'disable_metrics', 'profile', 'export_metrics',
+    'LATENCY_BUCKETS'
+)
+
+#: Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+#: Minimum interval in seconds between two automatic exports, see :func:`export_metrics`
+EXPORT_INTERVAL = 60
+
+
+class _Operation:
+    """Statistics of an operation type"""
+
+    __slots__ = ('count', 'failures', 'bytes', 'seconds', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+
+class Metrics:
+    """Thread-safe statistics of each operation type"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._operations = {}
+
+    def record(self, operation, seconds, nbytes=0, failed=False):
+        """
+        Record a call of an operation
+
+        :param operation: the operation type, e.g. ``sftp.stat``
+        :param seconds: the duration of the call
+        :param nbytes: the bytes transferred by the call
+        :param failed: whether the call raised
+        """
+        with self._lock:
+            stats = self._operations.get(operation)
+            if stats is None:
+                stats = self._operations[operation] = _Operation()
+            stats.count += 1
+            stats.failures += failed
+            stats.bytes += nbytes
+            stats.seconds += seconds
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    stats.buckets[index] += 1
+                    break
+
+    def reset(self):
+        with self._lock:
+            self._operations = {}
+
+    def snapshot(self):
+        """
+        Return the statistics of each operation
+
+        :return: dictionary of operation type to a dictionary with the ``count``, ``failures``, ``bytes``, total
+            ``seconds`` and the cumulative counts of the latency ``buckets``, keyed by their upper bound
+        """
+        with self._lock:
+            snapshot = {}
+            for operation, stats in sorted(self._operations.items()):
+                cumulative = 0
+                buckets = {}
+                for bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+                    cumulative += count
+                    buckets[str(bound)] = cumulative
+                buckets['+Inf'] = stats.count
+                snapshot[operation] = {
+                    'count': stats.count,
+                    'failures': stats.failures,
+                    'bytes': stats.bytes,
+                    'seconds': stats.seconds,
+                    'buckets': buckets,
+                }
+            return snapshot
+
+    def to_prometheus(self, prefix='archer2'):
+        """Return the statistics in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = [
+            '# HELP {}_operation_seconds Latency of the ARCHER2 transport and scheduler operations'.format(prefix),
+            '# TYPE {}_operation_seconds histogram'.format(prefix),
+        ]
+        for operation, stats in snapshot.items():
+            for bound, count in stats['buckets'].items():
+                lines.append('{}_operation_seconds_bucket{{operation="{}",le="{}"}} {}'.format(
+                    prefix, operation, bound, count
+                ))
+            lines.append('{}_operation_seconds_sum{{operation="{}"}} {}'.format(prefix, operation, stats['seconds']))
+            lines.append('{}_operation_seconds_count{{operation="{}"}} {}'.format(prefix, operation, stats['count']))
+        for name, key, description in (('failures', 'failures', 'Operations that raised an exception'),
+                                        ('bytes', 'bytes', 'Bytes transferred by the operations')):
+            lines.append('# HELP {}_operation_{}_total {}'.format(prefix, name, description))
+            lines.append('# TYPE {}_operation_{}_total counter'.format(prefix, name))
+            for operation, stats in snapshot.items():
+                lines.append('{}_operation_{}_total{{operation="{}"}} {}'.format(prefix, name, operation, stats[key]))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path, prefix='archer2'):
+        """Atomically write the statistics to a Prometheus textfile"""
+        _write_atomic(path, self.to_prometheus(prefix))
+
+    def write_json(self, path):
+        """Atomically write a JSON snapshot of the statistics"""
+        _write_atomic(path, json.dumps({'created': time.time(), 'operations': self.snapshot()}, indent=2))
+
+
+def _write_atomic(path, content):
+    with open(path + '.tmp', 'w') as handle:
+        handle.write(content)
+    os.replace(path + '.tmp', path)
+
+
+#: Process-wide metrics, recorded when enabled
+METRICS = Metrics()
+
+
+class _State:
+    """Whether anything is recorded at all - checked first by every instrumented call"""
+    enabled = bool(os.environ.get('ARCHER2_METRICS'))
+    profiles = 0
+    active = enabled
+    last_export = 0.0
+
+
+_PROFILES = contextvars.ContextVar('archer2_profiles', default=())
+_STATE_LOCK = threading.Lock()
+
+
+def _update_active():
+    _State.active = _State.enabled or _State.profiles > 0
+
+
+def enable_metrics():
+    """Start recording into :data:`METRICS`"""
+    _State.enabled = True
+    _update_active()
+
+
+def disable_metrics():
+    """Stop recording into :data:`METRICS`, the profiles still record"""
+    _State.enabled = False
+    _update_active()
+
+
+@contextlib.contextmanager
+def profile():
+    """
+    Record the operations run inside the block, and the tasks started from it, into a new :class:`Metrics`
+
+    For example, to profile the lifecycle of a single calculation::
+
+        with profile() as metrics:
+            run(builder)
+        print(metrics.to_prometheus())
+
+    The operations are recorded whether or not :data:`METRICS` is enabled.
+    """
+    metrics = Metrics()
+    token = _PROFILES.set(_PROFILES.get() + (metrics,))
+    with _STATE_LOCK:
+        _State.profiles += 1
+        _update_active()
+    try:
+        yield metrics
+    finally:
+        _PROFILES.reset(token)
+        with _STATE_LOCK:
+            _State.profiles -= 1
+            _update_active()
+
+
+def _record(operation, seconds, nbytes, failed):
+    if _State.enabled:
+        METRICS.record(operation, seconds, nbytes, failed)
+    for metrics in _PROFILES.get():
+        metrics.record(operation, seconds, nbytes, failed)
+
+
+def instrumented(operation, size=None):
+    """
+    Decorate a function to record its calls as an operation
+
+    :param operation: the operation type, e.g. ``sftp.stat``
+    :param size: optional callable returning the bytes transferred, called with the result and then the arguments
+        of the function
+    """
+
+    def decorator(function):
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _State.active:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            except Exception:
+                _record(operation, time.perf_counter() - start, 0, True)
+                raise
+            elapsed = time.perf_counter() - start
+            nbytes = 0
+            if size is not None:
+                try:
+                    nbytes = size(result, *args, **kwargs)
+                except (OSError, TypeError, ValueError):
+                    pass
+            _record(operation, elapsed, nbytes, False)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def export_metrics():
+    """
+    Write :data:`METRICS` to the files named by the ``ARCHER2_METRICS_TEXTFILE`` (Prometheus) and
+    ``ARCHER2_METRICS_JSON`` environmental variables, at most every :data:`EXPORT_INTERVAL` seconds
+
+    :return: True if the files were written
+    """
+    if not _State.enabled or time.monotonic() - _State.last_export < EXPORT_INTERVAL:
+        return False
+    textfile = os.environ.get('ARCHER2_METRICS_TEXTFILE')
+    jsonfile = os.environ.get('ARCHER2_METRICS_JSON')
+    if not textfile and not jsonfile:
+        return False
+    _State.last_export = time.monotonic()
+    if textfile:
+        METRICS.write_prometheus(textfile)
+    if jsonfile:
+        METRICS.write_json(jsonfile)
+    return True
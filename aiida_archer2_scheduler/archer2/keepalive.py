@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Background check of the open connections, replacing those that dropped
+
+Long daemon sessions lose their connection to ARCHER2 silently, and the operation that finds out pays for the
+reconnection. With keepalives enabled, the SSH transport sends a keepalive request every few seconds so that a dead
+connection is detected, and the :class:`LivenessMonitor` checks the open transports on the same period, marking those
+whose connection dropped. The connection is only replaced by the thread using the transport, at its next operation,
+so that it is never swapped under an operation in flight.
+"""
+import threading
+import weakref
+
+__all__ = ('LivenessMonitor', 'LIVENESS_MONITOR')
+
+
+class LivenessMonitor:
+    """Daemon thread calling ``_mark_if_dropped`` on the watched transports
+
+    Transports are held by weak references, so that a transport that is garbage collected is no longer watched.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._transports = weakref.WeakKeyDictionary()
+        self._wakeup = threading.Event()
+        self._thread = None
+        #: Number of dropped connections found by the monitor
+        self.dropped = 0
+
+    def watch(self, transport, interval):
+        """
+        Check a transport every ``interval`` seconds, the shortest interval of the watched transports is used
+
+        :param transport: an open transport with a ``_mark_if_dropped`` method returning True if its connection dropped
+        """
+        with self._lock:
+            self._transports[transport] = interval
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='archer2-liveness', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def unwatch(self, transport):
+        with self._lock:
+            self._transports.pop(transport, None)
+
+    def check(self):
+        """Check all watched transports once"""
+        with self._lock:
+            transports = list(self._transports.keys())
+        for transport in transports:
+            try:
+                if transport._mark_if_dropped():  # pylint: disable=protected-access
+                    self.dropped += 1
+            except Exception as exc:  # pylint: disable=broad-except
+                transport.logger.warning('Background check of the connection failed: {}'.format(exc))
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._transports:
+                    self._thread = None
+                    return
+                interval = min(self._transports.values())
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
+            self.check()
+
+
+#: The monitor of the transports of this process
+LIVENESS_MONITOR = LivenessMonitor()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Process-wide cache of parsed private keys
+
+Decrypting a passphrase protected key (bcrypt KDF) takes hundreds of milliseconds, and each ``SshTransport.open`` would
+otherwise parse the same key files again, trying each key class in turn. The :class:`KeyCache` keeps the parsed keys,
+keyed by the path and the signature (mtime and size) of the file, and remembers which key class loaded each file.
+"""
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+import time
+import weakref
+
+from paramiko.ssh_exception import SSHException
+
+__all__ = ('KeyCache', 'KEY_CACHE')
+
+
+def _signature(path):
+    """Signature of a key file and its certificate - any change to either gives a new cache entry"""
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cert_path = path[:-len('-cert.pub')] if path.endswith('-cert.pub') else path + '-cert.pub'
+    try:
+        cert_stat = os.stat(cert_path)
+    except OSError:
+        return signature
+    return signature + (cert_stat.st_mtime_ns, cert_stat.st_size)
+
+
+class KeyCache:
+    """Thread-safe LRU cache of parsed private keys
+
+    Keys are only handed out for the same passphrase they were decrypted with. The passphrase itself is never stored,
+    only a salted digest of it.
+    """
+
+    def __init__(self, max_entries=32, ttl=3600):
+        """
+        :param max_entries: maximum number of keys kept, the least recently used are evicted first
+        :param ttl: seconds after which a cached key is parsed again, None to keep keys until evicted
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._keys = OrderedDict()
+        self._classes = {}
+        self._lock = threading.Lock()
+        # Held only while a file is being loaded, so that the locks of files no longer loaded are dropped
+        self._path_locks = weakref.WeakValueDictionary()
+        self._salt = os.urandom(16)
+        self.hits = 0
+        self.misses = 0
+
+    def _digest(self, passphrase):
+        if passphrase is None:
+            return None
+        if isinstance(passphrase, str):
+            passphrase = passphrase.encode()
+        return hashlib.sha256(self._salt + passphrase).hexdigest()
+
+    def _path_lock(self, path):
+        with self._lock:
+            lock = self._path_locks.get(path)
+            if lock is None:
+                lock = self._path_locks[path] = threading.Lock()
+            return lock
+
+    def _lookup(self, entry):
+        """Return a cached key, or None, evicting it if expired"""
+        with self._lock:
+            cached = self._keys.get(entry)
+            if cached is None:
+                return None
+            key, stored_at = cached
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                del self._keys[entry]
+                return None
+            self._keys.move_to_end(entry)
+            self.hits += 1
+            return key
+
+    def load(self, path, passphrase, key_classes, loader):
+        """
+        Return the key of a file, parsing it only if needed
+
+        :param path: path of the private key (or certificate) file
+        :param passphrase: passphrase used for decrypting the key
+        :param key_classes: the key classes to try, in order
+        :param loader: callable ``loader(path, key_class, passphrase)`` parsing the key, raising ``SSHException`` or
+            ``ValueError`` if the class does not match
+        :return: a tuple of the key and the name of its class
+        :raises SSHException: if the file cannot be loaded by any of the classes
+        :raises OSError: if the file cannot be read
+        """
+        signature = _signature(path)
+        entry = (path, signature, self._digest(passphrase))
+
+        with self._path_lock(path):
+            key = self._lookup(entry)
+            if key is not None:
+                return key, type(key).__name__
+
+            with self._lock:
+                self.misses += 1
+                known = self._classes.get((path, signature))
+            if known is not None:
+                # Go straight to the class that loaded this file before
+                key_classes = sorted(key_classes, key=lambda cls: cls.__name__ != known)
+
+            key = None
+            saved_exception = None
+            for key_class in key_classes:
+                try:
+                    key = loader(path, key_class, passphrase)
+                    break
+                except (SSHException, ValueError) as exc:
+                    saved_exception = exc
+                    if known is not None and key_class.__name__ == known:
+                        # The class is right, so the passphrase must be wrong - no point trying the others
+                        break
+            if key is None:
+                raise saved_exception
+
+            with self._lock:
+                self._classes[(path, signature)] = key_class.__name__
+                self._keys[entry] = (key, time.monotonic())
+                self._keys.move_to_end(entry)
+                while len(self._keys) > self.max_entries:
+                    self._keys.popitem(last=False)
+                # Drop the detected classes of older versions of the same file
+                for stale in [item for item in self._classes if item[0] == path and item[1] != signature]:
+                    del self._classes[stale]
+
+        return key, key_class.__name__
+
+    def clear(self):
+        """Drop all cached keys"""
+        with self._lock:
+            self._keys.clear()
+            self._classes.clear()
+
+
+#: The cache shared by all clients of this process
+KEY_CACHE = KeyCache()
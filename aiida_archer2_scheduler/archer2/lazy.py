@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Attributes imported on first use, to keep loading the plugins fast
+
+AiiDA loads the transport and scheduler entry points for every ``verdi`` command and daemon worker, most of which never
+connect to ARCHER2. Attributes that need a slow import, such as the paramiko SSH client, are declared with
+:class:`LazyAttribute` on the plugin classes, or with :func:`lazy_module_attributes` on the modules, and only imported
+when first accessed.
+"""
+import importlib
+
+__all__ = ('LazyAttribute', 'lazy_module_attributes')
+
+
+def _resolve(module, name):
+    return getattr(importlib.import_module(module, __package__), name)
+
+
+class LazyAttribute:
+    """Class attribute set to the attribute ``name`` of ``module`` the first time it is accessed
+
+    Once resolved, the descriptor is replaced by the value on the class defining it, so that later accesses, and
+    assignments overriding it, are those of a plain class attribute.
+    """
+
+    def __init__(self, module, name):
+        """
+        :param module: the module name, relative to this package if it starts with a dot
+        :param name: the name of the attribute in the module
+        """
+        self.module = module
+        self.name = name
+        self._owner = None
+        self._attribute = None
+
+    def __set_name__(self, owner, name):
+        self._owner = owner
+        self._attribute = name
+
+    def __get__(self, instance, owner):
+        value = _resolve(self.module, self.name)
+        setattr(self._owner, self._attribute, value)
+        return value
+
+
+def lazy_module_attributes(module_name, attributes):
+    """
+    Return a module ``__getattr__`` importing some attributes of the module on first access
+
+    :param module_name: the name of the module, for the error messages
+    :param attributes: dictionary of the attribute names to the module they are imported from
+    """
+
+    def __getattr__(name):
+        if name not in attributes:
+            raise AttributeError('module {!r} has no attribute {!r}'.format(module_name, name))
+        return _resolve(attributes[name], name)
+
+    return __getattr__
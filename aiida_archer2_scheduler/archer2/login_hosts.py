@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Health of the login nodes, used to choose the one new connections go to
+
+ARCHER2 has several login nodes behind the ``login.archer2.ac.uk`` alias. When the node a computer is set up with is
+overloaded or down, every operation stalls or fails. The :class:`LoginHostHealth` keeps, for each login host, a moving
+average of the time to connect and log in, and the number of consecutive failures. Connections go to the fastest host
+not in quarantine, and a host that failed is put in quarantine for a time doubling with each further failure.
+"""
+import threading
+import time
+
+__all__ = ('LoginHostHealth', 'LOGIN_HOST_HEALTH', 'parse_login_hosts')
+
+
+def parse_login_hosts(value, default_port=None):
+    """
+    Parse a comma-separated list of ``host[:port]``
+
+    :return: list of ``(host, port)`` tuples, the port being ``default_port`` if not given
+    """
+    hosts = []
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        host, _, port = item.partition(':')
+        hosts.append((host, int(port) if port else default_port))
+    return hosts
+
+
+class LoginHostHealth:
+    """Thread-safe record of the connection time and failures of each login host"""
+
+    #: Weight of the latest connection time in the moving average
+    SMOOTHING = 0.3
+    #: Quarantine after the first failure, in seconds, doubled by each further consecutive failure
+    QUARANTINE = 30.0
+    #: Longest quarantine, in seconds
+    MAX_QUARANTINE = 1800.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latency = {}
+        self._failures = {}
+        self._quarantined_until = {}
+
+    def order(self, hosts):
+        """
+        Return the hosts in the order they should be tried
+
+        Hosts not in quarantine come first: those never connected to, so that they get measured, then the others from
+        the fastest to the slowest. Hosts in quarantine come last, from the one released soonest, so that a connection
+        is still attempted when all of them failed recently.
+        """
+        now = time.monotonic()
+        with self._lock:
+            available = [host for host in hosts if self._quarantined_until.get(host, 0) <= now]
+            quarantined = [host for host in hosts if self._quarantined_until.get(host, 0) > now]
+            available.sort(key=lambda host: (host in self._latency, self._latency.get(host, 0)))
+            quarantined.sort(key=lambda host: self._quarantined_until[host])
+        return available + quarantined
+
+    def record_success(self, host, seconds):
+        """Record a successful connection, taking the host out of quarantine"""
+        with self._lock:
+            previous = self._latency.get(host)
+            self._latency[host] = seconds if previous is None else previous + self.SMOOTHING * (seconds - previous)
+            self._failures.pop(host, None)
+            self._quarantined_until.pop(host, None)
+
+    def record_failure(self, host):
+        """
+        Record a failed connection, putting the host in quarantine
+
+        :return: the duration of the quarantine in seconds
+        """
+        with self._lock:
+            failures = self._failures.get(host, 0) + 1
+            self._failures[host] = failures
+            duration = min(self.QUARANTINE * 2**(failures - 1), self.MAX_QUARANTINE)
+            self._quarantined_until[host] = time.monotonic() + duration
+            return duration
+
+    def status(self):
+        """
+        Return the state of each host
+
+        :return: dictionary of host to a dictionary with the average connection time in seconds (None if never
+            connected), the number of consecutive failures and the remaining quarantine in seconds
+        """
+        now = time.monotonic()
+        with self._lock:
+            hosts = set(self._latency) | set(self._failures)
+            return {
+                host: {
+                    'latency': self._latency.get(host),
+                    'failures': self._failures.get(host, 0),
+                    'quarantine': max(self._quarantined_until.get(host, 0) - now, 0),
+                } for host in sorted(hosts, key=str)
+            }
+
+    def forget(self):
+        with self._lock:
+            self._latency.clear()
+            self._failures.clear()
+            self._quarantined_until.clear()
+
+
+#: Health of the login hosts, shared by the transports of the process
+LOGIN_HOST_HEALTH = LoginHostHealth()
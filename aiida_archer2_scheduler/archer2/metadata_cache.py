@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Session-scoped cache of remote file metadata
+
+Uploading, retrieving and cleaning up a calculation calls ``isdir``, ``isfile``, ``listdir`` and ``normalize`` on the
+same paths again and again (the stock ``isfile`` alone calls ``stat`` three times), each one being an SFTP round trip.
+The :class:`RemoteMetadataCache` remembers the results for the lifetime of an open connection. The transport
+invalidates the affected entries whenever it changes something on the remote.
+"""
+import errno
+import posixpath
+
+__all__ = ('RemoteMetadataCache',)
+
+
+class RemoteMetadataCache:
+    """Cache of ``stat``, ``listdir`` and ``normalize`` results keyed by absolute remote path
+
+    Paths that do not exist are cached as well, so that repeated existence checks are answered locally.
+    """
+
+    def __init__(self):
+        self._stat = {}
+        self._listdir = {}
+        self._normalize = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, table, path):
+        try:
+            value = table[path]
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        return value
+
+    def get_stat(self, path):
+        """
+        Return the cached stat of a path
+
+        :raises KeyError: if the path is not cached
+        :raises FileNotFoundError: if the path is cached as missing
+        """
+        value = self._get(self._stat, path)
+        if value is None:
+            raise FileNotFoundError(errno.ENOENT, 'No such file', path)
+        return value
+
+    def set_stat(self, path, value):
+        """Cache the stat of a path, None meaning that the path does not exist"""
+        self._stat[path] = value
+
+    def get_listdir(self, path):
+        """Return a copy of the cached listing of a directory, raising KeyError if not cached"""
+        return list(self._get(self._listdir, path))
+
+    def set_listdir(self, path, names):
+        self._listdir[path] = list(names)
+
+    def get_normalize(self, path):
+        """Return the cached normalized path, raising KeyError if not cached"""
+        return self._get(self._normalize, path)
+
+    def set_normalize(self, path, value):
+        self._normalize[path] = value
+
+    def invalidate(self, path):
+        """
+        Drop the entries affected by a change to a path
+
+        This covers the path itself, everything below it, and the listing and stat of its parent directory.
+        """
+        path = posixpath.normpath(path)
+        prefix = path.rstrip('/') + '/'
+        parent = posixpath.dirname(path)
+        for table in (self._stat, self._listdir, self._normalize):
+            for key in [key for key in table if key == path or key.startswith(prefix)]:
+                del table[key]
+            table.pop(parent, None)
+
+    def flush(self):
+        """Drop all entries, keeping the counters"""
+        self._stat.clear()
+        self._listdir.clear()
+        self._normalize.clear()
+
+    def stats(self):
+        """Return the hit and miss counters, and the number of entries"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._stat) + len(self._listdir) + len(self._normalize),
+        }
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent SFTP transfers over several channels of one authenticated connection
+
+Over the link to ARCHER2 the time to transfer many small files is dominated by latency, as each SFTP request waits for
+the previous one. The :class:`ParallelTransfer` spreads the files over a bounded number of worker threads, each with
+its own SFTP channel on the same connection, so that several requests are in flight at any time.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import os
+import queue
+
+__all__ = ('ParallelTransfer', 'TransferReport')
+
+PUT = 'put'
+GET = 'get'
+
+
+class TransferReport:
+    """Outcome of a batch of transfers, one failure does not stop the others"""
+
+    def __init__(self):
+        self.succeeded = []
+        self.failed = {}
+        self.bytes_transferred = 0
+
+    def __bool__(self):
+        return not self.failed
+
+    def raise_for_errors(self):
+        """
+        Raise an OSError summarising the failures, if any
+
+        :raises OSError: if at least one of the transfers failed
+        """
+        if not self.failed:
+            return
+        details = '; '.join('{}: {}'.format(source, exc) for source, exc in sorted(self.failed.items()))
+        raise OSError('{} of {} transfers failed - {}'.format(
+            len(self.failed),
+            len(self.failed) + len(self.succeeded), details
+        ))
+
+
+class ParallelTransfer:
+    """Run ``put`` and ``get`` jobs on a bounded pool of SFTP channels"""
+
+    #: Number of read requests kept in flight when prefetching a file
+    max_concurrent_prefetch_requests = 64
+
+    def __init__(self, open_sftp, workers=4):
+        """
+        :param open_sftp: callable returning a new ``SFTPClient`` on the authenticated connection
+        :param workers: maximum number of concurrent transfers, and of SFTP channels opened
+        """
+        self.open_sftp = open_sftp
+        self.workers = max(int(workers), 1)
+
+    def _transfer(self, sftp, direction, source, destination):
+        """Transfer a single file, return the number of bytes transferred"""
+        if direction == PUT:
+            # put() pipelines the writes, and checks the size of the file once done
+            return sftp.put(source, destination, confirm=True).st_size
+        try:
+            # get() prefetches the file, keeping several read requests in flight
+            try:
+                sftp.get(
+                    source,
+                    destination,
+                    prefetch=True,
+                    max_concurrent_prefetch_requests=self.max_concurrent_prefetch_requests,
+                )
+            except TypeError:
+                # paramiko < 3.3 does not support limiting the prefetch requests
+                sftp.get(source, destination)
+        except OSError:
+            # Do not leave truncated files behind
+            try:
+                os.remove(destination)
+            except OSError:
+                pass
+            raise
+        return os.path.getsize(destination)
+
+    def run(self, jobs):
+        """
+        Run the transfers
+
+        :param jobs: list of ``(direction, source, destination)`` tuples, where direction is ``'put'`` or ``'get'``
+        :return: a :class:`TransferReport`
+        """
+        report = TransferReport()
+        if not jobs:
+            return report
+
+        nchannels = min(self.workers, len(jobs))
+        channels = queue.Queue()
+        opened = []
+        try:
+            for _ in range(nchannels):
+                try:
+                    sftp = self.open_sftp()
+                except Exception:  # pylint: disable=broad-except
+                    # The server may limit the number of channels - carry on with those already open
+                    if not opened:
+                        raise
+                    break
+                opened.append(sftp)
+                channels.put(sftp)
+            nchannels = len(opened)
+
+            def work(job):
+                sftp = channels.get()
+                try:
+                    return self._transfer(sftp, *job)
+                finally:
+                    channels.put(sftp)
+
+            with ThreadPoolExecutor(max_workers=nchannels) as executor:
+                futures = [(job, executor.submit(work, job)) for job in jobs]
+                for (_, source, _), future in futures:
+                    try:
+                        report.bytes_transferred += future.result() or 0
+                    except Exception as exc:  # pylint: disable=broad-except
+                        report.failed[source] = exc
+                    else:
+                        report.succeeded.append(source)
+        finally:
+            for sftp in opened:
+                sftp.close()
+        return report
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Limits of the ARCHER2 quality of service (QOS) levels, and selection of the QOS of a job
+
+Jobs exceeding the limits of their QOS are only rejected by ``sbatch``, and a small job left in the ``standard`` QOS
+may wait hours when the ``short`` QOS would start it at once. The rule table lists the QOS from the fastest to start
+to the slowest, so that the first one the job fits in is picked. The number of jobs a user may have queued in each QOS
+is limited as well, so the QOS the job fits in are all kept, to fall back on the next one when a QOS is full. Some QOS
+are only open on some days of the week, e.g. ``short`` from Monday to Friday.
+"""
+from collections import namedtuple
+
+__all__ = ('QosRule', 'ARCHER2_QOS_RULES', 'select_qos', 'fitting_qos', 'check_qos')
+
+QosRule = namedtuple(
+    'QosRule',
+    ['name', 'partition', 'max_nodes', 'max_walltime', 'max_jobs_queued', 'min_nodes', 'min_walltime', 'weekdays']
+)
+QosRule.__new__.__defaults__ = (1, 0, None)
+QosRule.__doc__ = """Limits of a QOS, walltimes in seconds, and the days it is open on (Monday is 0, None for all)"""
+
+#: Limits of the ARCHER2 QOS, from the fastest to start to the slowest
+ARCHER2_QOS_RULES = (
+    QosRule('short', 'standard', max_nodes=32, max_walltime=20 * 60, max_jobs_queued=2, weekdays=(0, 1, 2, 3, 4)),
+    QosRule('standard', 'standard', max_nodes=1024, max_walltime=24 * 3600, max_jobs_queued=64),
+    QosRule('long', 'standard', max_nodes=64, max_walltime=48 * 3600, max_jobs_queued=16, min_walltime=24 * 3600),
+    QosRule('largescale', 'standard', max_nodes=5860, max_walltime=12 * 3600, max_jobs_queued=8, min_nodes=1025),
+    QosRule('highmem', 'highmem', max_nodes=256, max_walltime=48 * 3600, max_jobs_queued=16),
+    QosRule('serial', 'serial', max_nodes=1, max_walltime=24 * 3600, max_jobs_queued=32),
+)
+
+
+def _fits(rule, nodes, walltime, queued, weekday=None):
+    if not rule.min_nodes <= nodes <= rule.max_nodes:
+        return False
+    if walltime is not None and not rule.min_walltime <= walltime <= rule.max_walltime:
+        return False
+    if weekday is not None and rule.weekdays is not None and weekday not in rule.weekdays:
+        return False
+    return queued.get(rule.name, 0) < rule.max_jobs_queued
+
+
+def fitting_qos(nodes, walltime, partition, rules=ARCHER2_QOS_RULES, queued=None, weekday=None):
+    """
+    Return the rules of a partition the job fits in, in the order of the table
+
+    See :func:`select_qos` for the parameters.
+    """
+    queued = queued or {}
+    return [rule for rule in rules if rule.partition == partition and _fits(rule, nodes, walltime, queued, weekday)]
+
+
+def select_qos(nodes, walltime, partition, rules=ARCHER2_QOS_RULES, queued=None, weekday=None):
+    """
+    Return the first rule of a partition the job fits in
+
+    :param nodes: number of nodes of the job
+    :param walltime: wallclock limit of the job in seconds, None is not checked
+    :param partition: the partition of the job
+    :param rules: the rule table, from the most to the least preferred QOS
+    :param queued: optional dictionary with the number of jobs already queued in each QOS, QOS that are full are
+        skipped
+    :param weekday: optional day of the week of the submission, Monday being 0 - QOS closed on that day are skipped
+    :raises ValueError: if the job does not fit in any QOS of the partition
+    """
+    fitting = fitting_qos(nodes, walltime, partition, rules, queued, weekday)
+    if fitting:
+        return fitting[0]
+    raise ValueError(
+        'No QOS of the {} partition accepts {} nodes for {} seconds, the limits are: {}'.format(
+            partition, nodes, walltime, ', '.join(
+                '{} ({}-{} nodes, {}-{} s)'.format(
+                    rule.name, rule.min_nodes, rule.max_nodes, rule.min_walltime, rule.max_walltime
+                ) for rule in rules if rule.partition == partition
+            )
+        )
+    )
+
+
+def check_qos(qos, nodes, walltime, rules=ARCHER2_QOS_RULES):
+    """
+    Check that a job fits in the limits of a QOS, QOS missing from the rule table are not checked
+
+    :raises ValueError: if the job exceeds the limits of the QOS
+    """
+    for rule in rules:
+        if rule.name == qos and not _fits(rule, nodes, walltime, {}):
+            raise ValueError(
+                'The {} QOS accepts {}-{} nodes for {}-{} seconds, but the job requests {} nodes for {} seconds'.format(
+                    qos, rule.min_nodes, rule.max_nodes, rule.min_walltime, rule.max_walltime, nodes, walltime
+                )
+            )
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Resumable, verified retrieval of large output files
+
+Large outputs (trajectories, wavefunctions, restart files) are otherwise retrieved in a single SFTP transfer once the
+job is finished, and a dropped connection means starting again from the first byte. The :class:`ResumableDownload`
+fetches a file in fixed-size chunks into a local partial file, checks each group of chunks against the sha256 computed
+on the remote, and records the verified offset next to it. An interrupted transfer resumes from that offset, and a file
+still being appended to by a running job can be fetched as it grows, so that only its tail is left to retrieve at the
+end. A file completed from chunks fetched earlier is compared as a whole with the remote before it is handed out.
+"""
+import errno
+import hashlib
+import json
+import os
+
+from aiida.common.escaping import escape_for_bash
+
+__all__ = ('ResumableDownload', 'ChecksumMismatch', 'chunk_checksum_command', 'file_checksum', 'stream_outputs')
+
+#: Default location of the partial files, can be overridden with the ``ARCHER2_DOWNLOAD_CACHE`` environmental variable
+DEFAULT_DOWNLOAD_CACHE = os.path.join('~', '.cache', 'aiida-archer2-scheduler', 'downloads')
+#: Size of the chunks, which is also the granularity of the resumption
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class ChecksumMismatch(OSError):
+    """A chunk received differs from the content of the remote file"""
+
+
+def chunk_checksum_command(remotepath, chunk_size, indices):
+    """Return the command printing the sha256 of the given chunks of a remote file, one per line"""
+    return 'for chunk in {}; do dd if={} bs={} skip=$chunk count=1 2>/dev/null | sha256sum; done'.format(
+        ' '.join(str(index) for index in indices), escape_for_bash(remotepath), chunk_size
+    )
+
+
+def file_checksum(path, block_size=DEFAULT_CHUNK_SIZE):
+    """Return the sha256 of a local file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ResumableDownload:
+    """Chunked download of remote files into a local cache of partial files
+
+    The chunks already verified are not checked again while a file is fetched in steps, which suits files that are
+    only appended to. When a file is completed, the whole of it is compared with the remote if part of it was fetched
+    earlier, and it is fetched again from the start if it changed in place - e.g. a checkpoint rewritten at the same
+    size. A remote file shorter than the verified offset is fetched again from the start.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self, transport, prefix, cache_dir=None, chunk_size=DEFAULT_CHUNK_SIZE, chunks_per_check=16, retries=3
+    ):
+        """
+        :param transport: an open transport, its ``sftp`` client and ``exec_command_wait`` are used
+        :param prefix: identifies the remote machine and user in the cache, e.g. ``user@host``
+        :param cache_dir: the local cache. Defaults to ``ARCHER2_DOWNLOAD_CACHE`` or :data:`DEFAULT_DOWNLOAD_CACHE`.
+        :param chunk_size: size of the chunks in bytes
+        :param chunks_per_check: number of chunks whose checksums are verified in a single command
+        :param retries: number of times a transfer is resumed within a call after an error
+        """
+        if cache_dir is None:
+            cache_dir = os.environ.get('ARCHER2_DOWNLOAD_CACHE', DEFAULT_DOWNLOAD_CACHE)
+        self.transport = transport
+        self.prefix = prefix
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.chunk_size = chunk_size
+        self.chunks_per_check = chunks_per_check
+        self.retries = retries
+        self.bytes_received = 0
+
+    def partial_path(self, remotepath):
+        """Return the local partial file of an absolute remote path, its state is kept in a ``.json`` file next to it"""
+        key = hashlib.sha256('{}:{}'.format(self.prefix, remotepath).encode()).hexdigest()
+        return os.path.join(self.cache_dir, key + '.part')
+
+    def verified_size(self, remotepath):
+        """Return the number of bytes of a remote file already fetched and verified"""
+        return self._load_state(self.partial_path(remotepath), remotepath)
+
+    @staticmethod
+    def _load_state(partial, remotepath):
+        try:
+            with open(partial + '.json') as handle:
+                state = json.load(handle)
+        except (OSError, ValueError):
+            return 0
+        if state.get('remote') != remotepath or not os.path.isfile(partial):
+            return 0
+        return min(state['offset'], os.path.getsize(partial))
+
+    @staticmethod
+    def _save_state(partial, remotepath, offset):
+        with open(partial + '.json.tmp', 'w') as handle:
+            json.dump({'remote': remotepath, 'offset': offset}, handle)
+        os.replace(partial + '.json.tmp', partial + '.json')
+
+    def discard(self, remotepath):
+        """Remove the partial file of a remote path from the cache"""
+        partial = self.partial_path(remotepath)
+        for path in (partial, partial + '.json'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def fetch(self, remotepath, complete=True):
+        """
+        Fetch a remote file into its partial file, resuming from the verified offset
+
+        :param remotepath: absolute path of the remote file
+        :param complete: if True the file is fetched to its end, and compared as a whole with the remote. Otherwise
+            only the complete chunks are fetched, the file being still written.
+        :return: path of the partial file, to be moved out of the cache by the caller once complete
+        :raises OSError: if the transfer still fails after the retries, the partial file is kept for the next call
+        """
+        partial = self.partial_path(remotepath)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        resumed = False
+        for attempt in range(self.retries + 1):
+            try:
+                resumed = self._fetch(remotepath, partial, complete) > 0 or resumed
+                if complete and resumed and file_checksum(partial) != self._remote_checksum(remotepath):
+                    # Chunks fetched earlier were changed since, all of them are suspect
+                    self.transport.logger.warning(
+                        '{} changed since it was partly fetched, fetching it again from the start'.format(remotepath)
+                    )
+                    self.discard(remotepath)
+                    resumed = False
+                    self._fetch(remotepath, partial, complete)
+                return partial
+            except (OSError, EOFError) as exc:
+                if attempt == self.retries:
+                    raise
+                self.transport.logger.warning(
+                    'Retrieval of {} interrupted at {} bytes ({}), resuming'.format(
+                        remotepath, self._load_state(partial, remotepath), exc
+                    )
+                )
+        return partial
+
+    def _fetch(self, remotepath, partial, complete):
+        """Fetch a file from its verified offset, returning the offset resumed from"""
+        sftp = self.transport.sftp
+        size = sftp.stat(remotepath).st_size
+        offset = self._load_state(partial, remotepath)
+        if offset > size:
+            offset = 0
+        elif offset != size:
+            # Only an incomplete final chunk is left unaligned, fetch it again
+            offset -= offset % self.chunk_size
+        end = size if complete else size - size % self.chunk_size
+
+        resumed = offset
+        with open(partial, 'r+b' if os.path.exists(partial) else 'w+b') as handle:
+            handle.truncate(offset)
+            if offset >= end:
+                return resumed
+            with sftp.open(remotepath, 'rb') as remote:
+                while offset < end:
+                    ranges = []
+                    start = offset
+                    while start < end and len(ranges) < self.chunks_per_check:
+                        length = min(self.chunk_size, end - start)
+                        ranges.append((start, length))
+                        start += length
+                    handle.seek(offset)
+                    digests = []
+                    for (_, length), data in zip(ranges, remote.readv(ranges)):
+                        if len(data) != length:
+                            raise EOFError('{} is shorter than expected'.format(remotepath))
+                        handle.write(data)
+                        digests.append(hashlib.sha256(data).hexdigest())
+                        self.bytes_received += length
+                    handle.flush()
+                    os.fsync(handle.fileno())
+                    self._verify(remotepath, ranges, digests)
+                    offset = start
+                    self._save_state(partial, remotepath, offset)
+        return resumed
+
+    def _remote_checksum(self, remotepath):
+        """Return the sha256 of a whole remote file"""
+        retval, stdout, stderr = self.transport.exec_command_wait('sha256sum {}'.format(escape_for_bash(remotepath)))
+        if retval != 0:
+            raise OSError('Checksum of {} failed with exit status {}: {}'.format(remotepath, retval, stderr.strip()))
+        return stdout.split()[0] if stdout.strip() else None
+
+    def _verify(self, remotepath, ranges, digests):
+        """Compare the digests of the chunks received with those of the remote file"""
+        command = chunk_checksum_command(remotepath, self.chunk_size, [start // self.chunk_size for start, _ in ranges])
+        retval, stdout, stderr = self.transport.exec_command_wait(command)
+        if retval != 0:
+            raise OSError('Checksum of {} failed with exit status {}: {}'.format(remotepath, retval, stderr.strip()))
+        remote_digests = [line.split()[0] for line in stdout.splitlines() if line.strip()]
+        for (start, _), digest, remote_digest in zip(ranges, digests, remote_digests + [None] * len(digests)):
+            if digest != remote_digest:
+                raise ChecksumMismatch(
+                    'Chunk of {} at offset {} differs from the remote file'.format(remotepath, start)
+                )
+
+
+def stream_outputs(node, transport, filenames=None):
+    """
+    Calculation monitor fetching output files while the job runs, so that little is left to retrieve at the end
+
+    Only takes effect with a transport having ``resumable_download_size`` set. Never asks for the job to be killed.
+    The files should be only appended to, such as trajectories and logs - a file rewritten in place is fetched again
+    in full when retrieved.
+
+    :param node: the calculation job node
+    :param transport: the open transport
+    :param filenames: the files to stream, relative to the working directory, given in the ``kwargs`` of the monitor
+    """
+    if not getattr(transport, 'prefetch_files', None) or not filenames:
+        return None
+    workdir = node.get_remote_workdir()
+    try:
+        transport.prefetch_files([os.path.join(workdir, name) for name in filenames])
+    except OSError as exc:
+        if getattr(exc, 'errno', None) != errno.ENOENT:
+            transport.logger.warning('Streaming the outputs of {} failed: {}'.format(node.pk, exc))
+    return None
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Local history of the runtime of finished jobs, used to tune their wallclock limits
+
+Jobs asking for 24 hours when they run for two are not considered by the Slurm backfill scheduler, and wait much
+longer than needed. The :class:`RuntimeHistory` records, for each job submitted, a key made of its codes, resources
+and an input fingerprint. Once the job is finished its elapsed time is taken from ``sacct``, so that later jobs with the
+same key can ask for a wallclock limit close to what they actually need.
+"""
+import hashlib
+import json
+from math import ceil
+import os
+import sqlite3
+import time
+
+__all__ = ('RuntimeHistory', 'runtime_key', 'quantile')
+
+#: Default location of the history, can be overridden with the ``ARCHER2_RUNTIME_HISTORY`` environmental variable
+DEFAULT_RUNTIME_HISTORY = os.path.join('~', '.cache', 'aiida-archer2-scheduler', 'runtime_history.sqlite')
+
+
+def runtime_key(job_tmpl, fingerprint=''):
+    """
+    Return the key of a job: its command lines, resources and an input fingerprint
+
+    :param job_tmpl: the job template
+    :param fingerprint: string identifying the inputs, e.g. the size of the system simulated
+    """
+    resource = job_tmpl.job_resource
+    content = {
+        'codes': [
+            list(code_info.prepend_cmdline_params or []) + list(code_info.cmdline_params or []) +
+            [code_info.stdin_name] for code_info in job_tmpl.codes_info or []
+        ],
+        'resources': [resource.num_machines, resource.num_mpiprocs_per_machine, resource.num_cores_per_mpiproc],
+        'fingerprint': fingerprint,
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def quantile(values, fraction):
+    """Return the nearest-rank quantile of a list of values"""
+    values = sorted(values)
+    rank = min(max(ceil(fraction * len(values)), 1), len(values))
+    return values[rank - 1]
+
+
+class RuntimeHistory:
+    """History of the submitted jobs and of their runtimes, shared by all daemon workers through sqlite"""
+
+    def __init__(self, path=None):
+        """
+        :param path: the sqlite file. Defaults to ``ARCHER2_RUNTIME_HISTORY`` or :data:`DEFAULT_RUNTIME_HISTORY`.
+        """
+        if path is None:
+            path = os.environ.get('ARCHER2_RUNTIME_HISTORY', DEFAULT_RUNTIME_HISTORY)
+        self.path = os.path.expanduser(path)
+        self._initialised = False
+
+    def _connect(self):
+        if not self._initialised:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30)
+        if not self._initialised:
+            with connection:
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS submissions ('
+                    'job_id TEXT PRIMARY KEY, key TEXT NOT NULL, requested INTEGER, tuned INTEGER, '
+                    'nodes INTEGER NOT NULL, created REAL NOT NULL)'
+                )
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS runs ('
+                    'job_id TEXT PRIMARY KEY, key TEXT NOT NULL, elapsed INTEGER NOT NULL, recorded REAL NOT NULL)'
+                )
+                connection.execute('CREATE INDEX IF NOT EXISTS runs_key ON runs (key)')
+                connection.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+            self._initialised = True
+        return connection
+
+    def record_submission(self, job_id, key, requested, tuned, nodes):
+        """
+        Record the key of a job once it is submitted
+
+        :param job_id: the job ID, qualified by the cluster and user since the history may be shared by several
+            AiiDA profiles and computers
+        :param requested: the wallclock limit requested, in seconds
+        :param tuned: the wallclock limit used instead, or None if not tuned
+        :param nodes: the number of nodes of the job
+        """
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute(
+                    'INSERT OR REPLACE INTO submissions (job_id, key, requested, tuned, nodes, created) '
+                    'VALUES (?, ?, ?, ?, ?, ?)', (job_id, key, requested, tuned, nodes, time.time())
+                )
+        finally:
+            connection.close()
+
+    def add_runs(self, runs):
+        """
+        Record the elapsed time of finished jobs, those whose submission was not recorded are ignored
+
+        :param runs: list of ``(job_id, elapsed)`` tuples, the job ID qualified as in :meth:`record_submission` and the
+            elapsed time in seconds
+        :return: the number of runs recorded
+        """
+        connection = self._connect()
+        try:
+            with connection:
+                keys = dict(connection.execute('SELECT job_id, key FROM submissions').fetchall())
+                now = time.time()
+                rows = [(job_id, keys[job_id], elapsed, now) for job_id, elapsed in runs if job_id in keys]
+                connection.executemany('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?)', rows)
+            return len(rows)
+        finally:
+            connection.close()
+
+    def elapsed(self, key):
+        """Return the elapsed times, in seconds, of the finished jobs with the given key"""
+        connection = self._connect()
+        try:
+            return [row[0] for row in connection.execute('SELECT elapsed FROM runs WHERE key = ?', (key,))]
+        finally:
+            connection.close()
+
+    def get_meta(self, name, default=None):
+        connection = self._connect()
+        try:
+            row = connection.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+            return row[0] if row else default
+        finally:
+            connection.close()
+
+    def set_meta(self, name, value):
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (name, value))
+        finally:
+            connection.close()
+
+    def savings(self):
+        """
+        Return the wallclock saved by tuning
+
+        :return: dictionary with the number of jobs submitted and tuned, and the node-hours requested without and with
+            tuning
+        """
+        connection = self._connect()
+        try:
+            submitted, tuned, requested, used = connection.execute(
+                'SELECT COUNT(*), COUNT(tuned), COALESCE(SUM(requested * nodes), 0), '
+                'COALESCE(SUM(COALESCE(tuned, requested) * nodes), 0) FROM submissions WHERE requested IS NOT NULL'
+            ).fetchone()
+        finally:
+            connection.close()
+        return {
+            'jobs': submitted,
+            'tuned': tuned,
+            'requested_node_hours': requested / 3600,
+            'tuned_node_hours': used / 3600,
+            'saved_node_hours': (requested - used) / 3600,
+        }
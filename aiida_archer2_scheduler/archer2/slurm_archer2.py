@@ -1,10 +1,28 @@
 """
 Scheduler module for ARCHER2
 """
+from collections import OrderedDict
+import copy
+from datetime import datetime, timedelta
 from math import ceil
-from aiida.schedulers.plugins.slurm import SlurmScheduler, NodeNumberJobResource
+import os
+import re
+import threading
+import time
+
+from aiida.schedulers.plugins.slurm import SlurmScheduler, NodeNumberJobResource, _FIELD_SEPARATOR
+from aiida.common.datastructures import CodeRunMode
+from aiida.schedulers.datastructures import JobState, JobTemplateCodeInfo
+from aiida.schedulers.scheduler import SchedulerError
+from aiida.common.escaping import escape_for_bash
 from aiida.common.extendeddicts import AttributeDict
 
+from .efficiency import SACCT_EFFICIENCY_FIELDS, aggregate_sacct
+from .instrumentation import instrumented
+from .qos import ARCHER2_QOS_RULES, check_qos, fitting_qos, select_qos
+from .runtime_history import RuntimeHistory, quantile, runtime_key
+from .topology import NODE_MODELS
+
 
 class FelxibleNodeNumber(NodeNumberJobResource):
     """A more fexlible node number JobResources"""
@@ -113,6 +131,189 @@ class Archer2SlurmJobResource(FelxibleNodeNumber):
         return resources
 
 
+class TimedCache:
+    """Process-wide cache of results of remote queries, each valid for a limited time"""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, ttl):
+        """Return the value stored no more than ``ttl`` seconds ago, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > ttl:
+            return None
+        return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+#: Parsed ``squeue`` snapshots, keyed by login ``(host, username)``. Several AiiDA computers (e.g. one per budget) may
+#: point to ARCHER2 with the same login: with a snapshot of all the jobs of the user, as a dictionary of job ID to
+#: ``JobInfo``, all of them are answered by a single ``squeue`` call per polling interval.
+SQUEUE_SNAPSHOTS = TimedCache()
+
+
+def iter_joblist_lines(stdout, separator=_FIELD_SEPARATOR):
+    """
+    Iterate over the job lines of the squeue output without splitting them into fields
+
+    :return: generator of ``(job_id, line)`` tuples
+    """
+    position = 0
+    length = len(stdout)
+    while position < length:
+        end = stdout.find('\n', position)
+        if end < 0:
+            end = length
+        first = stdout.find(separator, position, end)
+        if first >= 0:
+            line = stdout[position:end].rstrip('\r')
+            job_id = stdout[position:first]
+            if '_[' in job_id:
+                # Pending tasks of an array may be listed on a single line
+                rest = line[first - position:]
+                for task_id in expand_array_job_id(job_id):
+                    yield task_id, task_id + rest
+            else:
+                yield job_id, line
+        position = end + 1
+
+
+def expand_array_job_id(job_id):
+    """
+    Expand the ID of several tasks of a job array into the ``<array job ID>_<index>`` of each task
+
+    :param job_id: ID as printed by squeue, e.g. ``1234_[0-3,7%2]``
+    """
+    array_id, _, tasks = job_id.partition('_[')
+    tasks = tasks.rstrip(']').split('%')[0]
+    task_ids = []
+    for item in tasks.split(','):
+        bounds, _, step = item.partition(':')
+        first, _, last = bounds.partition('-')
+        for index in range(int(first), int(last or first) + 1, int(step or 1)):
+            task_ids.append('{}_{}'.format(array_id, index))
+    return task_ids
+
+
+class JobRecords:
+    """
+    Compact record of the jobs seen in previous squeue outputs
+
+    Each job is remembered by its squeue line and the ``JobInfo`` built for it, so that the ``JobInfo`` is only built
+    again once the line changes - that is every poll for running jobs, whose time used is in the line, but not for
+    the pending ones, which make most of a long queue. Jobs are keyed by ``(host, username, job ID)``, as the same
+    process may poll several computers. Jobs not seen for ``max_age`` seconds are forgotten.
+    """
+
+    def __init__(self, max_age=600):
+        self.max_age = max_age
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, key, line):
+        """Return the ``JobInfo`` of a job whose squeue line is unchanged, or None"""
+        record = self._records.get(key)
+        if record is None or record[0] != line:
+            return None
+        return record[1]
+
+    def update(self, records):
+        """
+        Record the jobs of the latest output and forget the stale ones
+
+        :param records: dictionary of ``(host, username, job ID)`` to ``(line, JobInfo)``
+        """
+        now = time.monotonic()
+        with self._lock:
+            for key, (line, job_info) in records.items():
+                self._records[key] = (line, job_info, now)
+            stale = [key for key, record in self._records.items() if now - record[2] > self.max_age]
+            for key in stale:
+                del self._records[key]
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+
+JOB_RECORDS = JobRecords()
+
+
+class EfficiencyRecords:
+    """
+    Efficiency of the finished jobs harvested from sacct, by job ID
+
+    At most ``max_entries`` jobs are kept, the least recently harvested or looked up being dropped first, so that a
+    long-running daemon does not grow without bound.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, job_id):
+        """Return the ``JobEfficiency`` of a job, or None"""
+        with self._lock:
+            job = self._records.get(job_id)
+            if job is not None:
+                self._records.move_to_end(job_id)
+            return job
+
+    def update(self, jobs):
+        """Record jobs, given as a dictionary of job ID to ``JobEfficiency``, dropping the oldest beyond the limit"""
+        with self._lock:
+            for job_id, job in jobs.items():
+                self._records[job_id] = job
+                self._records.move_to_end(job_id)
+            while len(self._records) > self.max_entries:
+                self._records.popitem(last=False)
+
+    def values(self):
+        with self._lock:
+            return list(self._records.values())
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+    def __len__(self):
+        return len(self._records)
+
+
+EFFICIENCY_RECORDS = EfficiencyRecords()
+
+#: Time of the last harvest of the efficiency of each login
+_EFFICIENCY_HARVESTED = {}
+
+#: Exit status of the calculations whose job was cancelled before it started, as its dependency can never be satisfied
+DEPENDENCY_NEVER_SATISFIED_EXIT_STATUS = 170
+
+#: Slurm states of jobs that have not finished
+_UNFINISHED_STATES = ('PENDING', 'RUNNING', 'REQUEUED', 'RESIZING', 'SUSPENDED')
+
+#: Comment of the submission scripts listing the QOS picked automatically and those to fall back on when it is full,
+#: each with the number of jobs a user may queue in it, e.g. ``# archer2-qos-candidates: short:16 standard:64``
+_QOS_CANDIDATES = '# archer2-qos-candidates:'
+
+#: Comment of the submission scripts of jobs with wallclock tuning, with what to record in the runtime history once
+#: the job is submitted, e.g. ``# archer2-runtime: <key> 86400 3375 1`` (``-`` for a limit not given)
+_RUNTIME_RECORD = '# archer2-runtime:'
+
+#: Options of srun placing the processes - the topology placement is skipped for jobs whose codes pass one of them,
+#: since srun rejects ``--hint`` together with an explicit CPU binding
+_PLACEMENT_OPTIONS = ('--hint', '--cpu-bind', '--cpu_bind', '--distribution', '-m')
+
+
 class Archer2SlurmScheduler(SlurmScheduler):
     """
     Special scheduler for ARCHER2
@@ -122,13 +323,611 @@ class Archer2SlurmScheduler(SlurmScheduler):
     _job_resource_class = Archer2SlurmJobResource
     DEFAULT_ARCHER2_QOS="standard"
     DEFAULT_ARCHER2_PARTITION="standard"
+    # QOS limits, from the fastest to start to the slowest - with AUTO_QOS, jobs without a QOS get the first one
+    # they fit in, otherwise DEFAULT_ARCHER2_QOS. Can be enabled with the ARCHER2_AUTO_QOS environmental variable.
+    QOS_RULES = ARCHER2_QOS_RULES
+    AUTO_QOS = False
+    # Wallclock tuning: enabled with WALLCLOCK_AUTOTUNE or the ARCHER2_WALLCLOCK_AUTOTUNE environmental variable, jobs
+    # with at least WALLCLOCK_MIN_SAMPLES runs in the history ask for a quantile of their runtimes plus a margin
+    WALLCLOCK_AUTOTUNE = False
+    WALLCLOCK_QUANTILE = 0.95
+    WALLCLOCK_MARGIN = 0.25
+    WALLCLOCK_MIN_SAMPLES = 5
+    WALLCLOCK_MIN_SECONDS = 600
+    # Seconds between the updates of the runtime history done while polling the jobs
+    RUNTIME_HISTORY_UPDATE_INTERVAL = 3600
+    runtime_history = RuntimeHistory()
+    # Jobs using less than this fraction of the CPU time allocated are flagged in the efficiency report
+    EFFICIENCY_THRESHOLD = 0.5
+    # Launch the codes of calculations running them in parallel with a single srun --multi-prog
+    MPMD_LAUNCH = True
+    MPMD_CONFIG_NAME = '_aiidampmd.conf'
+    # Node model of each partition, used to place the processes - set TOPOLOGY_PLACEMENT to False to disable.
+    # Jobs whose codes place their processes with srun options of their own are left alone.
+    NODE_MODELS = NODE_MODELS
+    TOPOLOGY_PLACEMENT = True
+    # Lifetime of the shared squeue snapshots in seconds, 0 to query the jobs of each computer separately.
+    # Can be set with the ARCHER2_SQUEUE_SNAPSHOT_TTL environmental variable.
+    DEFAULT_SQUEUE_SNAPSHOT_TTL = 0
+
+    def __init__(self):
+        super().__init__()
+        self.squeue_snapshot_ttl = float(
+            os.environ.get('ARCHER2_SQUEUE_SNAPSHOT_TTL', self.DEFAULT_SQUEUE_SNAPSHOT_TTL)
+        )
+        self.wallclock_autotune = os.environ.get(
+            'ARCHER2_WALLCLOCK_AUTOTUNE', '1' if self.WALLCLOCK_AUTOTUNE else '0'
+        ).lower() in ('1', 'true', 'yes')
+        # Time of the last update of the runtime history from the polling of the jobs
+        self._runtime_history_updated = None
+        self.auto_qos = os.environ.get(
+            'ARCHER2_AUTO_QOS', '1' if self.AUTO_QOS else '0'
+        ).lower() in ('1', 'true', 'yes')
 
     def _get_submit_script_header(self, job_tmpl):
         """"""
         # Apply some default settings for ARCHER2 - so one does not need to pass them everytime....
-        if not job_tmpl.qos:
-            job_tmpl.qos = self.DEFAULT_ARCHER2_QOS
         if not job_tmpl.queue_name:
             job_tmpl.queue_name = self.DEFAULT_ARCHER2_PARTITION
 
-        return super()._get_submit_script_header(job_tmpl)
\ No newline at end of file
+        resource = job_tmpl.job_resource
+        runtime = None
+        qos_candidates = None
+        if self.wallclock_autotune and resource:
+            runtime = self._tune_wallclock(job_tmpl)
+
+        # Pick the QOS, or check the limits of the one requested, before anything is sent to the remote
+        if resource:
+            walltime = job_tmpl.max_wallclock_seconds
+            walltime = int(walltime) if walltime is not None else None
+            # Without a wallclock limit the job gets the default of its QOS, it cannot be matched to a QOS
+            if not job_tmpl.qos and self.auto_qos and walltime is not None:
+                weekday = datetime.now().weekday()
+                job_tmpl.qos = select_qos(
+                    resource.num_machines, walltime, job_tmpl.queue_name, self.QOS_RULES, weekday=weekday
+                ).name
+                # The submission falls back on the next QOS if this one is full, see _get_submit_command
+                qos_candidates = fitting_qos(
+                    resource.num_machines, walltime, job_tmpl.queue_name, self.QOS_RULES, weekday=weekday
+                )
+            elif job_tmpl.qos:
+                check_qos(job_tmpl.qos, resource.num_machines, walltime, self.QOS_RULES)
+        if not job_tmpl.qos:
+            job_tmpl.qos = self.DEFAULT_ARCHER2_QOS
+
+        if self.TOPOLOGY_PLACEMENT and resource and resource.num_mpiprocs_per_machine:
+            if self._places_processes(job_tmpl):
+                self.logger.info('not placing the processes, the srun options of the codes already do')
+            else:
+                # Place the processes according to the node layout, the environment of the job takes precedence
+                environment = self.get_node_model(job_tmpl.queue_name).placement(
+                    resource.num_mpiprocs_per_machine, resource.num_cores_per_mpiproc
+                )
+                if 'SLURM_CPU_BIND' in (job_tmpl.job_environment or {}):
+                    # srun refuses a hint together with an explicit CPU binding
+                    environment.pop('SLURM_HINT', None)
+                environment.update(job_tmpl.job_environment or {})
+                job_tmpl.job_environment = environment
+
+        header = super()._get_submit_script_header(job_tmpl)
+        dependency = self.get_dependency(job_tmpl)
+        if dependency:
+            header += '\n#SBATCH --dependency=afterok:{}\n#SBATCH --kill-on-invalid-dep=yes'.format(dependency)
+        if qos_candidates:
+            header += '\n{} {}'.format(
+                _QOS_CANDIDATES, ' '.join('{}:{}'.format(rule.name, rule.max_jobs_queued) for rule in qos_candidates)
+            )
+
+        if runtime is not None:
+            # Recorded under the job ID once the job is submitted, see _parse_submit_output
+            header += '\n{} {}'.format(
+                _RUNTIME_RECORD, ' '.join('-' if value is None else str(value) for value in runtime)
+            )
+        return header
+
+    @staticmethod
+    def get_dependency(job_tmpl):
+        """
+        Return the job IDs a job must wait for, separated by colons
+
+        They are given by the ``dependency`` field of the job template, a job ID or a list of them, or by the
+        ``ARCHER2_AFTEROK`` variable of the job environment - which can be set from the options of a calculation.
+        The engine never sets the ``dependency`` field, so the variable is the only way to pass it for a calculation.
+        """
+        dependency = job_tmpl.get('dependency') or (job_tmpl.job_environment or {}).get('ARCHER2_AFTEROK')
+        if not dependency:
+            return None
+        if isinstance(dependency, (list, tuple)):
+            dependency = ':'.join(str(job_id) for job_id in dependency)
+        dependency = str(dependency).replace(',', ':')
+        if not re.match(r'^\d+(_\d+)?(:\d+(_\d+)?)*$', dependency):
+            raise ValueError('Invalid job dependency: {}'.format(dependency))
+        return dependency
+
+    def _tune_wallclock(self, job_tmpl):
+        """
+        Lower the wallclock limit of a job according to the runtimes of the previous jobs with the same key
+
+        The environment of the job may hold an ``ARCHER2_RUNTIME_FINGERPRINT`` distinguishing its inputs, and
+        ``ARCHER2_WALLCLOCK_AUTOTUNE=0`` to keep the wallclock limit requested.
+
+        :return: the ``(key, requested, tuned, nodes)`` to record in the history
+        """
+        environment = job_tmpl.job_environment or {}
+        key = runtime_key(job_tmpl, environment.get('ARCHER2_RUNTIME_FINGERPRINT', ''))
+        requested = job_tmpl.max_wallclock_seconds
+        requested = int(requested) if requested is not None else None
+        tuned = None
+        if str(environment.get('ARCHER2_WALLCLOCK_AUTOTUNE', '1')).lower() not in ('0', 'false', 'no'):
+            tuned = self.get_tuned_wallclock(key)
+            if tuned is not None and (requested is None or tuned < requested):
+                job_tmpl.max_wallclock_seconds = tuned
+            else:
+                tuned = None
+        return key, requested, tuned, job_tmpl.job_resource.num_machines
+
+    def get_tuned_wallclock(self, key):
+        """Return the wallclock limit for jobs with the given key, or None if there are too few runs"""
+        elapsed = self.runtime_history.elapsed(key)
+        if len(elapsed) < self.WALLCLOCK_MIN_SAMPLES:
+            return None
+        tuned = int(quantile(elapsed, self.WALLCLOCK_QUANTILE) * (1 + self.WALLCLOCK_MARGIN))
+        return max(tuned, self.WALLCLOCK_MIN_SECONDS)
+
+    @instrumented('scheduler.sacct')
+    def _get_sacct_records(self, fields, options=''):
+        """
+        Run sacct and return its records
+
+        :param fields: list of the sacct fields to report
+        :param options: further options selecting the jobs
+        :return: list of dictionaries, one per line, with the fields as keys
+        """
+        command = 'sacct --noheader --parsable2 {} --format={}'.format(options, ','.join(fields))
+        with self.transport:
+            retval, stdout, stderr = self.transport.exec_command_wait(command)
+        if retval != 0:
+            raise SchedulerError('sacct returned exit code {}: {}'.format(retval, stderr.strip()))
+        return [dict(zip(fields, line.split('|'))) for line in stdout.splitlines() if line.strip()]
+
+    def _history_job_id(self, job_id):
+        """The ID of a job in the runtime history, which may hold jobs of several clusters and users"""
+        host, username = self._login_key()
+        return '{}@{}:{}'.format(username, host, job_id)
+
+    def _record_runtime(self, job_id, stdout):
+        """Record in the runtime history the job whose runtime record is echoed by the submit command"""
+        for line in stdout.splitlines():
+            if line.startswith(_RUNTIME_RECORD + ' '):
+                key, requested, tuned, nodes = line[len(_RUNTIME_RECORD):].split()
+                requested, tuned = (None if value == '-' else int(value) for value in (requested, tuned))
+                self.runtime_history.record_submission(
+                    self._history_job_id(job_id), key, requested, tuned, int(nodes)
+                )
+
+    def _parse_submit_output(self, retval, stdout, stderr):
+        """Parse the output of the submit command, recording the runtime key of the job once it is submitted"""
+        result = super()._parse_submit_output(retval, stdout, stderr)
+        if isinstance(result, str):
+            self._record_runtime(result, stdout)
+        return result
+
+    def _update_runtime_history_if_due(self):
+        """Update the runtime history if its last update for this login is older than the update interval"""
+        now = time.time()
+        if self._runtime_history_updated is None:
+            # Schedulers are created anew by the engine, the time of the last update is kept in the history
+            last = self.runtime_history.get_meta(self._runtime_history_marker())
+            self._runtime_history_updated = float(last) if last else None
+        last = self._runtime_history_updated
+        if last is not None and now - last < self.RUNTIME_HISTORY_UPDATE_INTERVAL:
+            return
+        self._runtime_history_updated = now
+        try:
+            self.update_runtime_history()
+        except SchedulerError as exc:
+            self.logger.warning('could not update the runtime history: {}'.format(exc))
+
+    def _runtime_history_marker(self):
+        """Name of the time of the last update for this login in the runtime history"""
+        return 'runtime_history_updated:{}:{}'.format(*self._login_key())
+
+    def update_runtime_history(self, since=None):
+        """
+        Record the elapsed time of the jobs completed since the last update, in a single sacct query
+
+        Called from :meth:`get_jobs` every ``RUNTIME_HISTORY_UPDATE_INTERVAL`` seconds when wallclock tuning is enabled.
+
+        :param since: ``datetime`` from which to look for completed jobs, defaults to the last update (minus an hour,
+            to be safe with clock differences) or to a week ago
+        :return: the number of runs recorded
+        """
+        marker = self._runtime_history_marker()
+        if since is None:
+            last = self.runtime_history.get_meta(marker)
+            if last:
+                since = datetime.fromtimestamp(float(last)) - timedelta(hours=1)
+            else:
+                since = datetime.now() - timedelta(days=7)
+        now = time.time()
+        records = self._get_sacct_records(
+            ['JobID', 'Elapsed'],
+            '--allocations --state=CD --starttime={}'.format(since.strftime('%Y-%m-%dT%H:%M:%S')),
+        )
+        runs = [(self._history_job_id(record['JobID']), self._convert_time(record['Elapsed'])) for record in records]
+        recorded = self.runtime_history.add_runs(runs)
+        self.runtime_history.set_meta(marker, str(now))
+        return recorded
+
+    def harvest_efficiency(self, since=None):
+        """
+        Collect the CPU time, elapsed time, memory and energy of the jobs finished since the last call, in a single
+        sacct query
+
+        The records are kept for :meth:`get_detailed_job_info` and :meth:`efficiency_report`.
+
+        :param since: ``datetime`` from which to look for jobs, defaults to the previous harvest or to a day ago
+        :return: dictionary of job ID to :class:`~aiida_archer2_scheduler.archer2.efficiency.JobEfficiency`
+        """
+        login = self._login_key()
+        if since is None:
+            since = _EFFICIENCY_HARVESTED.get(login, datetime.now() - timedelta(days=1))
+        harvested = datetime.now()
+        records = self._get_sacct_records(
+            SACCT_EFFICIENCY_FIELDS, '--starttime={}'.format(since.strftime('%Y-%m-%dT%H:%M:%S'))
+        )
+        jobs = {
+            job_id: job for job_id, job in aggregate_sacct(records).items()
+            if job.state is not None and job.state not in _UNFINISHED_STATES
+        }
+        EFFICIENCY_RECORDS.update(jobs)
+        _EFFICIENCY_HARVESTED[login] = harvested
+        return jobs
+
+    def get_detailed_job_info(self, job_id):
+        """Return the detailed job info, with the efficiency of the job under the ``efficiency`` key
+
+        The efficiency is taken from the records of :meth:`harvest_efficiency`, or parsed from the sacct output.
+
+        :param job_id: the job identifier
+        :return: dictionary with ``retval``, ``stdout``, ``stderr`` and, if known, ``efficiency``
+        """
+        detailed_job_info = super().get_detailed_job_info(job_id)
+        job = EFFICIENCY_RECORDS.get(str(job_id))
+        if job is None and detailed_job_info['retval'] == 0:
+            lines = detailed_job_info['stdout'].splitlines()
+            try:
+                fields = lines[0].split('|')
+                records = (dict(zip(fields, line.split('|'))) for line in lines[1:] if line)
+                job = aggregate_sacct(records).get(str(job_id))
+            except (IndexError, KeyError, ValueError) as exc:
+                self.logger.warning('could not parse the efficiency of job {}: {}'.format(job_id, exc))
+        if job is not None:
+            detailed_job_info['efficiency'] = job.as_dict()
+        return detailed_job_info
+
+    def parse_output(self, detailed_job_info=None, stdout=None, stderr=None):
+        """
+        Parse the output of the scheduler, failing the jobs cancelled because their dependency can never be satisfied
+
+        Such a job never ran, so it gets the ``DEPENDENCY_NEVER_SATISFIED_EXIT_STATUS`` exit code: its parser can tell
+        it from a job that ran, instead of parsing outputs that were never written.
+
+        :return: None or an instance of :class:`aiida.engine.processes.exit_code.ExitCode`
+        """
+        from aiida.engine import ExitCode
+
+        lines = (detailed_job_info or {}).get('stdout', '').splitlines()
+        if len(lines) >= 2:
+            data = dict(zip(lines[0].split('|'), lines[1].split('|')))
+            if data.get('State', '').startswith('CANCELLED') and data.get('Reason') == 'DependencyNeverSatisfied':
+                return ExitCode(
+                    DEPENDENCY_NEVER_SATISFIED_EXIT_STATUS,
+                    'The job was cancelled before it started, as the job it depends on did not complete successfully.',
+                    invalidates_cache=True,
+                )
+        return super().parse_output(detailed_job_info, stdout, stderr)
+
+    def efficiency_report(self, jobs=None, threshold=None):
+        """
+        Summarise the efficiency of finished jobs
+
+        :param jobs: iterable of ``JobEfficiency``, defaults to all the jobs harvested
+        :param threshold: CPU efficiency below which jobs are flagged, defaults to ``EFFICIENCY_THRESHOLD``
+        :return: dictionary with the number of jobs, the node-hours used, the CPU efficiency weighted by node-hours,
+            and the records of the flagged jobs, least efficient first
+        """
+        threshold = self.EFFICIENCY_THRESHOLD if threshold is None else threshold
+        jobs = EFFICIENCY_RECORDS.values() if jobs is None else jobs
+        jobs = [job for job in jobs if job.cpu_efficiency is not None]
+        node_hours = sum(job.node_hours for job in jobs)
+        cpu_efficiency = None
+        if node_hours:
+            cpu_efficiency = sum(job.cpu_efficiency * job.node_hours for job in jobs) / node_hours
+        flagged = sorted((job for job in jobs if job.cpu_efficiency < threshold), key=lambda job: job.cpu_efficiency)
+        return {
+            'jobs': len(jobs),
+            'node_hours': node_hours,
+            'cpu_efficiency': cpu_efficiency,
+            'flagged': [job.as_dict() for job in flagged],
+        }
+
+    def wallclock_savings_report(self):
+        """
+        Return the wallclock saved by tuning
+
+        :return: dictionary with the number of jobs submitted and tuned, and the node-hours requested without and with
+            tuning
+        """
+        return self.runtime_history.savings()
+
+    def get_submit_script(self, job_tmpl):
+        """Return the submit script as a string, codes run in parallel with srun are launched as one MPMD step"""
+        if self.MPMD_LAUNCH:
+            mpmd_tmpl = self._get_mpmd_template(job_tmpl)
+            if mpmd_tmpl is not None:
+                return super().get_submit_script(mpmd_tmpl)
+        return super().get_submit_script(job_tmpl)
+
+    @staticmethod
+    def _places_processes(job_tmpl):
+        """Whether the srun command of a code places the processes itself, e.g. with ``--hint`` or ``--cpu-bind``"""
+        for code_info in job_tmpl.codes_info or []:
+            for param in code_info.prepend_cmdline_params or []:
+                param = str(param)
+                if param.split('=', 1)[0] in _PLACEMENT_OPTIONS or param.startswith('-m') and param[2:3].isalpha():
+                    return True
+        return False
+
+    @staticmethod
+    def _split_ntasks(prepend_cmdline_params):
+        """Split the srun options of a code into the number of tasks, None if not given, and the other options"""
+        ntasks, options = None, []
+        params = iter(prepend_cmdline_params[1:])
+        for param in params:
+            if param in ('-n', '--ntasks'):
+                ntasks = int(next(params))
+            elif param.startswith('--ntasks='):
+                ntasks = int(param.split('=', 1)[1])
+            elif param.startswith('-n') and param[2:].isdigit():
+                ntasks = int(param[2:])
+            else:
+                options.append(param)
+        return ntasks, options
+
+    def _get_mpmd_template(self, job_tmpl):
+        """
+        Return a copy of a job template running its codes as a single ``srun --multi-prog`` step, or None if the codes
+        are not run in parallel, not all with srun, or with different srun options other than the number of tasks
+
+        Each code gets a contiguous range of ranks, as many as the ``-n``/``--ntasks`` of its ``srun`` command, or
+        an even share of the ranks of the job if none is given. Each rank runs a wrapper script with the command
+        line and redirections of its code.
+
+        :raises ValueError: if the codes need more ranks than the job has
+        """
+        codes_info = job_tmpl.codes_info or []
+        if job_tmpl.codes_run_mode != CodeRunMode.PARALLEL or len(codes_info) < 2 or not job_tmpl.job_resource:
+            return None
+        for code_info in codes_info:
+            prepend = code_info.prepend_cmdline_params or []
+            if not prepend or os.path.basename(prepend[0]) != 'srun' or code_info.wrap_cmdline_params:
+                return None
+        try:
+            shapes = [self._split_ntasks(code_info.prepend_cmdline_params) for code_info in codes_info]
+        except (StopIteration, ValueError):
+            return None
+        # A single step has a single set of options, the placement of the codes must not change
+        if any(options != shapes[0][1] for _, options in shapes[1:]):
+            self.logger.info('not launching the codes as one srun step, their srun options differ')
+            return None
+
+        total = job_tmpl.job_resource.get_tot_num_mpiprocs()
+        ntasks = [shape[0] for shape in shapes]
+        if all(count is None for count in ntasks):
+            share, extra = divmod(total, len(codes_info))
+            ntasks = [share + (1 if index < extra else 0) for index in range(len(codes_info))]
+        elif None in ntasks:
+            return None
+        if sum(ntasks) > total or not all(ntasks):
+            raise ValueError('The codes need {} ranks, the job has {}'.format(sum(ntasks), total))
+
+        marker = 'AIIDA_MPMD_EOF'
+        lines, config, first = [], [], 0
+        for index, (code_info, count) in enumerate(zip(codes_info, ntasks)):
+            wrapper = '_aiidampmd_{}.sh'.format(index)
+            command, outputs = self._get_mpmd_command(code_info)
+            # The ranks of a code append to the same files, create them empty first
+            lines.extend(': > {}'.format(output) for output in outputs)
+            lines.extend(['cat > {} << \'{}\''.format(wrapper, marker), 'exec ' + command, marker])
+            config.append('{}-{} bash {}'.format(first, first + count - 1, wrapper))
+            first += count
+        lines.extend(['cat > {} << \'{}\''.format(self.MPMD_CONFIG_NAME, marker)] + config + [marker])
+
+        mpmd_code = JobTemplateCodeInfo()
+        mpmd_code.prepend_cmdline_params = [codes_info[0].prepend_cmdline_params[0]] + shapes[0][1] + [
+            '--ntasks={}'.format(first), '--multi-prog'
+        ]
+        mpmd_code.cmdline_params = [self.MPMD_CONFIG_NAME]
+        mpmd_code.use_double_quotes = codes_info[0].use_double_quotes
+
+        mpmd_tmpl = copy.copy(job_tmpl)
+        mpmd_tmpl.codes_info = [mpmd_code]
+        mpmd_tmpl.codes_run_mode = CodeRunMode.SERIAL
+        mpmd_tmpl.prepend_text = '\n'.join(([job_tmpl.prepend_text] if job_tmpl.prepend_text else []) + lines)
+        return mpmd_tmpl
+
+    @staticmethod
+    def _get_mpmd_command(code_info):
+        """Return the command line of a code with its redirections, appending to the output files, and these files"""
+        computer_quotes, code_quotes = code_info.use_double_quotes
+        parts = [escape_for_bash(param, use_double_quotes=code_quotes) for param in code_info.cmdline_params]
+        outputs = []
+        if code_info.stdin_name:
+            parts.append('< ' + escape_for_bash(code_info.stdin_name, use_double_quotes=computer_quotes))
+        if code_info.stdout_name:
+            outputs.append(escape_for_bash(code_info.stdout_name, use_double_quotes=computer_quotes))
+            parts.append('>> ' + outputs[-1])
+        if code_info.join_files:
+            parts.append('2>&1')
+        elif code_info.stderr_name:
+            outputs.append(escape_for_bash(code_info.stderr_name, use_double_quotes=computer_quotes))
+            parts.append('2>> ' + outputs[-1])
+        return ' '.join(parts), outputs
+
+    def get_node_model(self, partition):
+        """Return the node model of a partition, that of the default partition if unknown"""
+        return self.NODE_MODELS.get(partition, self.NODE_MODELS[self.DEFAULT_ARCHER2_PARTITION])
+
+    @instrumented('scheduler.submit')
+    def submit_job(self, working_directory, filename):
+        """Submit a job.
+
+        With ``squeue_snapshot_ttl`` set and a transport running batched commands, the shared snapshot of the jobs of
+        the user is taken again in the same round trip as the submission, so that the next poll finds the new job
+        without running ``squeue`` again. Otherwise the job is submitted with a plain ``sbatch``.
+
+        :param working_directory: The absolute filepath to the working directory where the job is to be executed.
+        :param filename: The filename of the submission script relative to the working directory.
+        :return: the job ID, or an exit code if the submission failed because the submission script is invalid
+        """
+        if not self.squeue_snapshot_ttl or not hasattr(self.transport, 'exec_command_batch'):
+            return super().submit_job(working_directory, filename)
+
+        key = self._login_key()
+        commands = [
+            (self._get_submit_command(escape_for_bash(filename)), working_directory),
+            self._get_joblist_command(user=key[1] or '$USER'),
+        ]
+        submitted, listed = self.transport.exec_command_batch(commands, stop_on_error=True)
+        result = self._parse_submit_output(*submitted)
+        if isinstance(result, str) and listed[0] is not None:
+            self._store_squeue_snapshot(key, *listed)
+        return result
+
+    def _get_submit_command(self, submit_script):
+        """
+        Return the command submitting a script
+
+        With ``auto_qos``, scripts whose QOS was picked automatically list the QOS the job fits in, each with the number
+        of jobs a user may queue in it. The jobs queued in each of them are counted in the same command, with one
+        ``squeue`` per QOS until one has room, so that no round trip is added, and the job goes to the first of them
+        that is not full. With wallclock tuning, the runtime record of the script, if any, is echoed once the job is
+        submitted, see :meth:`_parse_submit_output`.
+
+        :param submit_script: the path of the script relative to the working directory, already escaped
+        """
+        command = 'sbatch {}'.format(submit_script)
+        if self.auto_qos:
+            command = (
+                'qos=; for limit in $(sed -n \'s/^{candidates} //p\' {script}); do '
+                '[ "$(squeue --noheader --array --user="$USER" --qos="${{limit%:*}}" -o %i 2>/dev/null | wc -l)" '
+                '-lt "${{limit#*:}}" ] && qos=${{limit%:*}} && break; done; sbatch ${{qos:+--qos=$qos}} {script}'
+            ).format(candidates=_QOS_CANDIDATES, script=submit_script)
+        if self.wallclock_autotune:
+            command += ' && sed -n \'/^{runtime} /p\' {script}'.format(runtime=_RUNTIME_RECORD, script=submit_script)
+        self.logger.info('submitting with: {}'.format(command))
+        return command
+
+    def _get_joblist_command(self, jobs=None, user=None):
+        """The command to report full information on existing jobs, with one line per task of job arrays"""
+        command = super()._get_joblist_command(jobs=jobs, user=user)
+        return command.replace('squeue --noheader', 'squeue --array --noheader', 1)
+
+    def _parse_joblist_output(self, retval, stdout, stderr):
+        """
+        Parse the squeue output, building ``JobInfo`` objects only for the jobs whose state changed
+
+        The output is scanned line by line, and the jobs whose line is the same as in a previous output reuse the
+        ``JobInfo`` built back then - the changed ones are parsed in one go by the parent class. The state of jobs
+        whose dependency can never be satisfied is undetermined: Slurm cancels them, as they are submitted with
+        ``--kill-on-invalid-dep``, and :meth:`parse_output` then reports them as failed.
+        """
+        if retval != 0 or stderr.strip():
+            # Let the parent class raise or warn about the error
+            super()._parse_joblist_output(retval, stdout if retval != 0 else '', stderr)
+
+        login = self._login_key()
+        jobs = []
+        changed = {}
+        for job_id, line in iter_joblist_lines(stdout):
+            job_info = JOB_RECORDS.lookup(login + (job_id,), line)
+            if job_info is None:
+                changed[job_id] = line
+            jobs.append((job_id, line, job_info))
+
+        if changed:
+            parsed = super()._parse_joblist_output(0, '\n'.join(changed.values()), '')
+            parsed = {job_info.job_id: job_info for job_info in parsed}
+            for job_info in parsed.values():
+                if job_info.annotation == 'DependencyNeverSatisfied':
+                    # The job will never run, but it is not done either until Slurm cancels it
+                    job_info.job_state = JobState.UNDETERMINED
+            jobs = [(job_id, line, job_info or parsed.get(job_id)) for job_id, line, job_info in jobs]
+        JOB_RECORDS.update({login + (job_id,): (line, job_info) for job_id, line, job_info in jobs if job_info})
+        return [job_info for _, _, job_info in jobs if job_info is not None]
+
+    def _login_key(self):
+        """The (host, username) of the transport, jobs with the same key are in the same snapshot"""
+        transport = self._transport
+        username = getattr(transport, '_connect_args', {}).get('username')
+        return getattr(transport, 'hostname', None), username
+
+    @instrumented('scheduler.squeue_snapshot')
+    def _fetch_squeue_snapshot(self, key):
+        """Run a single squeue for all jobs of the user and store the parsed snapshot"""
+        command = self._get_joblist_command(user=key[1] or '$USER')
+        with self.transport:
+            retval, stdout, stderr = self.transport.exec_command_wait(command)
+        return self._store_squeue_snapshot(key, retval, stdout, stderr)
+
+    def _store_squeue_snapshot(self, key, retval, stdout, stderr):
+        """Parse the squeue output listing all jobs of the user and store it as the snapshot of the login"""
+        jobs = {job.job_id: job for job in self._parse_joblist_output(retval, stdout, stderr)}
+        SQUEUE_SNAPSHOTS.put(key, jobs)
+        return jobs
+
+    @instrumented('scheduler.get_jobs')
+    def get_jobs(self, jobs=None, user=None, as_dict=False):
+        """Return the list of currently active jobs.
+
+        If ``squeue_snapshot_ttl`` is set, the jobs are answered from a snapshot of all the jobs of the user, shared
+        by all computers with the same login. A new snapshot is taken once it expires, or if one of the requested jobs
+        is missing from it - e.g. because it was submitted after the snapshot was taken.
+
+        With wallclock tuning, the runtime history is updated from time to time as well.
+
+        :param jobs: A list of jobs to check; only these are checked.
+        :param user: A string with a user: only jobs of this user are checked.
+        :param as_dict: If ``False`` (default), a list of ``JobInfo`` objects is returned. If ``True``, a dictionary is
+            returned, where the ``job_id`` is the key and the values are the ``JobInfo`` objects.
+        :returns: List of active jobs.
+        """
+        if isinstance(jobs, str):
+            jobs = [jobs]
+
+        found = self._get_jobs_dict(jobs, user)
+        if self.wallclock_autotune:
+            self._update_runtime_history_if_due()
+        return found if as_dict else list(found.values())
+
+    def _get_jobs_dict(self, jobs, user):
+        """Return the dictionary of active jobs, from the shared snapshot if enabled"""
+        if not self.squeue_snapshot_ttl or user is not None:
+            return super().get_jobs(jobs=jobs, user=user, as_dict=True)
+
+        key = self._login_key()
+        snapshot = SQUEUE_SNAPSHOTS.get(key, self.squeue_snapshot_ttl)
+        if snapshot is None or any(str(job_id) not in snapshot for job_id in jobs or []):
+            snapshot = self._fetch_squeue_snapshot(key)
+
+        if jobs is None:
+            return dict(snapshot)
+        return {str(job_id): snapshot[str(job_id)] for job_id in jobs if str(job_id) in snapshot}
+
+    @instrumented('scheduler.kill')
+    def kill_job(self, jobid):
+        """Kill a remote job, the shared snapshot no longer reflects its state"""
+        result = super().kill_job(jobid)
+        SQUEUE_SNAPSHOTS.invalidate(self._login_key())
+        return result
@@ -9,285 +9,92 @@
 ###########################################################################
 """Plugin for transport over SSH (and SFTP for file transfer). Modified to make it work with ARCHER2"""
 # pylint: disable=too-many-lines
-from binascii import hexlify
+import errno
+import functools
+from glob import has_magic
+import inspect
 import os
+import posixpath
+import re
+import shutil
+import stat
+import tarfile
+import threading
+import time
+import uuid
 
-from paramiko.agent import Agent
-from paramiko.common import DEBUG
-from paramiko.dsskey import DSSKey
-from paramiko.ecdsakey import ECDSAKey
-from paramiko.ed25519key import Ed25519Key
-from paramiko.rsakey import RSAKey
-from paramiko.ssh_exception import (
-    SSHException,
-)
-from paramiko import SSHClient
+import click
 
+from aiida.common.escaping import escape_for_bash
 from aiida.transports.plugins.ssh import SshTransport as StockSshTransport
+from aiida.transports.transport import TransportInternalError
 
-__all__ = ('SshTransport', 'SSHTransport4C')
-
+from .command_batch import build_batch_script, parse_batch_output
+from .connection_pool import CONNECTION_POOL
+from .instrumentation import export_metrics, instrumented
+from .keepalive import LIVENESS_MONITOR
+from .lazy import LazyAttribute, lazy_module_attributes
+from .login_hosts import LOGIN_HOST_HEALTH, parse_login_hosts
+from .metadata_cache import RemoteMetadataCache
+from .parallel_transfer import GET, PUT, ParallelTransfer, TransferReport
+from .resumable_download import ResumableDownload
+from .upload_cache import UploadCacheIndex, file_digest, store_path
 
-class Archer2SSHClient(SSHClient):
-    """
-    Specialised SSHClient for ARCHER2
-    """
-    def _auth(
-        self,
-        username,
-        password,
-        pkey,
-        key_filenames,
-        allow_agent,
-        look_for_keys,
-        gss_auth,
-        gss_kex,
-        gss_deleg_creds,
-        gss_host,
-        passphrase,
-    ):
-        """
-        Try, in order:
-
-            - Plain username/password auth, if a password was given.
-            - A series of trials using public keys 
-
-        """
-        saved_exception = None
-        allowed_types = set()
-        if passphrase is None and password is not None:
-            passphrase = password
-
-
-        if pkey is not None:
-            try:
-                self._log(
-                    DEBUG,
-                    "Trying SSH key {}".format(
-                        hexlify(pkey.get_fingerprint())
-                    ),
-                )
-                allowed_types = self._transport.auth_publickey(username, pkey)
-                if not allowed_types:
-                    return
-            except SSHException as e:
-                saved_exception = e
+__all__ = ('SshTransport', 'SSHTransport4C')
 
+# The SSH clients import paramiko, they are only loaded when first used
+__getattr__ = lazy_module_attributes(
+    __name__, {
+        'Archer2SSHClient': '.ssh_client',
+        'ARCHER24CSSHClient': '.ssh_client',
+        'KEY_CLASSES': '.ssh_client',
+        'DEFAULT_KEY_FILES': '.ssh_client',
+    }
+)
 
-        # Using supplied file path
-        for key_filename in key_filenames:
-            for pkey_class in (RSAKey, DSSKey, ECDSAKey, Ed25519Key):
-                try:
-                    key = self._key_from_filepath(
-                        key_filename, pkey_class, passphrase
-                    )
-                    allowed_types = self._transport.auth_publickey(username, key)
-                    if not allowed_types:
-                        return
-                    break
-                except SSHException as e:
-                    saved_exception = e
-
-        # Try default ssh key in ~/.ssh 
-        keyfiles = []
-        for keytype, name in [
-            (DSSKey, "dsa"),
-            (ECDSAKey, "ecdsa"),
-            (Ed25519Key, "ed25519"),
-        ]:
-            # ~/ssh/ is for windows
-            for directory in [".ssh", "ssh"]:
-                full_path = os.path.expanduser(
-                    "~/{}/id_{}".format(directory, name)
-                )
-                if os.path.isfile(full_path):
-                    # TODO: only do this append if below did not run
-                    keyfiles.append((keytype, full_path))
-                    if os.path.isfile(full_path + "-cert.pub"):
-                        keyfiles.append((keytype, full_path + "-cert.pub"))
+# Modes for transferring folders, see SshTransport.puttree
+TREE_TRANSFER_MODES = ('sftp', 'tar', 'tar.gz')
 
-            if not look_for_keys:
-                keyfiles = []
+# Exit status of the placement command when the file is not in the upload cache
+_UPLOAD_CACHE_MISSING = 66
 
-            for pkey_class, filename in keyfiles:
-                try:
-                    key = self._key_from_filepath(
-                        filename, pkey_class, passphrase
-                    )
-                    # for 2-factor auth a successfully auth'd key will result
-                    # in ['password']
-                    allowed_types = self._transport.auth_publickey(username, key)
-                    if not allowed_types:
-                        return
-                    break
-                except (SSHException, IOError) as e:
-                    saved_exception = e
-
-        # Try using agents
-        if self._agent is None:
-            self._agent = Agent()
-
-        for key in self._agent.get_keys():
-            try:
-                id_ = hexlify(key.get_fingerprint())
-                self._log(DEBUG, "Trying SSH agent key {}".format(id_))
-                # for 2-factor auth a successfully auth'd key password
-                # will return an allowed 2fac auth method
-                allowed_types = self._transport.auth_publickey(username, key)
-                if not allowed_types:
-                    return
-                break
-            except SSHException as e:
-                saved_exception = e
-
-        # Password authentication goes last
-        try:
-            allowed_types = set( self._transport.auth_password(username, password))
-        except SSHException as e:
-            saved_exception = e
 
-        # If allowed_types is empty the authentication worked
-        if not allowed_types:
-            return 
+def _sent_size(result, transport, localpath, *args, **kwargs):
+    return os.path.getsize(localpath)
 
-         # if we got an auth-failed exception earlier, re-raise it
-        if saved_exception is not None:
-            raise saved_exception
 
-       
-        raise SSHException("No authentication methods available")
+def _received_size(result, transport, remotepath, localpath, *args, **kwargs):
+    return os.path.getsize(localpath)
 
-class ARCHER24CSSHClient(SSHClient):
-    """
-    Client for the 4-cabinet service
 
-    ARCHER2 (4-cabint pilot system) uses a unusual authentication order such as the password is attempted
-    first, followed by the public key. Hence we have to override the _auth method for it to work.
-    """
-    
-    def _auth(
-        self,
-        username,
-        password,
-        pkey,
-        key_filenames,
-        allow_agent,
-        look_for_keys,
-        gss_auth,
-        gss_kex,
-        gss_deleg_creds,
-        gss_host,
-        passphrase,
-    ):
-        """
-        Try, in order:
-
-            - Plain username/password auth, if a password was given.
-            - A series of trials using public keys 
-
-        """
-        saved_exception = None
-        allowed_types = set()
-        if passphrase is None and password is not None:
-            passphrase = password
-
-        # Password authentication goes first
-        try:
-            allowed_types = set( self._transport.auth_password(username, password))
-        except SSHException as e:
-            saved_exception = e
+def _output_size(result, *args, **kwargs):
+    return len(result[1]) + len(result[2])
 
-        if pkey is not None:
-            try:
-                self._log(
-                    DEBUG,
-                    "Trying SSH key {}".format(
-                        hexlify(pkey.get_fingerprint())
-                    ),
-                )
-                allowed_types = self._transport.auth_publickey(username, pkey)
-                if not allowed_types:
-                    return
-            except SSHException as e:
-                saved_exception = e
 
+def _invalidates(*names):
+    """Decorate a transport method changing the remote paths passed as the given arguments
 
-        # Using supplied file path
-        for key_filename in key_filenames:
-            for pkey_class in (RSAKey, DSSKey, ECDSAKey, Ed25519Key):
-                try:
-                    key = self._key_from_filepath(
-                        key_filename, pkey_class, passphrase
-                    )
-                    allowed_types = self._transport.auth_publickey(username, key)
-                    if not allowed_types:
-                        return
-                    break
-                except SSHException as e:
-                    saved_exception = e
-
-        # Try default ssh key in ~/.ssh 
-        keyfiles = []
-        for keytype, name in [
-            (DSSKey, "dsa"),
-            (ECDSAKey, "ecdsa"),
-            (Ed25519Key, "ed25519"),
-        ]:
-            # ~/ssh/ is for windows
-            for directory in [".ssh", "ssh"]:
-                full_path = os.path.expanduser(
-                    "~/{}/id_{}".format(directory, name)
-                )
-                if os.path.isfile(full_path):
-                    # TODO: only do this append if below did not run
-                    keyfiles.append((keytype, full_path))
-                    if os.path.isfile(full_path + "-cert.pub"):
-                        keyfiles.append((keytype, full_path + "-cert.pub"))
+    The entries of the metadata cache for these paths are invalidated once the method returns, or fails.
+    """
 
-            if not look_for_keys:
-                keyfiles = []
+    def decorator(method):
+        signature = inspect.signature(method)
 
-            for pkey_class, filename in keyfiles:
-                try:
-                    key = self._key_from_filepath(
-                        filename, pkey_class, passphrase
-                    )
-                    # for 2-factor auth a successfully auth'd key will result
-                    # in ['password']
-                    allowed_types = self._transport.auth_publickey(username, key)
-                    if not allowed_types:
-                        return
-                    break
-                except (SSHException, IOError) as e:
-                    saved_exception = e
-
-        # Try using agents
-        if self._agent is None:
-            self._agent = Agent()
-
-        for key in self._agent.get_keys():
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self._metadata_cache is None:
+                return method(self, *args, **kwargs)
             try:
-                id_ = hexlify(key.get_fingerprint())
-                self._log(DEBUG, "Trying SSH agent key {}".format(id_))
-                # for 2-factor auth a successfully auth'd key password
-                # will return an allowed 2fac auth method
-                allowed_types = self._transport.auth_publickey(username, key)
-                if not allowed_types:
-                    return
-                break
-            except SSHException as e:
-                saved_exception = e
-
-        # If allowed_types is empty the authentication worked
-        if not allowed_types:
-            return 
+                return method(self, *args, **kwargs)
+            finally:
+                arguments = signature.bind(self, *args, **kwargs).arguments
+                for name in names:
+                    if arguments.get(name):
+                        self._metadata_cache.invalidate(self._cache_key(arguments[name]))
 
-         # if we got an auth-failed exception earlier, re-raise it
-        if saved_exception is not None:
-            raise saved_exception
+        return wrapper
 
-       
-        raise SSHException("No authentication methods available")
+    return decorator
 
 
 class SshTransport(StockSshTransport):  # pylint: disable=too-many-public-methods
@@ -297,7 +104,141 @@ class SshTransport(StockSshTransport):  # pylint: disable=too-many-public-method
     # Valid keywords accepted by the connect method of paramiko.SSHClient
     # I disable 'password' and 'pkey' to avoid these data to get logged in the
     # aiida log file.
-    CLIENT_CLASS = Archer2SSHClient
+    CLIENT_CLASS = LazyAttribute('.ssh_client', 'Archer2SSHClient')
+
+    _valid_auth_options = StockSshTransport._valid_auth_options + [
+        (
+            'use_connection_pool',
+            {
+                'default': False,
+                'switch': True,
+                'prompt': 'Share connections',
+                'help': 'Share one authenticated connection between the transports of a daemon worker, '
+                'instead of logging in for each of them.',
+                'non_interactive_default': True,
+            },
+        ),
+        (
+            'tree_transfer',
+            {
+                'default': 'sftp',
+                'type': click.Choice(TREE_TRANSFER_MODES),
+                'prompt': 'Folder transfer mode',
+                'help': 'How folders are transferred: file by file over SFTP, or as a single (compressed) tar stream. '
+                'Falls back to SFTP if tar is not available on the remote.',
+                'non_interactive_default': True,
+            },
+        ),
+        (
+            'transfer_workers',
+            {
+                'default': 1,
+                'type': int,
+                'prompt': 'Concurrent SFTP transfers',
+                'help': 'Number of files transferred concurrently, each over its own SFTP channel, when transferring '
+                'folders or multiple files over SFTP.',
+                'non_interactive_default': True,
+            },
+        ),
+        (
+            'upload_cache_dir',
+            {
+                'default': '',
+                'type': str,
+                'prompt': 'Upload cache directory',
+                'help': 'Remote directory used as a content-addressed store of uploaded files, so that identical '
+                'inputs are only sent once and linked afterwards. Leave empty to disable.',
+                'non_interactive_default': True,
+            },
+        ),
+        (
+            'upload_cache_max_size',
+            {
+                'default': 10240,
+                'type': int,
+                'prompt': 'Upload cache size (MB)',
+                'help': 'Maximum size of the upload cache, the least recently used files are removed beyond it.',
+                'non_interactive_default': True,
+            },
+        ),
+        (
+            'upload_cache_link',
+            {
+                'default': 'copy',
+                'type': click.Choice(['copy', 'hardlink', 'symlink']),
+                'prompt': 'Upload cache link type',
+                'help': 'How cached files are placed in the calculation folder. Copies are made on the remote. Hard '
+                'and symbolic links share the file of the cache, so only use them for codes that do not modify their '
+                'inputs in place. The cache is not evicted while files are linked symbolically.',
+                'non_interactive_default': True,
+            },
+        ),
+        (
+            'metadata_cache',
+            {
+                'default': False,
+                'switch': True,
+                'prompt': 'Cache remote metadata',
+                'help': 'Remember the results of stat, listdir and normalize while the connection is open, '
+                'invalidating them when the transport changes the remote.',
+                'non_interactive_default': True,
+            },
+        ),
+        (
+            'keepalive_interval',
+            {
+                'default': 0,
+                'type': int,
+                'prompt': 'Keepalive interval (s)',
+                'help': 'Send a keepalive every this many seconds, and reconnect in the background when the '
+                'connection dropped. Set to 0 to disable.',
+                'non_interactive_default': True,
+            },
+        ),
+        (
+            'login_hosts',
+            {
+                'default': '',
+                'type': str,
+                'prompt': 'Login hosts',
+                'help': 'Comma-separated login nodes (host[:port]) to connect to instead of the machine, e.g. '
+                'ln01.archer2.ac.uk,ln02.archer2.ac.uk. Connections go to the fastest host, and hosts that fail are '
+                'avoided for a while. Leave empty to only use the machine.',
+                'non_interactive_default': True,
+            },
+        ),
+        (
+            'resumable_download_size',
+            {
+                'default': 0,
+                'type': int,
+                'prompt': 'Resumable download size (MB)',
+                'help': 'Files at least this large are retrieved in verified chunks, resuming where an interrupted '
+                'transfer stopped. Set to 0 to disable.',
+                'non_interactive_default': True,
+            },
+        ),
+    ]
+
+    #: The pool used when ``use_connection_pool`` is set
+    connection_pool = CONNECTION_POOL
+    #: Health of the login hosts, when ``login_hosts`` is set
+    login_host_health = LOGIN_HOST_HEALTH
+    #: Recent authentication failures, logins are not attempted again for a while after one
+    auth_failures = LazyAttribute('.auth_backoff', 'AUTH_FAILURES')
+    #: Checks the open transports when ``keepalive_interval`` is set
+    liveness_monitor = LIVENESS_MONITOR
+    #: Local index of the content of the remote upload caches
+    upload_cache_index = UploadCacheIndex()
+    #: Files smaller than this are always sent, as a link costs a round trip as well
+    UPLOAD_CACHE_MIN_SIZE = 64 * 1024
+    #: Remote commands placing a file of the upload cache, for each ``upload_cache_link`` mode
+    UPLOAD_CACHE_LINK_COMMANDS = {
+        'copy': 'cp -f {src} {dest}',
+        'hardlink': 'ln -f {src} {dest}',
+        'symlink': 'ln -sf {src} {dest}',
+    }
+
     def __init__(self, *args, **kwargs):
         """
         Initialize the SshTransport class.
@@ -307,37 +248,73 @@ class SshTransport(StockSshTransport):  # pylint: disable=too-many-public-method
            if False, do not load the system host keys
         :param key_policy: (optional, default = paramiko.RejectPolicy())
            the policy to use for unknown keys
+        :param use_connection_pool: (optional, default False)
+           if True, share the connection with other transports to the same machine and user
+        :param tree_transfer: (optional, default 'sftp')
+           transfer folders file by file ('sftp') or as a single tar stream ('tar', or 'tar.gz' to compress it)
+        :param transfer_workers: (optional, default 1)
+           number of files transferred concurrently over SFTP
+        :param upload_cache_dir: (optional, default '')
+           remote directory of the content-addressed upload cache, disabled if empty
+        :param upload_cache_max_size: (optional, default 10240)
+           maximum size of the upload cache in MB
+        :param upload_cache_link: (optional, default 'copy')
+           place cached files with a 'copy' made on the remote, a 'hardlink' or a 'symlink'
+        :param metadata_cache: (optional, default False)
+           if True, cache the remote metadata while the connection is open
+        :param keepalive_interval: (optional, default 0)
+           seconds between keepalives and background checks of the connection, disabled if 0
+        :param login_hosts: (optional, default '')
+           comma-separated ``host[:port]`` of the login nodes to connect to, the machine if empty
+        :param resumable_download_size: (optional, default 0)
+           size in MB from which files are retrieved in resumable, verified chunks, disabled if 0
 
         Other parameters valid for the ssh connect function (see the
         self._valid_connect_params list) are passed to the connect
         function (as port, username, password, ...); taken from the
         accepted paramiko.SSHClient.connect() params.
         """
-        import paramiko
         super().__init__(*args, **kwargs)
 
         self._sftp = None
         self._proxy = None
+        self._proxies = []
+        self._pooled = None
 
         self._machine = kwargs.pop('machine')
 
-        self._client = self.CLIENT_CLASS() 
         self._load_system_host_keys = kwargs.pop('load_system_host_keys', False)
-        if self._load_system_host_keys:
-            self._client.load_system_host_keys()
-
         self._missing_key_policy = kwargs.pop('key_policy', 'RejectPolicy')  # This is paramiko default
-        if self._missing_key_policy == 'RejectPolicy':
-            self._client.set_missing_host_key_policy(paramiko.RejectPolicy())
-        elif self._missing_key_policy == 'WarningPolicy':
-            self._client.set_missing_host_key_policy(paramiko.WarningPolicy())
-        elif self._missing_key_policy == 'AutoAddPolicy':
-            self._client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        else:
+        if self._missing_key_policy not in ('RejectPolicy', 'WarningPolicy', 'AutoAddPolicy'):
             raise ValueError(
                 'Unknown value of the key policy, allowed values '
                 'are: RejectPolicy, WarningPolicy, AutoAddPolicy'
             )
+        self._client = self._new_client()
+        self._use_connection_pool = kwargs.pop('use_connection_pool', False)
+        self._tree_transfer = kwargs.pop('tree_transfer', 'sftp')
+        if self._tree_transfer not in TREE_TRANSFER_MODES:
+            raise ValueError(
+                'Unknown tree transfer mode, allowed values are: {}'.format(', '.join(TREE_TRANSFER_MODES))
+            )
+        self._remote_has_tar = None
+        self._transfer_workers = int(kwargs.pop('transfer_workers', 1))
+        self._upload_cache_dir = kwargs.pop('upload_cache_dir', '') or ''
+        self._upload_cache_max_size = int(kwargs.pop('upload_cache_max_size', 10240)) * 1024 * 1024
+        self._upload_cache_link = kwargs.pop('upload_cache_link', 'copy')
+        self._upload_cache_failed = False
+        self.upload_cache_hits = 0
+        self.upload_cache_misses = 0
+        self._metadata_cache = RemoteMetadataCache() if kwargs.pop('metadata_cache', False) else None
+        self._resumable_download_size = int(kwargs.pop('resumable_download_size', 0)) * 1024 * 1024
+        self._resumable_download = None
+        self._login_hosts = parse_login_hosts(kwargs.pop('login_hosts', '') or '')
+        self._keepalive_interval = int(kwargs.pop('keepalive_interval', 0))
+        self._reconnect_lock = threading.Lock()
+        # Set by the liveness monitor, the connection is replaced at the next operation
+        self._connection_dropped = False
+        #: The host the current connection goes to
+        self.login_host = None
 
         self._connect_args = {}
         for k in self._valid_connect_params:
@@ -351,7 +328,7 @@ class SshTransport(StockSshTransport):  # pylint: disable=too-many-public-method
             username = self._connect_args['username'].upper()
             env_name = 'ARCHER2_PASS_' + username
             password = os.environ.get(env_name)
-            
+
             if not password:
                 # Fallback for generic ones
                 password = os.environ.get('ARCHER2_PASS')
@@ -360,9 +337,982 @@ class SshTransport(StockSshTransport):  # pylint: disable=too-many-public-method
                 raise ValueError(f'Cannot found password for ARCHER2 - please set the {env_name} environmental variable')
             self._connect_args['password'] = password
 
+    def _new_client(self, client_class=None):
+        """Create an unconnected client with the host key settings of this transport"""
+        import paramiko
+
+        client = (client_class or self.CLIENT_CLASS)()
+        if self._load_system_host_keys:
+            client.load_system_host_keys()
+        client.set_missing_host_key_policy(getattr(paramiko, self._missing_key_policy)())
+        return client
+
+    @property
+    def _pool_key(self):
+        """Transports with the same key can share a connection"""
+        return (
+            self._machine, self._connect_args.get('username'), self._connect_args.get('port'),
+            self.CLIENT_CLASS.__name__
+        )
+
+    def _connect(self):
+        """
+        Open a new authenticated connection to the machine, or to the healthiest of the ``login_hosts`` if set
+
+        A login host that cannot be reached, or whose host key is not the known one, is put in quarantine by
+        :attr:`login_host_health` and the next one is tried. Authentication failures are not the fault of the host,
+        and are raised at once. After such a failure, logins with the same password fail at once for a while, see
+        :attr:`auth_failures`.
+
+        :return: a tuple of the connected client and the list of proxies (objects with a ``close`` method) it goes
+            through
+        """
+        if not self._login_hosts:
+            self.login_host = self._machine
+            return self._connect_host(self._machine)
+
+        from paramiko.ssh_exception import AuthenticationException, SSHException
+
+        error = None
+        for host, port in self.login_host_health.order(self._login_hosts):
+            start = time.monotonic()
+            try:
+                connection = self._connect_host(host, port)
+            except AuthenticationException:
+                raise
+            except (OSError, EOFError, SSHException) as exc:
+                quarantine = self.login_host_health.record_failure((host, port))
+                self.logger.warning(f'Login host {host} failed ({exc}), avoiding it for {quarantine:.0f} s')
+                error = exc
+                continue
+            self.login_host_health.record_success((host, port), time.monotonic() - start)
+            self.login_host = host
+            return connection
+        raise error
+
+    def _connect_host(self, host, port=None):
+        """
+        Open a new authenticated connection to a host, going through the proxies if any
+
+        The host key is checked against the known key of that host.
+
+        :param port: the port to connect to, the ``port`` of the transport if None
+        :return: a tuple of the connected client and the list of proxies it goes through
+        """
+        import paramiko
+
+        connection_arguments = self._connect_args.copy()
+        if port is not None:
+            connection_arguments['port'] = port
+        if 'key_filename' in connection_arguments and not connection_arguments['key_filename']:
+            connection_arguments.pop('key_filename')
+
+        proxyjumpstring = connection_arguments.pop('proxy_jump', None)
+        proxycmdstring = connection_arguments.pop('proxy_command', None)
+
+        if proxyjumpstring and proxycmdstring:
+            raise ValueError('The SSH proxy jump and SSH proxy command options can not be used together')
+
+        proxies = []
+
+        def close_proxies():
+            while proxies:
+                proxies.pop().close()
+
+        if proxyjumpstring:
+            matcher = re.compile(r'^(?:(?P<username>[^@]+)@)?(?P<host>[^@:]+)(?::(?P<port>\d+))?\s*$')
+            try:
+                jumps = [matcher.match(s).groupdict() for s in proxyjumpstring.split(',')]
+            except AttributeError:
+                raise ValueError('The given configuration for the SSH proxy jump option could not be parsed')
+
+            # Each jump host is another paramiko connection, opening a forward channel to the next hop
+            for proxy, target in zip(
+                jumps, jumps[1:] + [{
+                    'host': host,
+                    'port': connection_arguments.get('port', 22)
+                }]
+            ):
+                proxy_connargs = connection_arguments.copy()
+                if proxy['username']:
+                    proxy_connargs['username'] = proxy['username']
+                if proxy['port']:
+                    proxy_connargs['port'] = int(proxy['port'])
+                if not target['port']:  # the target port for the channel can not be None
+                    target['port'] = connection_arguments.get('port', 22)
+
+                proxy_client = self._new_client(paramiko.SSHClient)
+                try:
+                    proxy_client.connect(proxy['host'], **proxy_connargs)
+                except Exception as exc:
+                    self.logger.error(
+                        f"Error connecting to proxy '{proxy['host']}' through SSH: [{self.__class__.__name__}] {exc}"
+                    )
+                    close_proxies()
+                    raise
+                connection_arguments['sock'] = proxy_client.get_transport().open_channel(
+                    'direct-tcpip', (target['host'], target['port']), ('', 0)
+                )
+                proxies.append(proxy_client)
+
+        if proxycmdstring:
+            proxy_command = paramiko.ProxyCommand(proxycmdstring)
+            connection_arguments['sock'] = proxy_command
+            proxies.append(proxy_command)
+
+        from paramiko.ssh_exception import AuthenticationException
+        from .auth_backoff import AuthenticationBackoff
+
+        # Failures are counted against the account, whichever login node is used
+        username, password = connection_arguments.get('username'), connection_arguments.get('password')
+        client = self._new_client()
+        try:
+            self.auth_failures.check(self._machine, username, password)
+            client.connect(host, **connection_arguments)
+        except Exception as exc:
+            if isinstance(exc, AuthenticationException) and not isinstance(exc, AuthenticationBackoff):
+                backoff = self.auth_failures.record_failure(self._machine, username, password, str(exc))
+                self.logger.error(f'Authentication to {host} failed, not trying again for {backoff:.0f} s')
+            self.logger.error(
+                f"Error connecting to '{host}' through SSH: [{self.__class__.__name__}] {exc}, "
+                f'connect_args were: {self._safe_connect_args}'
+            )
+            close_proxies()
+            raise
+        self.auth_failures.record_success(self._machine, username, password)
+        if self._keepalive_interval:
+            client.get_transport().set_keepalive(self._keepalive_interval)
+
+        return client, proxies
+
+    @property
+    def _safe_connect_args(self):
+        """The connection arguments without the password, for logging"""
+        return {key: value for key, value in self._connect_args.items() if key != 'password'}
+
+    @instrumented('transport.open')
+    def open(self):
+        """
+        Open a SSHClient to the machine possibly using the parameters given in the __init__.
+
+        If ``use_connection_pool`` is set, an authenticated connection from the pool is used instead of logging in.
+        Also opens a sftp channel, ready to be used.
+        The current working directory is set explicitly, so it is not None.
+
+        :raise aiida.common.InvalidOperation: if the channel is already open
+        """
+        from aiida.common.exceptions import InvalidOperation
+        from paramiko.ssh_exception import SSHException
+
+        if self._is_open:
+            raise InvalidOperation('Cannot open the transport twice')
+
+        self.flush_metadata_cache()
+        if self._use_connection_pool:
+            self._pooled = self.connection_pool.acquire(self._pool_key, self._connect, self._pool_channels)
+            self._client = self._pooled.client
+        else:
+            self._client, self._proxies = self._connect()
+
+        # Open the SFTP channel, and handle error by directing customer to try another transport
+        try:
+            self._sftp = self._client.open_sftp()
+        except SSHException:
+            self._release_connection()
+            raise InvalidOperation(
+                'Error in ssh transport plugin. This may be due to the remote computer not supporting SFTP. '
+                'Try setting it up with the core.ssh_async transport plugin with openssh backend, instead.'
+            )
+
+        self._is_open = True
+
+        # Set the current directory to a explicit path, and not to None
+        self._sftp.chdir(self._sftp.normalize('.'))
+
+        if self._keepalive_interval:
+            self.liveness_monitor.watch(self, self._keepalive_interval)
+        return self
+
+    @property
+    def _pool_channels(self):
+        """Channels held at once on a pooled connection: the SFTP channel, those of the transfer workers and an exec"""
+        return 2 + (self._transfer_workers if self._transfer_workers > 1 else 0)
+
+    def _release_connection(self):
+        """Close the connection, or give it back to the pool"""
+        if self._pooled is not None:
+            self.connection_pool.release(self._pooled, self._pool_channels)
+            self._pooled = None
+        else:
+            self._client.close()
+            self._close_proxies()
+
+    def close(self):
+        """
+        Close the SFTP channel, and the SSHClient - or give it back to the pool.
+
+        :raise aiida.common.InvalidOperation: if the channel is already closed
+        """
+        from aiida.common.exceptions import InvalidOperation
+
+        if not self._is_open:
+            raise InvalidOperation('Cannot close the transport: it is already closed')
+
+        self.liveness_monitor.unwatch(self)
+        self._sftp.close()
+        self._release_connection()
+        self.flush_metadata_cache()
+
+        self._is_open = False
+        self._connection_dropped = False
+        export_metrics()
+
+    def _connection_is_active(self):
+        if self._pooled is not None:
+            return self._pooled.is_active
+        transport = self._client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def _mark_if_dropped(self):
+        """
+        Mark the connection to be replaced at the next operation if it dropped, called by the liveness monitor
+
+        The connection is left as it is, as operations may be in flight on it in other threads.
+
+        :return: True if the connection was found dropped
+        """
+        if not self._is_open or self._connection_dropped or self._connection_is_active():
+            return False
+        self.logger.warning(f'Connection to {self.login_host or self._machine} dropped, reconnecting at the next use')
+        self._connection_dropped = True
+        return True
+
+    def _reconnect_if_dropped(self):
+        """
+        Replace a connection that dropped, reopening the SFTP channel in the same directory
+
+        Pooled connections are always replaced, others only if ``keepalive_interval`` is set. Called by the thread
+        using the transport, before each operation.
+
+        :return: True if the connection was replaced
+        """
+        if self._pooled is None and not self._keepalive_interval:
+            return False
+        if not self._is_open or (not self._connection_dropped and self._connection_is_active()):
+            return False
+        with self._reconnect_lock:
+            if not self._is_open or (not self._connection_dropped and self._connection_is_active()):
+                return False
+            self._connection_dropped = False
+            cwd = self._sftp.getcwd()
+            self.logger.warning(f'Connection to {self.login_host or self._machine} dropped, reconnecting')
+            if self._pooled is not None:
+                self._pooled = self.connection_pool.reconnect(self._pooled, self._connect, self._pool_channels)
+                self._client = self._pooled.client
+            else:
+                self._client.close()
+                self._close_proxies()
+                self._client, self._proxies = self._connect()
+            self._sftp = self._client.open_sftp()
+            self._sftp.chdir(cwd or self._sftp.normalize('.'))
+            self.flush_metadata_cache()
+            return True
+
+    @property
+    def sshclient(self):
+        if not self._is_open:
+            raise TransportInternalError('Error, ssh method called for SshTransport without opening the channel first')
+        self._reconnect_if_dropped()
+        return self._client
+
+    @property
+    def sftp(self):
+        if not self._is_open:
+            raise TransportInternalError('Error, sftp method called for SshTransport without opening the channel first')
+        self._reconnect_if_dropped()
+        return self._sftp
+
+    @instrumented('ssh.exec_batch')
+    def exec_command_batch(self, commands, stop_on_error=False, workdir=None, encoding='utf-8'):
+        """
+        Execute several commands in a single remote shell invocation, i.e. in one round trip
+
+        :param commands: list of commands, each either a string or a ``(command, workdir)`` tuple. The commands are
+            assumed to be already escaped using :py:func:`aiida.common.escaping.escape_for_bash`.
+        :param stop_on_error: if True, the commands following one that failed are not run
+        :param workdir: the working directory of the commands without one, defaults to the current directory
+        :param encoding: the encoding of the outputs
+        :return: list of ``(retval, stdout, stderr)`` tuples, one per command. The ``retval`` of commands that were not
+            run is None.
+        :raises OSError: if the batch itself could not be run
+        """
+        if not commands:
+            return []
+        script, marker = build_batch_script(commands, stop_on_error=stop_on_error)
+        retval, stdout, stderr = self.exec_command_wait_bytes(script, workdir=workdir)
+        results = parse_batch_output(stdout, marker, len(commands))
+        if retval != 0 and results[0][0] is None:
+            raise OSError(
+                'Running the batch of commands failed with exit status {}: {}'.format(
+                    retval, stderr.decode(encoding, errors='replace').strip()
+                )
+            )
+        return [(ret, out.decode(encoding), err.decode(encoding)) for ret, out, err in results]
+
+    def _use_tar(self):
+        """Whether folders should be transferred as tar streams, checking once that tar exists on the remote"""
+        if self._tree_transfer == 'sftp':
+            return False
+        if self._remote_has_tar is None:
+            retval, _, _ = self.exec_command_wait('command -v tar')
+            self._remote_has_tar = retval == 0
+            if not self._remote_has_tar:
+                self.logger.warning('tar is not available on the remote, falling back to SFTP for folder transfers')
+        return self._remote_has_tar
+
+    def _open_tar_channel(self, command):
+        """
+        Run a tar command on the remote, outside of the login shell so that nothing else is written to the stream
+
+        :return: the paramiko channel
+        """
+        channel = self.sshclient.get_transport().open_session()
+        self.logger.debug(f'Command to be executed: {command}')
+        channel.exec_command(command)
+        return channel
+
+    def _close_tar_channel(self, channel, command):
+        """Wait for the remote tar to finish, raising OSError if it failed"""
+        retval = channel.recv_exit_status()
+        stderr = channel.makefile_stderr('rb').read().decode('utf-8', errors='replace')
+        channel.close()
+        if retval != 0:
+            raise OSError(f'Remote command `{command}` failed with exit status {retval}: {stderr.strip()}')
+
+    def _absolute_remote(self, path):
+        """Make a remote path absolute with respect to the current directory, without a round trip"""
+        if os.path.isabs(path):
+            return path
+        return os.path.join(self.getcwd() or '.', path)
+
+    @instrumented('transfer.puttree')
+    @_invalidates('remotepath')
+    def puttree(self, localpath, remotepath, callback=None, dereference=True, overwrite=True):
+        """
+        Put a folder recursively from local to remote.
+
+        With the ``tar`` and ``tar.gz`` transfer modes, the folder is packed on the fly into a single tar stream
+        unpacked on the remote, instead of one SFTP round trip per file.
+        See the stock :meth:`aiida.transports.plugins.ssh.SshTransport.puttree` for the parameters.
+        """
+        localpath = str(localpath)
+        remotepath = str(remotepath)
+
+        # Symbolic links are only kept by the per-file SFTP transfer of the stock transport
+        if not self._use_tar() or not dereference:
+            if self._transfer_workers > 1 and dereference:
+                return self._puttree_parallel(localpath, remotepath, overwrite)
+            return super().puttree(localpath, remotepath, callback, dereference, overwrite)
+
+        if not os.path.isabs(localpath):
+            raise ValueError('The localpath must be an absolute path')
+        if not os.path.exists(localpath):
+            raise OSError('The localpath does not exists')
+        if not os.path.isdir(localpath):
+            raise ValueError(f'Input localpath is not a folder: {localpath}')
+        if not remotepath:
+            raise OSError('remotepath must be a non empty string')
+
+        if self.path_exists(remotepath) and not overwrite:
+            raise OSError("Can't overwrite existing files")
+        if self.isfile(remotepath):
+            raise OSError('Cannot copy a directory into a file')
+
+        if not self.isdir(remotepath):  # in this case copy things in the remotepath directly
+            self.makedirs(remotepath)  # and make a directory at its place
+        else:  # remotepath exists already: copy the folder inside of it!
+            remotepath = os.path.join(remotepath, os.path.split(localpath)[1])
+            self.makedirs(remotepath, ignore_existing=overwrite)  # create a nested folder
+
+        compress = self._tree_transfer == 'tar.gz'
+        target = escape_for_bash(self._absolute_remote(remotepath))
+        command = 'tar -x{}f - -C {}'.format('z' if compress else '', target)
+        channel = self._open_tar_channel(command)
+        try:
+            with channel.makefile('wb') as stream:
+                with tarfile.open(fileobj=stream, mode='w|gz' if compress else 'w|', dereference=True) as tar:
+                    for name in sorted(os.listdir(localpath)):
+                        tar.add(os.path.join(localpath, name), arcname=name)
+            channel.shutdown_write()
+        except OSError:
+            channel.close()
+            raise
+        self._close_tar_channel(channel, command)
+
+    @instrumented('transfer.gettree')
+    def gettree(self, remotepath, localpath, callback=None, dereference=True, overwrite=True):
+        """
+        Get a folder recursively from remote to local.
+
+        With the ``tar`` and ``tar.gz`` transfer modes, the remote folder is packed on the fly into a single tar
+        stream, instead of one SFTP round trip per file and per stat.
+        See the stock :meth:`aiida.transports.plugins.ssh.SshTransport.gettree` for the parameters.
+        """
+        remotepath = str(remotepath)
+        localpath = str(localpath)
+
+        # Symbolic links are only kept by the per-file SFTP transfer of the stock transport
+        if not self._use_tar() or not dereference:
+            if self._transfer_workers > 1 and dereference:
+                return self._gettree_parallel(remotepath, localpath, overwrite)
+            return super().gettree(remotepath, localpath, callback, dereference, overwrite)
+
+        if not remotepath:
+            raise OSError('Remotepath must be a non empty string')
+        if not localpath:
+            raise ValueError('Localpaths must be a non empty string')
+        if not os.path.isabs(localpath):
+            raise ValueError('Localpaths must be an absolute path')
+        if not self.isdir(remotepath):
+            raise OSError(f'Input remotepath is not a folder: {localpath}')
+        if os.path.exists(localpath) and not overwrite:
+            raise OSError("Can't overwrite existing files")
+        if os.path.isfile(localpath):
+            raise OSError('Cannot copy a directory into a file')
+
+        if not os.path.isdir(localpath):  # in this case copy things in the remotepath directly
+            os.makedirs(localpath, exist_ok=True)  # and make a directory at its place
+        else:  # localpath exists already: copy the folder inside of it!
+            localpath = os.path.join(localpath, os.path.split(remotepath)[1])
+            os.makedirs(localpath, exist_ok=overwrite)  # create a nested folder
+
+        compress = self._tree_transfer == 'tar.gz'
+        source = escape_for_bash(self._absolute_remote(remotepath))
+        command = 'tar -c{}hf - -C {} .'.format('z' if compress else '', source)
+        channel = self._open_tar_channel(command)
+        try:
+            with channel.makefile('rb') as stream:
+                with tarfile.open(fileobj=stream, mode='r|gz' if compress else 'r|') as tar:
+                    _extract_tar_stream(tar, localpath)
+        except (OSError, tarfile.TarError) as exc:
+            channel.close()
+            raise OSError(f'Error while unpacking {remotepath}: {exc}') from exc
+        self._close_tar_channel(channel, command)
+
+    def _run_transfers(self, jobs):
+        """Run a batch of ``(direction, source, destination)`` transfers concurrently"""
+        engine = ParallelTransfer(lambda: self.sshclient.open_sftp(), workers=self._transfer_workers)
+        return engine.run(jobs)
+
+    @instrumented('transfer.putfiles')
+    def putfiles(self, pairs, overwrite=True):
+        """
+        Put several files from local to remote, ``transfer_workers`` of them at a time
+
+        :param pairs: list of ``(localpath, remotepath)`` tuples, local paths must be absolute
+        :param overwrite: if False, files that already exist on the remote are reported as failed
+        :return: a :class:`~aiida_archer2_scheduler.archer2.parallel_transfer.TransferReport`, with the errors of the
+            individual files
+        """
+        from paramiko.ssh_exception import SSHException
+
+        jobs = []
+        report = TransferReport()
+        for localpath, remotepath in pairs:
+            localpath, remotepath = str(localpath), str(remotepath)
+            if not os.path.isabs(localpath):
+                report.failed[localpath] = ValueError('The localpath must be an absolute path')
+                continue
+            try:
+                if not overwrite and self.isfile(remotepath):
+                    raise OSError('Destination already exists: not overwriting it')
+                if self._upload_cache_enabled and os.path.getsize(localpath) >= self.UPLOAD_CACHE_MIN_SIZE:
+                    # Goes through the upload cache
+                    self.putfile(localpath, remotepath)
+                    report.succeeded.append(localpath)
+                    continue
+            except (OSError, SSHException) as exc:
+                report.failed[localpath] = exc
+                continue
+            jobs.append((PUT, localpath, self._absolute_remote(remotepath)))
+        try:
+            batch = self._run_transfers(jobs)
+        finally:
+            if self._metadata_cache is not None:
+                for _, _, remotepath in jobs:
+                    self._metadata_cache.invalidate(remotepath)
+        batch.succeeded.extend(report.succeeded)
+        return self._merge_reports(report, batch)
+
+    @instrumented('transfer.getfiles')
+    def getfiles(self, pairs, overwrite=True):
+        """
+        Get several files from remote to local, ``transfer_workers`` of them at a time
+
+        :param pairs: list of ``(remotepath, localpath)`` tuples, local paths must be absolute
+        :param overwrite: if False, files that already exist locally are reported as failed
+        :return: a :class:`~aiida_archer2_scheduler.archer2.parallel_transfer.TransferReport`, with the errors of the
+            individual files
+        """
+        jobs = []
+        report = TransferReport()
+        for remotepath, localpath in pairs:
+            remotepath, localpath = str(remotepath), str(localpath)
+            if not os.path.isabs(localpath):
+                report.failed[remotepath] = ValueError('localpath must be an absolute path')
+            elif not overwrite and os.path.isfile(localpath):
+                report.failed[remotepath] = OSError('Destination already exists: not overwriting it')
+            else:
+                jobs.append((GET, self._absolute_remote(remotepath), localpath))
+        return self._merge_reports(report, self._run_transfers(jobs))
+
+    @staticmethod
+    def _merge_reports(first, second):
+        second.failed.update(first.failed)
+        return second
+
+    def get(self, remotepath, localpath, callback=None, dereference=True, overwrite=True, ignore_nonexisting=False):
+        """
+        Get a file or folder from remote to local.
+
+        The files matched by a pattern are transferred concurrently if ``transfer_workers`` is more than one.
+        See the stock :meth:`aiida.transports.plugins.ssh.SshTransport.get` for the parameters.
+        """
+        remotepath = str(remotepath)
+        localpath = str(localpath)
+        if (
+            self._transfer_workers <= 1 or not has_magic(remotepath) or has_magic(localpath) or not dereference or
+            not os.path.isabs(localpath)
+        ):
+            return super().get(remotepath, localpath, callback, dereference, overwrite, ignore_nonexisting)
+
+        to_copy_list = self.glob(remotepath)
+        rename_local = False
+        if len(to_copy_list) > 1:
+            # I can't scp more than one file on a single file
+            if os.path.isfile(localpath):
+                raise OSError('Remote destination is not a directory')
+            # I can't scp more than one file in a non existing directory
+            if not os.path.exists(localpath):
+                raise OSError('Remote directory does not exist')
+            rename_local = True
+
+        pairs = []
+        for file in to_copy_list:
+            if self.isfile(file):
+                pairs.append((file, os.path.join(localpath, os.path.split(file)[1]) if rename_local else localpath))
+            else:
+                self.gettree(file, localpath, callback, dereference, overwrite)
+        self.getfiles(pairs, overwrite=overwrite).raise_for_errors()
+
+    @property
+    def resumable_download(self):
+        """The :class:`~aiida_archer2_scheduler.archer2.resumable_download.ResumableDownload` of this transport"""
+        if self._resumable_download is None:
+            self._resumable_download = ResumableDownload(
+                self, '{}@{}'.format(self._connect_args.get('username'), self._machine)
+            )
+        return self._resumable_download
+
+    @instrumented('sftp.getfile', size=_received_size)
+    def getfile(self, remotepath, localpath, callback=None, dereference=True, overwrite=True):
+        """
+        Get a file from remote to local.
+
+        If ``resumable_download_size`` is set, larger files are fetched in verified chunks through the local cache of
+        partial files, so that an interrupted retrieval, or one started by :meth:`prefetch_files`, is resumed.
+        See the stock :meth:`aiida.transports.plugins.ssh.SshTransport.getfile` for the parameters.
+        """
+        remotepath = str(remotepath)
+        localpath = str(localpath)
+        if self._resumable_download_size and dereference and os.path.isabs(localpath):
+            remotepath = self._absolute_remote(remotepath)
+            if self.sftp.stat(remotepath).st_size >= self._resumable_download_size:
+                if os.path.isfile(localpath) and not overwrite:
+                    raise OSError('Destination already exists: not overwriting it')
+                shutil.move(self.resumable_download.fetch(remotepath), localpath)
+                self.resumable_download.discard(remotepath)
+                return None
+        return super().getfile(remotepath, localpath, callback, dereference, overwrite)
+
+    def prefetch_files(self, remotepaths):
+        """
+        Fetch the complete chunks of files still being written, for example by a running job
+
+        Missing files and files smaller than ``resumable_download_size`` are skipped. The rest of each file is
+        fetched when it is retrieved with :meth:`getfile`.
+
+        :param remotepaths: list of remote paths
+        :return: dictionary of the absolute remote paths fetched to the number of bytes held locally
+        """
+        fetched = {}
+        if not self._resumable_download_size:
+            return fetched
+        for remotepath in remotepaths:
+            remotepath = self._absolute_remote(str(remotepath))
+            try:
+                size = self.sftp.stat(remotepath).st_size
+            except FileNotFoundError:
+                continue
+            if size >= self._resumable_download_size:
+                self.resumable_download.fetch(remotepath, complete=False)
+                fetched[remotepath] = self.resumable_download.verified_size(remotepath)
+        return fetched
+
+    @instrumented('sftp.putfile', size=_sent_size)
+    @_invalidates('remotepath')
+    def putfile(self, localpath, remotepath, callback=None, dereference=True, overwrite=True):
+        """
+        Put a file from local to remote.
+
+        If the upload cache is enabled, files of at least :attr:`UPLOAD_CACHE_MIN_SIZE` bytes are sent once into the
+        remote cache and linked from there.
+        See the stock :meth:`aiida.transports.plugins.ssh.SshTransport.putfile` for the parameters.
+        """
+        localpath = str(localpath)
+        remotepath = str(remotepath)
+        if (
+            self._upload_cache_enabled and dereference and os.path.isabs(localpath) and os.path.isfile(localpath) and
+            os.path.getsize(localpath) >= self.UPLOAD_CACHE_MIN_SIZE
+        ):
+            if self.isfile(remotepath) and not overwrite:
+                raise OSError('Destination already exists: not overwriting it')
+            if self._put_cached(localpath, remotepath):
+                return None
+        return super().putfile(localpath, remotepath, callback, dereference, overwrite)
+
+    @property
+    def _upload_cache_enabled(self):
+        """Whether files go through the upload cache, not the case if its files could not be placed"""
+        return bool(self._upload_cache_dir) and not self._upload_cache_failed
+
+    @property
+    def _upload_cache_store(self):
+        """Name of the remote store in the local index"""
+        return '{}@{}:{}'.format(self._connect_args.get('username'), self._machine, self._upload_cache_dir)
+
+    def _link_cached(self, source, destination):
+        """
+        Place a file of the cache in the calculation folder
+
+        :return: True if the file was placed, False if the file is not in the cache
+        :raises OSError: if the file is in the cache but could not be placed
+        """
+        retval, _, stderr = self.exec_command_wait(
+            'test -f {src} || exit {missing}; {command}'.format(
+                src=escape_for_bash(source),
+                missing=_UPLOAD_CACHE_MISSING,
+                command=self.UPLOAD_CACHE_LINK_COMMANDS[self._upload_cache_link].format(
+                    src=escape_for_bash(source), dest=escape_for_bash(destination)
+                )
+            )
+        )
+        if retval == _UPLOAD_CACHE_MISSING:
+            return False
+        if retval != 0:
+            raise OSError(f'Placing {source} from the upload cache failed: {stderr.strip()}')
+        return True
+
+    def _place_cached(self, source, destination):
+        """
+        Place a file of the cache, switching to copies if hard links cannot be made (e.g. the cache is on another
+        filesystem), and to direct uploads for the rest of the transport if the file cannot be placed at all
+
+        :return: True if the file was placed, False if the file is not in the cache, None if it could not be placed
+        """
+        try:
+            return self._link_cached(source, destination)
+        except OSError as exc:
+            self.logger.warning(str(exc))
+        if self._upload_cache_link == 'hardlink':
+            self.logger.warning('Copying the files of the upload cache from now on')
+            self._upload_cache_link = 'copy'
+            try:
+                return self._link_cached(source, destination)
+            except OSError as exc:
+                self.logger.warning(str(exc))
+        self.logger.warning('Uploading files directly instead of through the upload cache from now on')
+        self._upload_cache_failed = True
+        return None
+
+    def _put_cached(self, localpath, remotepath):
+        """
+        Put a file through the upload cache
+
+        :return: True if the file was placed, False if it should be sent directly instead
+        """
+        digest = file_digest(localpath)
+        store = self._upload_cache_store
+        source = store_path(self._upload_cache_dir, digest)
+        destination = self._absolute_remote(remotepath)
+
+        if self.upload_cache_index.contains(store, digest):
+            placed = self._place_cached(source, destination)
+            if placed:
+                self.upload_cache_hits += 1
+                return True
+            if placed is None:
+                return False
+            # The file was removed from the cache behind our back
+            self.upload_cache_index.discard(store, digest)
+
+        self.upload_cache_misses += 1
+        try:
+            self.makedirs(os.path.dirname(source), ignore_existing=True)
+            partial = '{}.{}.part'.format(source, uuid.uuid4().hex)
+            self.sftp.put(localpath, partial, confirm=True)
+            self.sftp.posix_rename(partial, source)
+        except OSError as exc:
+            self.logger.warning(f'Could not add {localpath} to the upload cache: {exc}')
+            return False
+
+        self.upload_cache_index.add(store, digest, os.path.getsize(localpath))
+        self._evict_upload_cache()
+        return bool(self._place_cached(source, destination))
+
+    def _evict_upload_cache(self):
+        """
+        Remove the least recently used files beyond the maximum size of the cache
+
+        Nothing is removed while the files are linked symbolically, as calculation folders may still point to them.
+        """
+        if self._upload_cache_link == 'symlink':
+            return
+        store = self._upload_cache_store
+        for digest in self.upload_cache_index.eviction_candidates(store, self._upload_cache_max_size):
+            try:
+                self.remove(store_path(self._upload_cache_dir, digest))
+            except OSError:
+                pass
+            self.upload_cache_index.discard(store, digest)
+
+    def verify_upload_cache(self):
+        """
+        Re-synchronise the local index with the files actually present in the remote upload cache
+
+        Use this after files have been purged from the remote, e.g. by a filesystem cleanup policy.
+
+        :return: the number of files in the cache
+        """
+        if not self._upload_cache_dir:
+            raise ValueError('The upload cache is not enabled for this transport')
+        retval, stdout, stderr = self.exec_command_wait(
+            "find {} -type f -printf '%f %s\\n'".format(escape_for_bash(self._upload_cache_dir))
+        )
+        if retval != 0 and not self.path_exists(self._upload_cache_dir):
+            stdout = ''
+        elif retval != 0:
+            raise OSError(f'Could not list the upload cache: {stderr.strip()}')
+        entries = {}
+        for line in stdout.splitlines():
+            name, _, size = line.partition(' ')
+            if len(name) == 64 and all(char in '0123456789abcdef' for char in name):
+                entries[name] = int(size)
+        self.upload_cache_index.replace(self._upload_cache_store, entries)
+        return len(entries)
+
+    def _puttree_parallel(self, localpath, remotepath, overwrite):
+        """Put a folder following the links, creating the directories and then transferring the files concurrently"""
+        if not os.path.isabs(localpath):
+            raise ValueError('The localpath must be an absolute path')
+        if not os.path.exists(localpath):
+            raise OSError('The localpath does not exists')
+        if not os.path.isdir(localpath):
+            raise ValueError(f'Input localpath is not a folder: {localpath}')
+        if not remotepath:
+            raise OSError('remotepath must be a non empty string')
+
+        if self.path_exists(remotepath) and not overwrite:
+            raise OSError("Can't overwrite existing files")
+        if self.isfile(remotepath):
+            raise OSError('Cannot copy a directory into a file')
+
+        if not self.isdir(remotepath):  # in this case copy things in the remotepath directly
+            self.makedirs(remotepath)  # and make a directory at its place
+        else:  # remotepath exists already: copy the folder inside of it!
+            remotepath = os.path.join(remotepath, os.path.split(localpath)[1])
+            self.makedirs(remotepath, ignore_existing=overwrite)  # create a nested folder
+
+        pairs = []
+        for dirpath, _, filenames in os.walk(localpath):
+            relpath = os.path.relpath(dirpath, localpath)
+            if relpath != '.':
+                self.mkdir(os.path.join(remotepath, relpath), ignore_existing=True)
+            for filename in filenames:
+                remote_file = os.path.normpath(os.path.join(remotepath, relpath, filename))
+                pairs.append((os.path.join(dirpath, filename), remote_file))
+
+        self.putfiles(pairs).raise_for_errors()
+
+    def _gettree_parallel(self, remotepath, localpath, overwrite):
+        """Get a folder following the links, listing the directories and then transferring the files concurrently"""
+        if not remotepath:
+            raise OSError('Remotepath must be a non empty string')
+        if not localpath:
+            raise ValueError('Localpaths must be a non empty string')
+        if not os.path.isabs(localpath):
+            raise ValueError('Localpaths must be an absolute path')
+        if not self.isdir(remotepath):
+            raise OSError(f'Input remotepath is not a folder: {localpath}')
+        if os.path.exists(localpath) and not overwrite:
+            raise OSError("Can't overwrite existing files")
+        if os.path.isfile(localpath):
+            raise OSError('Cannot copy a directory into a file')
+
+        if not os.path.isdir(localpath):  # in this case copy things in the remotepath directly
+            os.makedirs(localpath, exist_ok=True)  # and make a directory at its place
+        else:  # localpath exists already: copy the folder inside of it!
+            localpath = os.path.join(localpath, os.path.split(remotepath)[1])
+            os.makedirs(localpath, exist_ok=overwrite)  # create a nested folder
+
+        # One listing per directory gives the type of every entry, instead of a stat per entry
+        pairs = []
+        pending = [(remotepath, localpath)]
+        while pending:
+            remote_dir, local_dir = pending.pop()
+            for attr in self.sftp.listdir_attr(remote_dir):
+                remote_item = os.path.join(remote_dir, attr.filename)
+                local_item = os.path.join(local_dir, attr.filename)
+                if stat.S_ISLNK(attr.st_mode):
+                    # Follow the link, as done by the stock gettree
+                    attr = self.sftp.stat(remote_item)
+                if stat.S_ISDIR(attr.st_mode):
+                    os.makedirs(local_item, exist_ok=True)
+                    pending.append((remote_item, local_item))
+                else:
+                    pairs.append((remote_item, local_item))
+
+        self.getfiles(pairs).raise_for_errors()
+
+    def flush_metadata_cache(self):
+        """Drop everything held by the metadata cache, if enabled"""
+        if self._metadata_cache is not None:
+            self._metadata_cache.flush()
+
+    def metadata_cache_stats(self):
+        """
+        Return the counters of the metadata cache
+
+        :return: a dictionary with the number of ``hits``, ``misses`` and ``entries``, or None if the cache is disabled
+        """
+        if self._metadata_cache is None:
+            return None
+        return self._metadata_cache.stats()
+
+    def _cache_key(self, path):
+        return posixpath.normpath(self._absolute_remote(str(path)))
+
+    @instrumented('sftp.stat')
+    def stat(self, path):
+        """
+        Retrieve information about a file on the remote system, see the stock ``SshTransport.stat``
+
+        The result is served from the metadata cache if enabled.
+        """
+        if self._metadata_cache is None:
+            return super().stat(path)
+        key = self._cache_key(path)
+        try:
+            return self._metadata_cache.get_stat(key)
+        except KeyError:
+            pass
+        try:
+            value = super().stat(path)
+        except OSError as exc:
+            if getattr(exc, 'errno', None) == errno.ENOENT:
+                self._metadata_cache.set_stat(key, None)
+            raise
+        self._metadata_cache.set_stat(key, value)
+        return value
+
+    @instrumented('sftp.normalize')
+    def normalize(self, path='.'):
+        """Returns the normalized path (removing double slashes, etc...), served from the metadata cache if enabled"""
+        if self._metadata_cache is None:
+            return super().normalize(path)
+        key = self._cache_key(path)
+        try:
+            return self._metadata_cache.get_normalize(key)
+        except KeyError:
+            value = super().normalize(path)
+            self._metadata_cache.set_normalize(key, value)
+            return value
+
+    @instrumented('sftp.listdir')
+    def listdir(self, path='.', pattern=None):
+        """Get the list of files at path, served from the metadata cache if enabled and no pattern is given"""
+        if self._metadata_cache is None or pattern:
+            return super().listdir(path, pattern)
+        key = self._cache_key(path)
+        try:
+            return self._metadata_cache.get_listdir(key)
+        except KeyError:
+            value = super().listdir(path)
+            self._metadata_cache.set_listdir(key, value)
+            return list(value)
+
+    @instrumented('sftp.mkdir')
+    @_invalidates('path')
+    def mkdir(self, path, ignore_existing=False):
+        return super().mkdir(path, ignore_existing)
+
+    @instrumented('sftp.rmdir')
+    @_invalidates('path')
+    def rmdir(self, path):
+        return super().rmdir(path)
+
+    @instrumented('sftp.remove')
+    @_invalidates('path')
+    def remove(self, path):
+        return super().remove(path)
+
+    @instrumented('sftp.rename')
+    @_invalidates('oldpath', 'newpath')
+    def rename(self, oldpath, newpath):
+        return super().rename(oldpath, newpath)
+
+    @instrumented('sftp.chmod')
+    @_invalidates('path')
+    def chmod(self, path, mode):
+        return super().chmod(path, mode)
+
+    @instrumented('sftp.symlink')
+    @_invalidates('dest')
+    def _symlink(self, source, dest):
+        return super()._symlink(source, dest)
+
+    @instrumented('ssh.exec', size=_output_size)
+    def exec_command_wait_bytes(self, command, *args, **kwargs):  # pylint: disable=arguments-differ
+        """Execute a command and wait for it to finish, see the stock ``SshTransport.exec_command_wait_bytes``"""
+        return super().exec_command_wait_bytes(command, *args, **kwargs)
+
+    def _exec_command_internal(self, command, *args, **kwargs):  # pylint: disable=arguments-differ
+        """Execute a command, see the stock ``SshTransport._exec_command_internal``
+
+        Since a command can change anything on the remote, the metadata cache is flushed.
+        """
+        self.flush_metadata_cache()
+        return super()._exec_command_internal(command, *args, **kwargs)
+
+
+def _extract_tar_stream(tar, destination):
+    """Extract a streamed tar archive, refusing members that would end up outside of the destination"""
+    destination = os.path.realpath(destination)
+    for member in tar:
+        target = os.path.realpath(os.path.join(destination, member.name))
+        if os.path.commonpath([destination, target]) != destination:
+            raise OSError(f'Refusing to extract {member.name} outside of {destination}')
+        if not (member.isdir() or member.isfile()):
+            # Links and special files are not transferred, as with SFTP
+            continue
+        if hasattr(tarfile, 'data_filter'):
+            tar.extract(member, destination, filter='data')
+        else:
+            tar.extract(member, destination)
+
 
 class SshTransport4C(SshTransport):
     """
     SSH Transport for the 4 cabinet service
     """
-    CLIENT_CLASS = ARCHER24CSSHClient
\ No newline at end of file
+    CLIENT_CLASS = LazyAttribute('.ssh_client', 'ARCHER24CSSHClient')
\ No newline at end of file
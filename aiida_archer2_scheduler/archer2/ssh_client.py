@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+SSH clients logging in to ARCHER2 with both a public key and the password
+
+This module imports paramiko and its key classes, which takes longer than the rest of the plugin together. The
+transports only load it through their ``CLIENT_CLASS`` attribute, when they first connect.
+"""
+from binascii import hexlify
+import os
+
+from paramiko.agent import Agent
+from paramiko.common import DEBUG
+from paramiko.dsskey import DSSKey
+from paramiko.ecdsakey import ECDSAKey
+from paramiko.ed25519key import Ed25519Key
+from paramiko.rsakey import RSAKey
+from paramiko.ssh_exception import AuthenticationException, BadAuthenticationType, SSHException
+from paramiko import SSHClient
+
+from .auth_plan import AuthPlanStore, auth_config_digest
+from .instrumentation import instrumented
+from .key_cache import KEY_CACHE
+
+__all__ = ('Archer2SSHClient', 'ARCHER24CSSHClient', 'KEY_CLASSES', 'DEFAULT_KEY_FILES')
+
+KEY_CLASSES = (RSAKey, DSSKey, ECDSAKey, Ed25519Key)
+
+# Default key files looked for in ~/.ssh when ``look_for_keys`` is set
+DEFAULT_KEY_FILES = ((DSSKey, 'dsa'), (ECDSAKey, 'ecdsa'), (Ed25519Key, 'ed25519'))
+
+DEFAULT_AUTH_PLAN_STORE = AuthPlanStore()
+
+
+class _KeyCandidate:
+    """A public key that may be offered to the server, only loaded when it is actually tried"""
+
+    def __init__(self, source, name, loader, key_class=None):
+        """
+        :param source: where the key comes from - ``pkey``, ``file`` or ``agent``
+        :param name: the path of the key file, or the fingerprint for the other sources
+        :param loader: callable returning a ``(key, key_class_name)`` tuple
+        :param key_class: the name of the key class, if known already
+        """
+        self.source = source
+        self.name = name
+        self.key_class = key_class
+        self._loader = loader
+
+    def load(self):
+        """Load the key"""
+        key, self.key_class = self._loader()
+        return key
+
+    @property
+    def step(self):
+        """The plan step corresponding to this key"""
+        return {'method': 'publickey', 'source': self.source, 'name': self.name, 'key_class': self.key_class}
+
+    def matches(self, step):
+        return step.get('source') == self.source and step.get('name') == self.name
+
+
+class Archer2SSHClient(SSHClient):
+    """
+    Specialised SSHClient for ARCHER2
+
+    ARCHER2 requires both a public key and the password: the key is offered first, followed by the password.
+    The steps that lead to a successful login are recorded in the :attr:`auth_plan_store` and tried first the next
+    time the same user connects to the same host.
+    """
+    #: Offer the password before the public key
+    PASSWORD_FIRST = False
+    #: Where successful authentication plans are recorded, set to None to always go through the full list
+    auth_plan_store = DEFAULT_AUTH_PLAN_STORE
+
+    @instrumented('ssh.connect')
+    def connect(self, hostname, *args, **kwargs):  # pylint: disable=arguments-differ
+        """Connect to the host, recording its name for looking up the authentication plan"""
+        self._archer2_hostname = hostname
+        return super().connect(hostname, *args, **kwargs)
+
+    def _load_key_file(self, filename, passphrase, key_classes=KEY_CLASSES):
+        """
+        Load a private key file through the process-wide :data:`KEY_CACHE`, trying each of the key classes in turn
+
+        :return: a tuple of the key and the name of the class that loaded it
+        :raises SSHException: if the file cannot be loaded by any class
+        """
+        return KEY_CACHE.load(filename, passphrase, key_classes, self._key_from_filepath)
+
+    def _key_candidates(self, pkey, key_filenames, look_for_keys, passphrase):
+        """
+        Return the full list of public keys to try, in order:
+
+            - The supplied ``pkey``
+            - Each of the supplied ``key_filenames``
+            - The default keys in ``~/.ssh``, if ``look_for_keys`` is set
+            - The keys held by the SSH agent
+        """
+        candidates = []
+        if pkey is not None:
+            candidates.append(
+                _KeyCandidate('pkey', hexlify(pkey.get_fingerprint()).decode(), lambda: (pkey, type(pkey).__name__))
+            )
+
+        for key_filename in key_filenames:
+            candidates.append(
+                _KeyCandidate('file', key_filename, lambda name=key_filename: self._load_key_file(name, passphrase))
+            )
+
+        if look_for_keys:
+            for keytype, name in DEFAULT_KEY_FILES:
+                # ~/ssh/ is for windows
+                for directory in ['.ssh', 'ssh']:
+                    full_path = os.path.expanduser('~/{}/id_{}'.format(directory, name))
+                    if not os.path.isfile(full_path):
+                        continue
+                    for path in (full_path, full_path + '-cert.pub'):
+                        if path != full_path and not os.path.isfile(path):
+                            continue
+                        candidates.append(
+                            _KeyCandidate(
+                                'file',
+                                path,
+                                lambda path=path, keytype=keytype: self._load_key_file(path, passphrase, (keytype,)),
+                                keytype.__name__,
+                            )
+                        )
+
+        if self._agent is None:
+            self._agent = Agent()
+        for key in self._agent.get_keys():
+            candidates.append(
+                _KeyCandidate('agent', hexlify(key.get_fingerprint()).decode(), lambda key=key: (key, 'AgentKey'))
+            )
+
+        return candidates
+
+    def _plan_candidates(self, plan, candidates, passphrase):
+        """
+        Select the candidates used by a remembered plan
+
+        :return: the list of candidates, or None if the plan refers to a key that is no longer available
+        """
+        selected = []
+        for step in plan:
+            if step['method'] != 'publickey':
+                continue
+            for candidate in candidates:
+                if candidate.matches(step):
+                    break
+            else:
+                return None
+            key_class = step.get('key_class')
+            if candidate.source == 'file' and key_class:
+                # Go straight to the key class that worked last time
+                classes = [cls for cls in KEY_CLASSES if cls.__name__ == key_class]
+                candidate = _KeyCandidate(
+                    'file',
+                    candidate.name,
+                    lambda name=candidate.name, classes=classes: self._load_key_file(name, passphrase, classes),
+                    key_class,
+                )
+            selected.append(candidate)
+        return selected
+
+    @instrumented('auth.password')
+    def _try_password(self, username, password):
+        """Try the password, return the methods still required or raise SSHException"""
+        return self._transport.auth_password(username, password)
+
+    @instrumented('auth.publickey')
+    def _try_key(self, username, candidate):
+        """Try a public key, return the methods still required or raise SSHException/IOError"""
+        key = candidate.load()
+        self._log(DEBUG, 'Trying SSH {} key {}'.format(candidate.source, hexlify(key.get_fingerprint())))
+        # for 2-factor auth a successfully auth'd key will result in ['password']
+        return self._transport.auth_publickey(username, key)
+
+    @staticmethod
+    def _note_rejected_password(exc, rejected):
+        """Record that the server checked the password and rejected it, rather than not accepting it at this stage"""
+        if rejected is not None and isinstance(exc, AuthenticationException) and not isinstance(
+            exc, BadAuthenticationType
+        ):
+            rejected.add('password')
+
+    def _run_auth(self, username, password, candidates, use_password=True, rejected=None):
+        """
+        Go through the authentication steps
+
+        At most one public key is accepted: once the server accepted a key the remaining candidates are not tried.
+        The password is tried before or after the keys depending on :attr:`PASSWORD_FIRST`.
+
+        :param rejected: set to which ``'password'`` is added if the server rejected the password
+        :return: the list of steps that lead to the successful login
+        :raises SSHException: if the login did not succeed
+        """
+        saved_exception = None
+        steps = []
+        use_password = use_password and password is not None
+
+        if self.PASSWORD_FIRST and use_password:
+            try:
+                allowed_types = self._try_password(username, password)
+                steps.append({'method': 'password'})
+                if not allowed_types:
+                    return steps
+            except SSHException as exc:
+                saved_exception = exc
+                self._note_rejected_password(exc, rejected)
+
+        for candidate in candidates:
+            try:
+                allowed_types = self._try_key(username, candidate)
+            except (SSHException, IOError) as exc:
+                saved_exception = exc
+                continue
+            steps.append(candidate.step)
+            if not allowed_types:
+                return steps
+            break
+
+        if not self.PASSWORD_FIRST and use_password:
+            try:
+                allowed_types = self._try_password(username, password)
+                steps.append({'method': 'password'})
+                if not allowed_types:
+                    return steps
+            except SSHException as exc:
+                saved_exception = exc
+                self._note_rejected_password(exc, rejected)
+
+        # if we got an auth-failed exception earlier, re-raise it
+        if saved_exception is not None:
+            raise saved_exception
+
+        raise SSHException('No authentication methods available')
+
+    @instrumented('ssh.auth')
+    def _auth(
+        self,
+        username,
+        password,
+        pkey,
+        key_filenames,
+        allow_agent,
+        look_for_keys,
+        gss_auth,
+        gss_kex,
+        gss_deleg_creds,
+        gss_host,
+        passphrase,
+    ):
+        """
+        Authenticate with a public key and the password
+
+        The plan remembered for this host and username is tried first. If there is none, or it no longer works,
+        the full list of keys from :meth:`_key_candidates` is tried, together with the password - unless the server
+        rejected the password while trying the plan, so that a wrong password is never sent twice.
+        """
+        if passphrase is None and password is not None:
+            passphrase = password
+
+        host = getattr(self, '_archer2_hostname', None)
+        store = self.auth_plan_store if host is not None else None
+        digest = auth_config_digest(
+            type(self).__name__, sorted(key_filenames), look_for_keys,
+            hexlify(pkey.get_fingerprint()) if pkey is not None else None
+        )
+        candidates = self._key_candidates(pkey, key_filenames, look_for_keys, passphrase)
+
+        plan = store.get(host, username, digest) if store is not None else None
+        rejected = set()
+        plan_exception = None
+        if plan:
+            selected = self._plan_candidates(plan, candidates, passphrase)
+            if selected is not None:
+                try:
+                    self._run_auth(
+                        username,
+                        password,
+                        selected,
+                        use_password=any(step['method'] == 'password' for step in plan),
+                        rejected=rejected,
+                    )
+                    return
+                except SSHException as exc:
+                    self._log(DEBUG, 'Remembered authentication plan failed ({}), trying all methods'.format(exc))
+                    plan_exception = exc
+                    tried = [step for step in plan if step['method'] == 'publickey']
+                    candidates = [cand for cand in candidates if not any(cand.matches(step) for step in tried)]
+
+        try:
+            steps = self._run_auth(username, password, candidates, use_password='password' not in rejected)
+        except SSHException:
+            if store is not None and plan:
+                store.invalidate(host, username)
+            if 'password' in rejected:
+                # The rejected password is what failed, not the keys tried without it
+                raise plan_exception
+            raise
+
+        if store is not None:
+            store.put(host, username, digest, steps)
+
+
+class ARCHER24CSSHClient(Archer2SSHClient):
+    """
+    Client for the 4-cabinet service
+
+    ARCHER2 (4-cabint pilot system) uses a unusual authentication order such as the password is attempted
+    first, followed by the public key.
+    """
+    PASSWORD_FIRST = True
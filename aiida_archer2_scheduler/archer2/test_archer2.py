@@ -1,3 +1,4 @@
+import os
 import pytest
 from .slurm_archer2 import Archer2SlurmScheduler, FelxibleNodeNumber
 import uuid
@@ -89,7 +90,1383 @@ def test_submit_script():
 
     assert "'mpirun' '-np' '23' 'pw.x' '-npool' '1' < 'aiida.in'" in submit_script_text
 
+    # The short QOS is limited to 20 minutes
     job_tmpl.qos = "short"
+    with pytest.raises(ValueError):
+        scheduler.get_submit_script(job_tmpl)
+
+    job_tmpl.max_wallclock_seconds = 600
     submit_script_text = scheduler.get_submit_script(job_tmpl)
 
-    assert '#SBATCH --qos=short' in submit_script_text
\ No newline at end of file
+    assert '#SBATCH --qos=short' in submit_script_text
+
+
+class FakeAuthTransport:
+    """Mimic the ARCHER2 login node - a given public key and the password are both needed"""
+
+    def __init__(self, fingerprint, password):
+        self.fingerprint = fingerprint
+        self.password = password
+        self.calls = []
+        self.key_ok = False
+        self.password_ok = False
+
+    def auth_publickey(self, username, key):
+        from paramiko.ssh_exception import AuthenticationException
+        self.calls.append('publickey')
+        if key.get_fingerprint() != self.fingerprint:
+            raise AuthenticationException('Wrong key')
+        self.key_ok = True
+        return [] if self.password_ok else ['password']
+
+    def auth_password(self, username, password):
+        from paramiko.ssh_exception import AuthenticationException
+        self.calls.append('password')
+        if password != self.password:
+            raise AuthenticationException('Wrong password')
+        self.password_ok = True
+        return [] if self.key_ok else ['publickey']
+
+    def _log(self, level, msg):
+        pass
+
+
+class FakeAgent:
+
+    def get_keys(self):
+        return []
+
+
+def make_auth_client(client_class, transport, store):
+    """Create a client that talks to a fake transport"""
+    client = client_class()
+    client._transport = transport
+    client._agent = FakeAgent()
+    client._archer2_hostname = 'login.archer2.ac.uk'
+    client.auth_plan_store = store
+    return client
+
+
+@pytest.mark.parametrize('password_first', [False, True])
+def test_auth_plan(tmp_path, password_first):
+    """The key that worked is tried first next time, and a stale plan falls back to the full list"""
+    from paramiko import RSAKey
+    from paramiko.ssh_exception import SSHException
+    from .auth_plan import AuthPlanStore
+    from .ssh_client import Archer2SSHClient, ARCHER24CSSHClient
+
+    client_class = ARCHER24CSSHClient if password_first else Archer2SSHClient
+    paths = []
+    keys = []
+    for i in range(3):
+        key = RSAKey.generate(1024)
+        path = str(tmp_path / 'id_{}'.format(i))
+        key.write_private_key_file(path)
+        paths.append(path)
+        keys.append(key)
+
+    store = AuthPlanStore(str(tmp_path / 'plans.json'))
+    args = ('user', 'secret', None, paths, False, False, False, False, False, None, None)
+
+    transport = FakeAuthTransport(keys[2].get_fingerprint(), 'secret')
+    make_auth_client(client_class, transport, store)._auth(*args)
+    assert transport.calls.count('publickey') == 3
+    assert transport.calls[0 if password_first else -1] == 'password'
+
+    # Now go straight to the right key
+    transport = FakeAuthTransport(keys[2].get_fingerprint(), 'secret')
+    make_auth_client(client_class, transport, store)._auth(*args)
+    assert sorted(transport.calls) == ['password', 'publickey']
+
+    # The key changed on the server - the full list is tried
+    transport = FakeAuthTransport(keys[1].get_fingerprint(), 'secret')
+    make_auth_client(client_class, transport, store)._auth(*args)
+    assert transport.key_ok and transport.password_ok
+    plan = store.get('login.archer2.ac.uk', 'user', next(iter(store._read().values()))['digest'])
+    assert plan[0 if not password_first else 1]['name'] == paths[1]
+
+    # Replacing the key file invalidates the plan
+    keys[1].write_private_key_file(paths[1], password='other')
+    digest = next(iter(store._read().values()))['digest']
+    assert store.get('login.archer2.ac.uk', 'user', digest) is None
+
+    # Wrong password - nothing works
+    transport = FakeAuthTransport(keys[2].get_fingerprint(), 'other')
+    with pytest.raises(SSHException):
+        make_auth_client(client_class, transport, store)._auth(*args)
+
+    # A password rejected while trying the plan is not sent again with the full list
+    make_auth_client(client_class, FakeAuthTransport(keys[2].get_fingerprint(), 'secret'), store)._auth(*args)
+    transport = FakeAuthTransport(keys[2].get_fingerprint(), 'other')
+    with pytest.raises(SSHException, match='Wrong password'):
+        make_auth_client(client_class, transport, store)._auth(*args)
+    assert transport.calls.count('password') == 1
+
+
+def test_key_cache(tmp_path):
+    """Keys are parsed once per file version and passphrase, with the detected class tried first"""
+    from paramiko import RSAKey, ECDSAKey
+    from paramiko.ssh_exception import SSHException
+    from .key_cache import KeyCache
+
+    calls = []
+
+    def loader(path, key_class, passphrase):
+        calls.append(key_class.__name__)
+        return key_class.from_private_key_file(path, passphrase)
+
+    path = str(tmp_path / 'id_rsa')
+    RSAKey.generate(1024).write_private_key_file(path, password='pass')
+    cache = KeyCache(max_entries=1)
+
+    key, name = cache.load(path, 'pass', (ECDSAKey, RSAKey), loader)
+    assert name == 'RSAKey'
+    assert calls == ['ECDSAKey', 'RSAKey']
+    assert cache.load(path, 'pass', (ECDSAKey, RSAKey), loader)[0] is key
+    assert len(calls) == 2
+    assert cache.hits == 1
+
+    # Wrong passphrase is not served from the cache, and goes straight to the detected class
+    with pytest.raises(SSHException):
+        cache.load(path, 'wrong', (ECDSAKey, RSAKey), loader)
+    assert calls[2:] == ['RSAKey']
+
+    # Eviction
+    other = str(tmp_path / 'id_other')
+    RSAKey.generate(1024).write_private_key_file(other)
+    cache.load(other, None, (RSAKey,), loader)
+    del calls[:]
+    cache.load(path, 'pass', (ECDSAKey, RSAKey), loader)
+    assert calls == ['RSAKey']
+    assert not cache._path_locks
+
+
+class FakePoolClient:
+    """Stand-in for a connected SSHClient"""
+
+    def __init__(self):
+        self.active = True
+        self.closed = False
+
+    def get_transport(self):
+        return self
+
+    def is_active(self):
+        return self.active
+
+    def close(self):
+        self.closed = True
+        self.active = False
+
+
+def test_connection_pool():
+    """Connections are shared up to the limit, replaced when dropped and closed when idle"""
+    from .connection_pool import ConnectionPool
+
+    opened = []
+
+    def connect():
+        opened.append(FakePoolClient())
+        return opened[-1], []
+
+    pool = ConnectionPool(max_channels_per_connection=4, idle_timeout=60)
+    key = ('login.archer2.ac.uk', 'user')
+    conn1 = pool.acquire(key, connect, 2)
+    conn2 = pool.acquire(key, connect, 2)
+    assert conn1 is conn2
+    assert len(opened) == 1
+
+    # Over the limit
+    conn3 = pool.acquire(key, connect, 2)
+    assert conn3 is not conn1
+    assert pool.stats()[key] == [2, 1]
+
+    # A transport with parallel transfer workers holds more channels
+    conn5 = pool.acquire(key, connect, 3)
+    assert conn5 is not conn3
+    assert pool.stats()[key] == [2, 1, 1]
+    pool.release(conn5, 3)
+
+    # Dropped connection is replaced
+    opened[0].active = False
+    conn4 = pool.reconnect(conn1, connect, 2)
+    assert conn4 is conn3
+    assert opened[0].closed
+    assert conn4.channels == 4
+
+    for conn in (conn2, conn3, conn4):
+        pool.release(conn, 2)
+    assert not opened[1].closed
+    pool.evict_idle(0)
+    assert opened[1].closed
+    assert not pool.stats()
+
+
+class FakeTarChannel:
+    """Channel running the command in a local subprocess"""
+
+    def __init__(self, command):
+        import subprocess
+        self.proc = subprocess.Popen(
+            command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+
+    def makefile(self, mode):
+        return self.proc.stdin if 'w' in mode else self.proc.stdout
+
+    def makefile_stderr(self, mode):
+        return self.proc.stderr
+
+    def shutdown_write(self):
+        if not self.proc.stdin.closed:
+            self.proc.stdin.close()
+
+    def recv_exit_status(self):
+        return self.proc.wait()
+
+    def close(self):
+        pass
+
+
+def make_local_tar_transport(monkeypatch, mode):
+    """A transport whose remote is the local filesystem, only usable for tar transfers"""
+    from .ssh_archer2 import SshTransport
+
+    transport = SshTransport(machine='localhost', username='user', tree_transfer=mode)
+    transport._remote_has_tar = True
+    monkeypatch.setattr(transport, '_open_tar_channel', FakeTarChannel)
+    monkeypatch.setattr(transport, 'path_exists', os.path.exists)
+    monkeypatch.setattr(transport, 'isfile', os.path.isfile)
+    monkeypatch.setattr(transport, 'isdir', os.path.isdir)
+    monkeypatch.setattr(transport, 'makedirs', lambda path, ignore_existing=False: os.makedirs(path))
+    monkeypatch.setattr(transport, 'getcwd', os.getcwd)
+    return transport
+
+
+@pytest.mark.parametrize('mode', ['tar', 'tar.gz'])
+def test_tar_tree_transfer(tmp_path, monkeypatch, mode):
+    """Folders are sent and retrieved as a single tar stream"""
+    source = tmp_path / 'source'
+    (source / 'sub').mkdir(parents=True)
+    for i in range(20):
+        (source / 'file_{}'.format(i)).write_text('content {}'.format(i))
+    (source / 'sub' / 'POTCAR').write_text('potential')
+
+    transport = make_local_tar_transport(monkeypatch, mode)
+    transport.puttree(str(source), str(tmp_path / 'remote'))
+    assert (tmp_path / 'remote' / 'sub' / 'POTCAR').read_text() == 'potential'
+    assert len(os.listdir(tmp_path / 'remote')) == 21
+
+    # Destination exists - the folder is nested inside
+    (tmp_path / 'retrieved').mkdir()
+    transport.gettree(str(tmp_path / 'remote'), str(tmp_path / 'retrieved'))
+    assert (tmp_path / 'retrieved' / 'remote' / 'file_3').read_text() == 'content 3'
+
+    with pytest.raises(OSError):
+        transport.gettree(str(tmp_path / 'missing'), str(tmp_path / 'other'))
+
+    # Without following the links, folders go through the per-file SFTP transfer of the stock transport
+    from aiida.transports.plugins.ssh import SshTransport as StockSshTransport
+
+    calls = []
+    monkeypatch.setattr(transport, '_open_tar_channel', lambda command: pytest.fail('tar used for dereference=False'))
+    monkeypatch.setattr(StockSshTransport, 'puttree', lambda self, *args: calls.append(('put',) + args))
+    monkeypatch.setattr(StockSshTransport, 'gettree', lambda self, *args: calls.append(('get',) + args))
+    transport._transfer_workers = 4
+    transport.puttree(str(source), str(tmp_path / 'links'), dereference=False)
+    transport.gettree(str(tmp_path / 'remote'), str(tmp_path / 'links'), dereference=False)
+    assert calls == [
+        ('put', str(source), str(tmp_path / 'links'), None, False, True),
+        ('get', str(tmp_path / 'remote'), str(tmp_path / 'links'), None, False, True),
+    ]
+
+
+class FakeSFTP:
+    """SFTP client copying files locally, failing for names containing 'bad'"""
+
+    def __init__(self, opened):
+        opened.append(self)
+        self.closed = False
+
+    def put(self, localpath, remotepath, confirm=True):
+        import shutil
+        if 'bad' in localpath:
+            raise OSError('Permission denied')
+        shutil.copy(localpath, remotepath)
+        return os.stat(remotepath)
+
+    def get(self, remotepath, localpath, **kwargs):
+        import shutil
+        if 'bad' in remotepath:
+            raise OSError('No such file')
+        shutil.copy(remotepath, localpath)
+
+    def close(self):
+        self.closed = True
+
+
+def test_parallel_transfer(tmp_path):
+    """Files are spread over a bounded number of channels and errors are reported per file"""
+    from .parallel_transfer import ParallelTransfer
+
+    opened = []
+    (tmp_path / 'src').mkdir()
+    (tmp_path / 'dst').mkdir()
+    jobs = []
+    for name in ['file_{}'.format(i) for i in range(10)] + ['bad_file']:
+        (tmp_path / 'src' / name).write_text(name)
+        jobs.append(('put', str(tmp_path / 'src' / name), str(tmp_path / 'dst' / name)))
+
+    engine = ParallelTransfer(lambda: FakeSFTP(opened), workers=3)
+    report = engine.run(jobs)
+    assert len(opened) == 3
+    assert all(sftp.closed for sftp in opened)
+    assert len(report.succeeded) == 10
+    assert list(report.failed) == [str(tmp_path / 'src' / 'bad_file')]
+    assert report.bytes_transferred == sum(len('file_{}'.format(i)) for i in range(10))
+    with pytest.raises(OSError, match='1 of 11 transfers failed'):
+        report.raise_for_errors()
+
+    # Failed downloads do not leave partial files behind
+    (tmp_path / 'back').mkdir()
+    jobs = [('get', str(tmp_path / 'dst' / name), str(tmp_path / 'back' / name)) for name in ['file_1', 'bad_x']]
+    report = engine.run(jobs)
+    assert report.succeeded == [str(tmp_path / 'dst' / 'file_1')]
+    assert os.listdir(tmp_path / 'back') == ['file_1']
+
+
+class LocalSFTP:
+    """SFTP client working on the local filesystem"""
+
+    def put(self, localpath, remotepath, confirm=True):
+        import shutil
+        shutil.copy(localpath, remotepath)
+        return os.stat(remotepath)
+
+    def chmod(self, path, mode):
+        os.chmod(path, mode)
+
+    def posix_rename(self, old, new):
+        os.replace(old, new)
+
+    def remove(self, path):
+        os.remove(path)
+
+
+def local_exec_command_wait(command, **kwargs):
+    import subprocess
+    proc = subprocess.run(['bash', '-c', command], capture_output=True, text=True)
+    return proc.returncode, proc.stdout, proc.stderr
+
+
+def test_upload_cache(tmp_path, monkeypatch):
+    """Identical files are sent once to the store and linked afterwards"""
+    from aiida.transports.plugins.ssh import SshTransport as StockSshTransport
+    from .ssh_archer2 import SshTransport
+    from .upload_cache import UploadCacheIndex
+
+    store_dir = tmp_path / 'store'
+    transport = SshTransport(
+        machine='localhost',
+        username='user',
+        upload_cache_dir=str(store_dir),
+        upload_cache_max_size=1,
+        upload_cache_link='hardlink'
+    )
+    monkeypatch.setattr(transport, 'upload_cache_index', UploadCacheIndex(str(tmp_path / 'index.sqlite')))
+    monkeypatch.setattr(transport, 'exec_command_wait', local_exec_command_wait)
+    monkeypatch.setattr(transport, 'makedirs', lambda path, ignore_existing=False: os.makedirs(path, exist_ok=True))
+    monkeypatch.setattr(transport, 'isfile', os.path.isfile)
+    transport._sftp = LocalSFTP()
+    transport._is_open = True
+
+    potcar = tmp_path / 'POTCAR'
+    potcar.write_bytes(b'x' * 100000)
+    for i in range(3):
+        (tmp_path / 'calc{}'.format(i)).mkdir()
+        transport.putfile(str(potcar), str(tmp_path / 'calc{}'.format(i) / 'POTCAR'))
+    assert transport.upload_cache_misses == 1
+    assert transport.upload_cache_hits == 2
+    assert os.stat(tmp_path / 'calc2' / 'POTCAR').st_nlink == 4
+    assert os.access(tmp_path / 'calc2' / 'POTCAR', os.W_OK)
+    assert transport.verify_upload_cache() == 1
+
+    # Purged from the remote - sent again
+    for path in store_dir.rglob('*'):
+        if path.is_file():
+            path.unlink()
+    transport.putfile(str(potcar), str(tmp_path / 'calc0' / 'POTCAR.2'))
+    assert transport.upload_cache_misses == 2
+    assert (tmp_path / 'calc0' / 'POTCAR.2').read_bytes() == potcar.read_bytes()
+
+    # Going over the size limit evicts the least recently used files
+    other = tmp_path / 'other'
+    other.write_bytes(b'y' * 1024 * 1024)
+    transport.putfile(str(other), str(tmp_path / 'calc1' / 'other'))
+    assert transport.verify_upload_cache() == 1
+    assert (tmp_path / 'calc0' / 'POTCAR').read_bytes() == potcar.read_bytes()
+
+    # Small files are sent directly
+    small = tmp_path / 'INCAR'
+    small.write_text('ENCUT = 500')
+    monkeypatch.setattr(StockSshTransport, 'putfile', lambda self, *args: args)
+    assert transport.putfile(str(small), str(tmp_path / 'calc0' / 'INCAR'))[0] == str(small)
+
+    # Copies on the remote are writable
+    transport._upload_cache_link = 'copy'
+    transport.putfile(str(other), str(tmp_path / 'calc2' / 'other'))
+    assert os.stat(tmp_path / 'calc2' / 'other').st_nlink == 1
+    assert os.access(tmp_path / 'calc2' / 'other', os.W_OK)
+
+    # Files linked symbolically are never evicted
+    transport._upload_cache_link = 'symlink'
+    transport.putfile(str(other), str(tmp_path / 'calc0' / 'other.link'))
+    transport.putfile(str(potcar), str(tmp_path / 'calc0' / 'POTCAR.link'))
+    assert (tmp_path / 'calc0' / 'other.link').is_symlink()
+    assert (tmp_path / 'calc0' / 'other.link').read_bytes() == other.read_bytes()
+    assert transport.verify_upload_cache() == 2
+
+    # Hard links that cannot be made fall back to copies, without sending the file to the store again
+    transport._upload_cache_link = 'hardlink'
+    commands = dict(transport.UPLOAD_CACHE_LINK_COMMANDS, hardlink='false')
+    copy_command = commands['copy']
+    monkeypatch.setattr(transport, 'UPLOAD_CACHE_LINK_COMMANDS', commands)
+    transport.putfile(str(other), str(tmp_path / 'calc0' / 'other'))
+    assert not (tmp_path / 'calc0' / 'other').is_symlink()
+    assert os.stat(tmp_path / 'calc0' / 'other').st_nlink == 1
+    assert transport.upload_cache_misses == 4
+
+    # Files that cannot be placed at all are sent directly from then on, the cache is kept
+    commands['copy'] = 'false'
+    transport._upload_cache_link = 'hardlink'
+    assert transport.putfile(str(other), str(tmp_path / 'calc1' / 'other.2'))[0] == str(other)
+    assert transport.putfile(str(other), str(tmp_path / 'calc1' / 'other.3'))[0] == str(other)
+    assert transport.upload_cache_misses == 4
+    assert transport.verify_upload_cache() == 2
+
+    # A missing file only fails itself
+    commands['copy'] = copy_command
+    transport._upload_cache_failed = False
+    report = transport.putfiles([
+        (str(tmp_path / 'missing'), str(tmp_path / 'calc1' / 'missing')),
+        (str(potcar), str(tmp_path / 'calc1' / 'POTCAR')),
+    ])
+    assert list(report.failed) == [str(tmp_path / 'missing')] and report.succeeded == [str(potcar)]
+
+
+def test_command_batch():
+    """Several commands run in one shell, with their outputs demultiplexed"""
+    import subprocess
+    from .command_batch import build_batch_script, parse_batch_output
+
+    commands = [
+        'echo hello; echo oops >&2',
+        ('pwd', '/'),
+        'printf "\\n__ARCHER2_BATCH_x__ 0 0 0 0\\n"; exit 3',
+        'echo last',
+    ]
+    script, marker = build_batch_script(commands)
+    stdout = subprocess.run(['bash', '-c', script], capture_output=True).stdout
+    results = parse_batch_output(stdout, marker, len(commands))
+    assert results[0] == (0, b'hello\n', b'oops\n')
+    assert results[1] == (0, b'/\n', b'')
+    assert results[2] == (3, b'\n__ARCHER2_BATCH_x__ 0 0 0 0\n', b'')
+    assert results[3] == (0, b'last\n', b'')
+
+    script, marker = build_batch_script(commands, stop_on_error=True)
+    stdout = subprocess.run(['bash', '-c', script], capture_output=True).stdout
+    results = parse_batch_output(stdout, marker, len(commands))
+    assert results[2][0] == 3
+    assert results[3] == (None, b'', b'')
+
+
+class CountingSFTP(LocalSFTP):
+    """Local SFTP client counting the metadata requests"""
+
+    def __init__(self, cwd):
+        self.cwd = cwd
+        self.requests = 0
+
+    def getcwd(self):
+        return self.cwd
+
+    def stat(self, path):
+        self.requests += 1
+        return os.stat(os.path.join(self.cwd, path))
+
+    def listdir(self, path):
+        self.requests += 1
+        return os.listdir(path)
+
+    def normalize(self, path):
+        self.requests += 1
+        return os.path.normpath(os.path.join(self.cwd, path))
+
+    def mkdir(self, path):
+        os.mkdir(os.path.join(self.cwd, path))
+
+
+def test_metadata_cache(tmp_path):
+    """Metadata is cached while the connection is open and invalidated by changes made through the transport"""
+    from .ssh_archer2 import SshTransport
+
+    transport = SshTransport(machine='localhost', username='user', metadata_cache=True)
+    transport._sftp = sftp = CountingSFTP(str(tmp_path))
+    transport._is_open = True
+    (tmp_path / 'aiida.in').write_text('input')
+
+    for _ in range(3):
+        assert transport.isfile('aiida.in')
+        assert not transport.isdir(str(tmp_path / 'out'))
+        assert transport.listdir('.') == ['aiida.in']
+        assert transport.normalize('.') == str(tmp_path)
+    assert sftp.requests == 5
+    assert transport.metadata_cache_stats()['hits'] > transport.metadata_cache_stats()['misses']
+
+    # Creating the folder invalidates the negative entry and the listing of the parent
+    transport.mkdir('out')
+    assert transport.isdir(str(tmp_path / 'out'))
+    assert sorted(transport.listdir(str(tmp_path))) == ['aiida.in', 'out']
+    assert sftp.requests == 7
+
+    transport.remove(str(tmp_path / 'aiida.in'))
+    assert not transport.isfile('aiida.in')
+
+    transport.flush_metadata_cache()
+    assert transport.metadata_cache_stats()['entries'] == 0
+    assert SshTransport(machine='localhost', username='user').metadata_cache_stats() is None
+
+
+SQUEUE_LINE = '{}^^^{}^^^None^^^nid001^^^user^^^1^^^128^^^nid001^^^standard^^^1-00:00:00^^^1:00^^^' \
+    '2021-01-01T00:00:00^^^aiida-{}^^^2021-01-01T00:00:00'
+
+
+class SqueueTransport:
+    """Transport answering squeue with a fixed list of jobs"""
+
+    hostname = 'login.archer2.ac.uk'
+
+    def __init__(self, job_ids):
+        self.job_ids = job_ids
+        self.commands = []
+        self._connect_args = {'username': 'user'}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def exec_command_wait(self, command, **kwargs):
+        self.commands.append(command)
+        return 0, '\n'.join(SQUEUE_LINE.format(job_id, 'R', job_id) for job_id in self.job_ids), ''
+
+
+def test_squeue_snapshot(monkeypatch):
+    """Computers sharing a login are answered by a single squeue, refreshed when a job is missing"""
+    from .slurm_archer2 import SQUEUE_SNAPSHOTS
+
+    monkeypatch.setenv('ARCHER2_SQUEUE_SNAPSHOT_TTL', '60')
+    SQUEUE_SNAPSHOTS.invalidate(('login.archer2.ac.uk', 'user'))
+    transport = SqueueTransport(['100', '101', '102'])
+    schedulers = [Archer2SlurmScheduler() for _ in range(3)]
+    for scheduler in schedulers:
+        scheduler.set_transport(transport)
+
+    assert list(schedulers[0].get_jobs(jobs=['100'], as_dict=True)) == ['100']
+    assert sorted(schedulers[1].get_jobs(jobs=['101', '102'], as_dict=True)) == ['101', '102']
+    assert len(schedulers[2].get_jobs(jobs=['100', '102'])) == 2
+    assert transport.commands == [
+        "SLURM_TIME_FORMAT='standard' squeue --array --noheader -o '%i^^^%t^^^%r^^^%B^^^%u^^^%D^^^"
+        "%C^^^%R^^^%P^^^%l^^^%M^^^%S^^^%j^^^%V' -uuser"
+    ]
+
+    # A new job is not in the snapshot yet
+    transport.job_ids.append('103')
+    assert '103' in schedulers[0].get_jobs(jobs=['103'], as_dict=True)
+    assert len(transport.commands) == 2
+
+    # A finished job triggers a single refresh
+    assert schedulers[0].get_jobs(jobs=['99'], as_dict=True) == {}
+    assert len(transport.commands) == 3
+
+    monkeypatch.setenv('ARCHER2_SQUEUE_SNAPSHOT_TTL', '0')
+    scheduler = Archer2SlurmScheduler()
+    scheduler.set_transport(transport)
+    scheduler.get_jobs(jobs=['100', '101'])
+    assert transport.commands[-1].endswith('--jobs=100,101')
+
+
+class BatchTransport(SqueueTransport):
+    """Transport answering sbatch and squeue, and recording the batches of commands"""
+
+    def __init__(self, job_ids):
+        super().__init__(job_ids)
+        self.batches = []
+
+    def exec_command_wait(self, command, **kwargs):
+        if 'sbatch' not in command:
+            return super().exec_command_wait(command, **kwargs)
+        self.commands.append(command)
+        return 0, 'Submitted batch job 123\n', ''
+
+    def exec_command_batch(self, commands, stop_on_error=False):
+        self.batches.append(commands)
+        return [self.exec_command_wait(command) for command in (commands[0][0], commands[1])]
+
+
+def test_submit_job(monkeypatch):
+    """With squeue snapshots, the submission refreshes the snapshot in the same round trip"""
+    from .slurm_archer2 import SQUEUE_SNAPSHOTS
+
+    scheduler = Archer2SlurmScheduler()
+    transport = BatchTransport(['100', '123'])
+    scheduler.set_transport(transport)
+
+    # Without snapshots, a plain sbatch
+    assert scheduler.submit_job('/work/a', '_aiidasubmit.sh') == '123'
+    assert transport.commands == [scheduler._get_submit_command("'_aiidasubmit.sh'")]
+    assert not transport.batches
+
+    monkeypatch.setenv('ARCHER2_SQUEUE_SNAPSHOT_TTL', '60')
+    SQUEUE_SNAPSHOTS.invalidate(('login.archer2.ac.uk', 'user'))
+    scheduler = Archer2SlurmScheduler()
+    scheduler.set_transport(transport)
+    assert scheduler.submit_job('/work/b', '_aiidasubmit.sh') == '123'
+    assert transport.batches[0][0] == (scheduler._get_submit_command("'_aiidasubmit.sh'"), '/work/b')
+    assert '-uuser' in transport.batches[0][1]
+
+    # The new job is polled from the snapshot
+    del transport.commands[:]
+    assert list(scheduler.get_jobs(jobs=['123'], as_dict=True)) == ['123']
+    assert not transport.commands
+
+
+def test_streaming_joblist_parser():
+    """Jobs whose squeue line is unchanged reuse their JobInfo, and parsing a large output again is faster"""
+    import timeit
+    from aiida.schedulers.plugins.slurm import SlurmScheduler
+    from .slurm_archer2 import JOB_RECORDS, iter_joblist_lines
+
+    JOB_RECORDS.clear()
+    states = ['PD', 'R', 'CG']
+    stdout = '\n'.join(SQUEUE_LINE.format(job_id, states[job_id % 3], job_id) for job_id in range(10000))
+    assert next(iter_joblist_lines(stdout)) == ('0', stdout.splitlines()[0])
+
+    scheduler = Archer2SlurmScheduler()
+    stock = SlurmScheduler()
+    first = scheduler._parse_joblist_output(0, stdout, '')
+    expected = stock._parse_joblist_output(0, stdout, '')
+    assert [(job.job_id, job.job_state, job.title) for job in first] == \
+        [(job.job_id, job.job_state, job.title) for job in expected]
+
+    # One job changes state, the others are unchanged
+    changed = stdout.replace('1^^^R^^^', '1^^^CG^^^', 1)
+    second = scheduler._parse_joblist_output(0, changed, '')
+    assert second[1] is not first[1] and second[1].job_state.value == 'running'
+    assert all(new is old for index, (new, old) in enumerate(zip(second, first)) if index != 1)
+
+    # A running job whose time used changed is parsed again, so that its wallclock is not stale
+    lines = changed.splitlines()
+    lines[4] = lines[4].replace('^^^1:00^^^', '^^^2:00^^^')
+    third = scheduler._parse_joblist_output(0, '\n'.join(lines), '')
+    assert third[4] is not second[4] and third[4].wallclock_time_seconds == 120
+    assert all(new is old for index, (new, old) in enumerate(zip(third, second)) if index != 4)
+
+    # A second pass over the same output builds no JobInfo, the time taken has a loose bound so as not to be flaky
+    assert all(new is old for new, old in zip(scheduler._parse_joblist_output(0, '\n'.join(lines), ''), third))
+    stock_time = min(timeit.repeat(lambda: stock._parse_joblist_output(0, stdout, ''), number=1, repeat=3))
+    streaming_time = min(timeit.repeat(lambda: scheduler._parse_joblist_output(0, stdout, ''), number=1, repeat=3))
+    assert streaming_time < 0.5 * stock_time
+
+    # The same job IDs on another computer are different jobs
+    other = SqueueTransport([])
+    other.hostname = 'login-4c.archer2.ac.uk'
+    scheduler.set_transport(other)
+    assert not any(new is old for new, old in zip(scheduler._parse_joblist_output(0, stdout, ''), first))
+
+
+def make_job_template(scheduler, num_machines, num_mpiprocs_per_machine, wallclock=3600, account='e05'):
+    from aiida.schedulers.datastructures import JobTemplate
+
+    job_tmpl = JobTemplate()
+    job_tmpl.account = account
+    job_tmpl.max_wallclock_seconds = wallclock
+    job_tmpl.sched_output_path = '_scheduler-stdout.txt'
+    job_tmpl.sched_error_path = '_scheduler-stderr.txt'
+    job_tmpl.job_resource = scheduler.create_job_resource(
+        num_machines=num_machines, num_mpiprocs_per_machine=num_mpiprocs_per_machine
+    )
+    return job_tmpl
+
+
+class SbatchTransport(SqueueTransport):
+    """Transport answering sbatch and squeue"""
+
+    def exec_command_wait(self, command, **kwargs):
+        if 'sbatch' in command:
+            self.commands.append(command)
+            return 0, 'Submitted batch job 500\n', ''
+        return super().exec_command_wait(command, **kwargs)
+
+
+def test_job_array():
+    """The tasks of job arrays are listed one per line, even when squeue compresses them"""
+    from .slurm_archer2 import JOB_RECORDS, expand_array_job_id
+
+    JOB_RECORDS.clear()
+    scheduler = Archer2SlurmScheduler()
+    transport = SbatchTransport(['500_0', '500_[1-2]', '500'])
+    scheduler.set_transport(transport)
+
+    assert expand_array_job_id('7_[0-3:2,9%4]') == ['7_0', '7_2', '7_9']
+    jobs = scheduler.get_jobs(jobs=['500_0', '500_2', '500_3'], as_dict=True)
+    assert {'500_0', '500_1', '500_2'} <= set(jobs) and '500_3' not in jobs
+    assert jobs['500_2'].job_state.value == 'running'
+    assert '--array' in transport.commands[-1]
+    assert scheduler._get_kill_command('500_2') == 'scancel 500_2'
+
+
+def test_topology_placement():
+    """Under-populated ranks are spread over the NUMA regions, and the job environment is kept"""
+    from .topology import STANDARD_NODE, NodeModel
+
+    env = STANDARD_NODE.placement(16)
+    assert env['SRUN_CPUS_PER_TASK'] == '8' and env['SLURM_HINT'] == 'nomultithread'
+    assert 'SLURM_CPU_BIND' not in env and env['OMP_NUM_THREADS'] == '1'
+
+    env = STANDARD_NODE.placement(8, 4)
+    assert env['SRUN_CPUS_PER_TASK'] == '16' and env['OMP_NUM_THREADS'] == '4'
+
+    # srun refuses a hint together with an explicit binding, whatever the number of ranks
+    for ranks, threads in ((12, 1), (48, 1), (100, 1), (24, 2), (7, 3), (128, 2)):
+        env = STANDARD_NODE.placement(ranks, threads)
+        assert not ('SLURM_HINT' in env and 'SLURM_CPU_BIND' in env)
+        assert int(env['SRUN_CPUS_PER_TASK']) >= threads
+    assert STANDARD_NODE.placement(48)['SRUN_CPUS_PER_TASK'] == '2'
+
+    env = STANDARD_NODE.placement(128, 2)
+    assert env['SLURM_HINT'] == 'multithread' and env['OMP_PLACES'] == 'threads'
+    with pytest.raises(ValueError):
+        STANDARD_NODE.placement(128, 4)
+    with pytest.raises(ValueError):
+        NodeModel('odd', cores=100, numa_regions=8)
+
+    scheduler = Archer2SlurmScheduler()
+    job_tmpl = make_job_template(scheduler, 1, 32)
+    job_tmpl.job_environment = {'OMP_NUM_THREADS': '2'}
+    scheduler._get_submit_script_header(job_tmpl)
+    assert job_tmpl.job_environment['SRUN_CPUS_PER_TASK'] == '4'
+    assert job_tmpl.job_environment['OMP_NUM_THREADS'] == '2'
+    job_tmpl = make_job_template(scheduler, 1, 32)
+    job_tmpl.job_environment = {'SLURM_CPU_BIND': 'cores'}
+    scheduler._get_submit_script_header(job_tmpl)
+    assert 'SLURM_HINT' not in job_tmpl.job_environment
+
+    # Codes placing their processes themselves are left alone
+    from aiida.common.datastructures import CodeInfo
+    job_tmpl = make_job_template(scheduler, 1, 32)
+    job_tmpl.codes_info = [CodeInfo()]
+    job_tmpl.codes_info[0].prepend_cmdline_params = ['srun', '--hint=nomultithread', '-n', '32']
+    scheduler._get_submit_script_header(job_tmpl)
+    assert not job_tmpl.job_environment
+
+
+def test_qos_selection(tmp_path, monkeypatch):
+    """The fastest starting QOS the job fits in is picked, jobs fitting none are rejected"""
+    import subprocess
+    from datetime import datetime
+    from . import slurm_archer2
+    from .qos import select_qos
+
+    assert select_qos(4, 600, 'standard').name == 'short'
+    assert select_qos(4, 600, 'standard', queued={'short': 2}).name == 'standard'
+    assert select_qos(4, 600, 'standard', weekday=5).name == 'standard'
+    assert select_qos(32, 36 * 3600, 'standard').name == 'long'
+    assert select_qos(2000, 3600, 'standard').name == 'largescale'
+    assert select_qos(2, 3600, 'highmem').name == 'highmem'
+    with pytest.raises(ValueError, match='No QOS'):
+        select_qos(128, 36 * 3600, 'standard')
+
+    # The QOS is only picked when enabled
+    scheduler = Archer2SlurmScheduler()
+    job_tmpl = make_job_template(scheduler, 2, 128, wallclock=900)
+    header = scheduler._get_submit_script_header(job_tmpl)
+    assert '#SBATCH --qos=standard' in header and 'archer2-qos-candidates' not in header
+    assert scheduler._get_submit_command('submit.sh') == 'sbatch submit.sh'
+
+    class Monday(datetime):
+
+        @classmethod
+        def now(cls, tz=None):
+            return cls(2024, 1, 1, 12)
+
+    monkeypatch.setattr(slurm_archer2, 'datetime', Monday)
+    monkeypatch.setenv('ARCHER2_AUTO_QOS', '1')
+    scheduler = Archer2SlurmScheduler()
+    job_tmpl = make_job_template(scheduler, 2, 128, wallclock=900)
+    assert '#SBATCH --qos=short' in scheduler._get_submit_script_header(job_tmpl)
+    job_tmpl = make_job_template(scheduler, 2, 128, wallclock=None)
+    assert '#SBATCH --qos=standard' in scheduler._get_submit_script_header(job_tmpl)
+    job_tmpl = make_job_template(scheduler, 128, 128, wallclock=30 * 3600)
+    with pytest.raises(ValueError):
+        scheduler._get_submit_script_header(job_tmpl)
+
+    # The submission falls back on the next QOS when the user has too many jobs queued in the first one
+    job_tmpl = make_job_template(scheduler, 2, 128, wallclock=900)
+    header = scheduler._get_submit_script_header(job_tmpl)
+    assert header.endswith('\n# archer2-qos-candidates: short:2 standard:64')
+    (tmp_path / 'submit.sh').write_text('#!/bin/bash\n' + header + '\n')
+    (tmp_path / 'squeue').write_text('#!/bin/bash\n[[ " $* " == *" --qos=short "* ]] && seq 2\n')
+    (tmp_path / 'sbatch').write_text('#!/bin/bash\necho "$@"\n')
+    for name in ('squeue', 'sbatch'):
+        (tmp_path / name).chmod(0o755)
+    environment = dict(os.environ, PATH='{}:{}'.format(tmp_path, os.environ['PATH']), USER='user')
+
+    def submitted():
+        command = scheduler._get_submit_command('submit.sh')
+        return subprocess.run(['bash', '-c', command], cwd=str(tmp_path), env=environment, check=True,
+                              stdout=subprocess.PIPE, universal_newlines=True).stdout.strip()
+
+    assert submitted() == '--qos=standard submit.sh'
+    (tmp_path / 'squeue').write_text('#!/bin/bash\nseq 1\n')
+    assert submitted() == '--qos=short submit.sh'
+    (tmp_path / 'submit.sh').write_text('#!/bin/bash\n#SBATCH --qos=short\n')
+    assert submitted() == 'submit.sh'
+
+
+class SacctTransport(SqueueTransport):
+    """Transport answering sacct with fixed records, and squeue with no job"""
+
+    def __init__(self, records):
+        super().__init__([])
+        self.records = records
+
+    def exec_command_wait(self, command, **kwargs):
+        if 'squeue' in command:
+            return 0, '', ''
+        self.commands.append(command)
+        return 0, '\n'.join('|'.join(record) for record in self.records), ''
+
+
+def test_wallclock_autotune(tmp_path, monkeypatch):
+    """Jobs with enough runs in the history ask for a quantile of their runtimes plus a margin"""
+    from aiida.common.datastructures import CodeRunMode
+    from aiida.schedulers.datastructures import JobTemplateCodeInfo
+    from .runtime_history import RuntimeHistory, quantile
+
+    assert quantile([5, 1, 4, 2, 3], 0.95) == 5
+    assert quantile([5, 1, 4, 2, 3], 0.5) == 3
+
+    monkeypatch.setenv('ARCHER2_WALLCLOCK_AUTOTUNE', '1')
+    monkeypatch.setattr(Archer2SlurmScheduler, 'runtime_history', RuntimeHistory(str(tmp_path / 'history.sqlite')))
+    transport = SacctTransport([])
+    scheduler = Archer2SlurmScheduler()
+    scheduler.set_transport(transport)
+
+    def make_job(index, environment=None):
+        job_tmpl = make_job_template(scheduler, 1, 128, wallclock=24 * 3600)
+        job_tmpl.job_name = 'aiida-{}'.format(index)
+        job_tmpl.job_environment = environment or {}
+        code_info = JobTemplateCodeInfo()
+        code_info.cmdline_params = ['pw.x', '-in', 'aiida.in']
+        job_tmpl.codes_info = [code_info]
+        job_tmpl.codes_run_mode = CodeRunMode.SERIAL
+        return job_tmpl
+
+    def submit(header, job_id):
+        """Parse the output of the submit command, which echoes the runtime record of the script"""
+        record = [line for line in header.splitlines() if line.startswith('# archer2-runtime: ')]
+        stdout = '\n'.join(['Submitted batch job {}'.format(job_id)] + record)
+        assert scheduler._parse_submit_output(0, stdout, '') == str(job_id)
+        return header
+
+    # Not enough history yet
+    for index in range(6):
+        assert '#SBATCH --time=1-00:00:00' in submit(scheduler._get_submit_script_header(make_job(index)), 100 + index)
+
+    # Jobs whose script is written but not submitted are not recorded
+    scheduler._get_submit_script_header(make_job(7))
+
+    # The history is updated while polling the jobs, at most once per interval
+    records = [(str(100 + index), 'aiida-{}'.format(index), '00:{:02d}:00'.format(40 + index)) for index in range(6)]
+    records.append(('200', 'other-job', '10:00:00'))
+    records.append(('107', 'aiida-7', '00:01:00'))
+    # A job of another profile, with the same name as one of ours
+    records.append(('201', 'aiida-0', '10:00:00'))
+    transport.records = [(job_id, elapsed) for job_id, _, elapsed in records]
+    scheduler.get_jobs(jobs=['300'])
+    scheduler.get_jobs(jobs=['300'])
+    assert len(transport.commands) == 1
+    assert '--allocations --state=CD' in transport.commands[0]
+    assert len(scheduler.runtime_history.elapsed(scheduler._tune_wallclock(make_job(8))[0])) == 6
+
+    # The engine creates new schedulers, which know of the last update as well
+    scheduler = Archer2SlurmScheduler()
+    scheduler.set_transport(transport)
+    scheduler.get_jobs(jobs=['300'])
+    assert len(transport.commands) == 1
+
+    # 95% quantile of 40-45 minutes, plus 25%
+    header = submit(scheduler._get_submit_script_header(make_job(10)), 110)
+    assert '#SBATCH --time=00:56:15' in header
+    header = submit(scheduler._get_submit_script_header(make_job(11, {'ARCHER2_WALLCLOCK_AUTOTUNE': '0'})), 111)
+    assert '#SBATCH --time=1-00:00:00' in header
+    header = submit(scheduler._get_submit_script_header(make_job(12, {'ARCHER2_RUNTIME_FINGERPRINT': 'Si64'})), 112)
+    assert '#SBATCH --time=1-00:00:00' in header
+
+    report = scheduler.wallclock_savings_report()
+    assert report['jobs'] == 9 and report['tuned'] == 1
+    assert report['saved_node_hours'] == pytest.approx(24 - 3375 / 3600)
+
+
+def test_efficiency_harvesting():
+    """Allocation and step lines are combined into one record per job, inefficient jobs are flagged"""
+    from .efficiency import parse_duration, parse_quantity
+    from .slurm_archer2 import EFFICIENCY_RECORDS, EfficiencyRecords
+
+    assert parse_duration('1-02:00:00') == 93600
+    assert parse_duration('05:30.500') == 330.5
+    assert parse_duration('') is None
+    assert parse_quantity('2G') == 2 * 1024**3
+    assert parse_quantity('1.5K', base=1000) == 1500
+
+    EFFICIENCY_RECORDS.clear()
+    records = [
+        ('300', 'COMPLETED', '2', '256', '01:00:00', '', '', '1.5M'),
+        ('300.batch', 'COMPLETED', '1', '128', '01:00:00', '00:10.000', '20M', '0'),
+        ('300.0', 'COMPLETED', '2', '256', '00:59:00', '8-00:00:00', '1.5G', '0'),
+        ('301', 'CANCELLED by 1', '1', '128', '02:00:00', '16:00:00', '', '200K'),
+        ('301.0', 'CANCELLED', '1', '128', '02:00:00', '16:00:00', '800M', ''),
+        ('302', 'RUNNING', '1', '128', '00:10:00', '', '', ''),
+    ]
+    transport = SacctTransport(records)
+    scheduler = Archer2SlurmScheduler()
+    scheduler.set_transport(transport)
+    jobs = scheduler.harvest_efficiency()
+    assert sorted(jobs) == ['300', '301']
+    assert 'TotalCPU,MaxRSS,ConsumedEnergy' in transport.commands[0]
+    assert jobs['300'].total_cpu == pytest.approx(8 * 86400 + 10)
+    assert jobs['300'].max_rss == 1.5 * 1024**3 and jobs['300'].energy == 1.5e6
+    assert jobs['301'].state == 'CANCELLED' and jobs['301'].cpu_efficiency == pytest.approx(1 / 16)
+
+    report = scheduler.efficiency_report()
+    assert report['jobs'] == 2 and report['node_hours'] == pytest.approx(4)
+    assert [job['job_id'] for job in report['flagged']] == ['301']
+
+    # The records are attached to the detailed job info
+    info = scheduler.get_detailed_job_info('300')
+    assert info['efficiency']['nodes'] == 2 and info['efficiency']['cpu_efficiency'] == pytest.approx(0.75, 1e-3)
+
+    # The records are bounded, the least recently used are dropped first
+    bounded = EfficiencyRecords(max_entries=2)
+    bounded.update({'300': jobs['300'], '301': jobs['301']})
+    assert bounded.get('300') is jobs['300']
+    bounded.update({'303': jobs['301']})
+    assert len(bounded) == 2 and bounded.get('301') is None and bounded.get('300') is jobs['300']
+
+
+def test_job_dependency():
+    """Jobs wait for the job they depend on, and jobs whose dependency failed are reported as failed"""
+    from .slurm_archer2 import DEPENDENCY_NEVER_SATISFIED_EXIT_STATUS, JOB_RECORDS
+
+    scheduler = Archer2SlurmScheduler()
+    job_tmpl = make_job_template(scheduler, 1, 128)
+    job_tmpl.dependency = ['500', '501_2']
+    header = scheduler._get_submit_script_header(job_tmpl)
+    assert '#SBATCH --dependency=afterok:500:501_2' in header
+    assert '#SBATCH --kill-on-invalid-dep=yes' in header
+
+    job_tmpl = make_job_template(scheduler, 1, 128)
+    job_tmpl.job_environment = {'ARCHER2_AFTEROK': '600'}
+    assert '#SBATCH --dependency=afterok:600' in scheduler._get_submit_script_header(job_tmpl)
+    job_tmpl.job_environment = {'ARCHER2_AFTEROK': '600; rm -rf'}
+    with pytest.raises(ValueError):
+        scheduler._get_submit_script_header(job_tmpl)
+
+    JOB_RECORDS.clear()
+    stdout = '\n'.join([
+        SQUEUE_LINE.format(700, 'PD', 700).replace('^^^None^^^', '^^^DependencyNeverSatisfied^^^'),
+        SQUEUE_LINE.format(701, 'PD', 701).replace('^^^None^^^', '^^^Dependency^^^'),
+    ])
+    jobs = scheduler._parse_joblist_output(0, stdout, '')
+    assert [job.job_state.value for job in jobs] == ['undetermined', 'queued held']
+
+    # Once Slurm cancelled it, the job that never ran gets an exit code instead of being parsed
+    sacct = 'JobID|State|Reason|Start|\n{}|{}|{}|{}|\n'
+    cancelled = sacct.format(700, 'CANCELLED by 0', 'DependencyNeverSatisfied', 'None')
+    exit_code = scheduler.parse_output({'stdout': cancelled})
+    assert exit_code.status == DEPENDENCY_NEVER_SATISFIED_EXIT_STATUS and exit_code.invalidates_cache
+    assert scheduler.parse_output({'stdout': sacct.format(702, 'CANCELLED by 1000', 'None', 'None')}) is None
+    assert scheduler.parse_output({'stdout': sacct.format(703, 'TIMEOUT', 'None', '2024-01-01T10:00:00')}).status == 120
+
+
+def test_mpmd_launch():
+    """Codes run in parallel with srun share a single multi-prog step"""
+    from aiida.common.datastructures import CodeRunMode
+    from aiida.schedulers.datastructures import JobTemplateCodeInfo
+
+    scheduler = Archer2SlurmScheduler()
+    job_tmpl = make_job_template(scheduler, 1, 128)
+    job_tmpl.shebang = '#!/bin/bash'
+    job_tmpl.codes_run_mode = CodeRunMode.PARALLEL
+    codes_info = []
+    for executable, ntasks in (('pw.x', '96'), ('sirius.x', '32')):
+        code_info = JobTemplateCodeInfo()
+        code_info.prepend_cmdline_params = ['srun', '--hint=nomultithread', '-n', ntasks]
+        code_info.cmdline_params = [executable, '-in', 'aiida.in']
+        code_info.stdout_name = executable + '.out'
+        code_info.join_files = True
+        codes_info.append(code_info)
+    job_tmpl.codes_info = codes_info
+
+    script = scheduler.get_submit_script(job_tmpl)
+    assert "'srun' '--hint=nomultithread' '--ntasks=128' '--multi-prog' '_aiidampmd.conf'" in script
+    assert "0-95 bash _aiidampmd_0.sh\n96-127 bash _aiidampmd_1.sh\nAIIDA_MPMD_EOF" in script
+    assert "exec 'pw.x' '-in' 'aiida.in' >> 'pw.x.out' 2>&1" in script
+    assert ": > 'sirius.x.out'" in script
+    assert script.count('srun') == 1 and job_tmpl.codes_info is codes_info
+
+    codes_info[1].prepend_cmdline_params = ['srun', '--hint=nomultithread', '-n', '64']
+    with pytest.raises(ValueError):
+        scheduler.get_submit_script(job_tmpl)
+
+    # Codes with different srun options keep their own steps
+    codes_info[1].prepend_cmdline_params = ['srun', '--cpus-per-task=2', '-n', '16']
+    script = scheduler.get_submit_script(job_tmpl)
+    assert '--multi-prog' not in script
+    assert "'--cpus-per-task=2'" in script and script.count('srun') == 2
+
+    # Codes not launched with srun are run as before
+    codes_info[1].prepend_cmdline_params = []
+    assert '--multi-prog' not in scheduler.get_submit_script(job_tmpl)
+
+
+class FlakyRemoteFile:
+    """Remote file whose reads fail once after a given number of bytes, as if the connection dropped"""
+
+    def __init__(self, path, sftp):
+        self.handle = open(path, 'rb')
+        self.sftp = sftp
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.handle.close()
+
+    def readv(self, ranges):
+        for offset, length in ranges:
+            if self.sftp.fail_at is not None and offset >= self.sftp.fail_at:
+                self.sftp.fail_at = None
+                raise EOFError('Connection dropped')
+            self.handle.seek(offset)
+            yield self.handle.read(length)
+
+
+class FlakySFTP(LocalSFTP):
+    """Local SFTP client dropping the connection once"""
+
+    fail_at = None
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def open(self, path, mode):
+        return FlakyRemoteFile(path, self)
+
+
+def test_resumable_download(tmp_path, monkeypatch):
+    """Large files are fetched in verified chunks while they grow, and resume after an interruption"""
+    from .resumable_download import ChecksumMismatch
+    from .ssh_archer2 import SshTransport
+
+    monkeypatch.setenv('ARCHER2_DOWNLOAD_CACHE', str(tmp_path / 'cache'))
+    transport = SshTransport(machine='localhost', username='user', resumable_download_size=1)
+    transport._sftp = sftp = FlakySFTP()
+    transport._is_open = True
+    monkeypatch.setattr(transport, 'exec_command_wait', local_exec_command_wait)
+    download = transport.resumable_download
+    download.chunk_size = 256 * 1024
+    download.chunks_per_check = 2
+
+    # Streamed while the job is running, only the complete chunks are kept
+    remote = tmp_path / 'aiida.traj'
+    content = os.urandom(1100 * 1024)
+    remote.write_bytes(content)
+    assert transport.prefetch_files([str(remote), str(tmp_path / 'missing')]) == {str(remote): 1024 * 1024}
+    assert transport.prefetch_files([str(remote)]) == {str(remote): 1024 * 1024}
+    assert download.bytes_received == 1024 * 1024
+
+    # The job finished, the retrieval is interrupted and resumed from the last verified chunk
+    content += os.urandom(1500 * 1024)
+    remote.write_bytes(content)
+    sftp.fail_at = 2304 * 1024
+    transport.getfile(str(remote), str(tmp_path / 'retrieved'))
+    assert (tmp_path / 'retrieved').read_bytes() == content
+    assert download.bytes_received == len(content) + 256 * 1024
+    assert os.listdir(tmp_path / 'cache') == []
+
+    # A checkpoint rewritten in place at the same size is fetched again in full
+    checkpoint = tmp_path / 'WAVECAR'
+    checkpoint.write_bytes(os.urandom(1024 * 1024))
+    assert transport.prefetch_files([str(checkpoint)]) == {str(checkpoint): 1024 * 1024}
+    rewritten = os.urandom(1024 * 1024)
+    checkpoint.write_bytes(rewritten)
+    received = download.bytes_received
+    transport.getfile(str(checkpoint), str(tmp_path / 'WAVECAR.out'))
+    assert (tmp_path / 'WAVECAR.out').read_bytes() == rewritten
+    assert download.bytes_received == received + len(rewritten)
+
+    # Only the files named are streamed by the monitor
+    from types import SimpleNamespace
+    from .resumable_download import stream_outputs
+    assert stream_outputs(None, SimpleNamespace(prefetch_files=lambda paths: pytest.fail('nothing to stream'))) is None
+
+    # Small files are fetched directly
+    (tmp_path / 'small').write_text('done')
+    monkeypatch.setattr(sftp, 'get', lambda remotepath, localpath, callback: 'stock', raising=False)
+    assert transport.getfile(str(tmp_path / 'small'), str(tmp_path / 'small.out')) == 'stock'
+
+    # A chunk differing from the remote is not accepted, and the verified part is kept
+    monkeypatch.setattr(transport, 'exec_command_wait', lambda command: (0, 'x  -\nx  -\n', ''))
+    with pytest.raises(ChecksumMismatch):
+        transport.getfile(str(remote), str(tmp_path / 'retrieved.2'))
+    assert not (tmp_path / 'retrieved.2').exists()
+    assert download.verified_size(str(remote)) == 0
+
+
+def test_benchmark_server(tmp_path):
+    """The fake login node enforces the login order of ARCHER2, and the benchmarks run against it"""
+    from paramiko.ssh_exception import AuthenticationException
+    from .benchmark import BenchmarkEnvironment, compare_results, run_benchmarks
+    from .ssh_archer2 import SshTransport4C
+
+    with BenchmarkEnvironment() as env:
+        server = env.server()
+        with env.make_transport() as transport:
+            assert transport.exec_command_wait('whoami') == (0, 'user\n', '')
+            (job_id,) = server.slurm.populate(1, running=0)
+            scheduler = Archer2SlurmScheduler()
+            scheduler.set_transport(transport)
+            assert scheduler.get_jobs(jobs=[job_id])[0].job_state.value == 'queued'
+        assert server.auth_attempts == [('publickey', True), ('password', True)]
+
+        # The 4-cabinet client offers the password first, which the node of the main system refuses
+        transport = env.make_transport(SshTransport4C)
+        transport._connect_args['port'] = server.port
+        with pytest.raises(AuthenticationException):
+            transport.open()
+        assert server.auth_attempts[2] == ('password', False)
+
+    results = run_benchmarks(repeat=1, names=['connect', 'poll'], jobs=100)
+    assert results['results']['connect_archer2_cold']['auth_attempts'] == 2
+    assert results['results']['poll_jobs']['jobs'] == 100
+    slower = {
+        'results': {name: dict(result, median=result['median'] * 2) for name, result in results['results'].items()}
+    }
+    assert all(regressed for *_, regressed in compare_results(slower, results))
+    assert not any(regressed for *_, regressed in compare_results(results, slower))
+
+
+def test_instrumentation(tmp_path):
+    """Operations are recorded per type inside a profile, or once enabled, and exported"""
+    import json
+    from paramiko.ssh_exception import AuthenticationException
+    from .benchmark import BenchmarkEnvironment
+    from .instrumentation import METRICS, disable_metrics, enable_metrics, instrumented, profile
+    from .ssh_archer2 import SshTransport4C
+
+    (tmp_path / 'INCAR').write_text('ENCUT = 500')
+    with BenchmarkEnvironment() as env, profile() as metrics:
+        with env.make_transport() as transport:
+            remote = os.path.join(env.server().home, 'INCAR')
+            transport.putfile(str(tmp_path / 'INCAR'), remote)
+            assert transport.isfile(remote)
+            transport.exec_command_wait('echo done')
+            scheduler = Archer2SlurmScheduler()
+            scheduler.set_transport(transport)
+            scheduler.get_jobs(jobs=['1', '2'])
+        transport = env.make_transport(SshTransport4C)
+        transport._connect_args['port'] = env.server().port
+        with pytest.raises(AuthenticationException):
+            transport.open()
+
+    snapshot = metrics.snapshot()
+    assert snapshot['auth.publickey']['count'] == 2
+    assert snapshot['auth.password'] == dict(snapshot['auth.password'], count=2, failures=1)
+    assert snapshot['sftp.putfile']['bytes'] == 11
+    assert snapshot['ssh.exec']['bytes'] == 5
+    assert snapshot['scheduler.get_jobs']['count'] == 1
+    assert snapshot['ssh.connect']['buckets']['+Inf'] == 2
+    text = metrics.to_prometheus()
+    assert 'archer2_operation_seconds_count{operation="sftp.stat"}' in text
+    assert 'archer2_operation_failures_total{operation="ssh.connect"} 1' in text
+
+    # Nothing is recorded outside of a profile unless enabled
+    @instrumented('test.operation', size=lambda result, value: value)
+    def operation(value):
+        return value
+
+    METRICS.reset()
+    operation(3)
+    assert METRICS.snapshot() == {}
+    enable_metrics()
+    try:
+        operation(3)
+    finally:
+        disable_metrics()
+    assert METRICS.snapshot()['test.operation']['bytes'] == 3
+    METRICS.write_json(str(tmp_path / 'metrics.json'))
+    assert json.loads((tmp_path / 'metrics.json').read_text())['operations']['test.operation']['count'] == 1
+    METRICS.reset()
+
+
+def test_login_host_failover(tmp_path, monkeypatch):
+    """Connections go to the healthy login hosts, those failing or with an unknown host key are avoided"""
+    import socket
+    from paramiko.ecdsakey import ECDSAKey
+    from .benchmark import BenchmarkEnvironment
+    from .fake_server import FakeArcher2Server
+    from .login_hosts import LoginHostHealth
+    from .ssh_archer2 import SshTransport
+
+    with BenchmarkEnvironment() as env:
+        known = env.server()
+        (tmp_path / 'unknown').mkdir()
+        unknown = FakeArcher2Server(str(tmp_path / 'unknown')).start()
+        unknown.authorize_key(ECDSAKey.from_private_key_file(env.key_filename))
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            down_port = sock.getsockname()[1]
+
+        # Only the host key of one of the hosts is known
+        (tmp_path / '.ssh').mkdir()
+        (tmp_path / '.ssh' / 'known_hosts').write_text(
+            '[127.0.0.1]:{} {} {}\n'.format(known.port, known.host_key.get_name(), known.host_key.get_base64())
+        )
+        monkeypatch.setenv('HOME', str(tmp_path))
+        monkeypatch.setenv('ARCHER2_PASS_USER', env.password)
+        hosts = ['127.0.0.1:{}'.format(port) for port in (unknown.port, down_port, known.port)]
+        transport = SshTransport(
+            machine='login.archer2.ac.uk',
+            username='user',
+            key_filename=env.key_filename,
+            look_for_keys=False,
+            allow_agent=False,
+            load_system_host_keys=True,
+            key_policy='RejectPolicy',
+            login_hosts=','.join(hosts),
+        )
+        health = transport.login_host_health = LoginHostHealth()
+        try:
+            with transport:
+                assert transport.exec_command_wait('whoami')[1] == 'user\n'
+            status = health.status()
+            assert status[('127.0.0.1', known.port)]['latency'] is not None
+            for port in (unknown.port, down_port):
+                assert status[('127.0.0.1', port)]['failures'] == 1
+                assert 0 < status[('127.0.0.1', port)]['quarantine'] <= 30
+            assert not unknown.auth_attempts
+
+            # The quarantined hosts are not tried again, unless all hosts are in quarantine
+            with transport:
+                pass
+            assert health.status()[('127.0.0.1', down_port)]['failures'] == 1
+            assert health.order([('a', 22), ('b', 22)]) == [('a', 22), ('b', 22)]
+            health.record_failure(('a', 22))
+            assert health.record_failure(('a', 22)) == 60
+            health.record_failure(('b', 22))
+            assert health.order([('a', 22), ('b', 22)]) == [('b', 22), ('a', 22)]
+        finally:
+            unknown.stop()
+
+
+def test_keepalive_and_auth_backoff(tmp_path):
+    """Dropped connections are replaced at the next operation, failed logins are not retried at once"""
+    import threading
+    from paramiko.ssh_exception import AuthenticationException
+    from .auth_backoff import AuthenticationBackoff
+    from .benchmark import BenchmarkEnvironment
+    from .keepalive import LivenessMonitor
+
+    with BenchmarkEnvironment() as env:
+        server = env.server()
+        transport = env.make_transport(keepalive_interval=60)
+        monitor = transport.liveness_monitor = LivenessMonitor()
+        with transport:
+            transport.chdir(server.home)
+            monitor.check()
+            assert monitor.dropped == 0
+
+            # Drop the connection, the monitor marks it and the next operation reconnects in the same directory
+            client = transport._client  # pylint: disable=protected-access
+            transport.sshclient.get_transport().close()
+            monitor.check()
+            assert monitor.dropped == 1 and transport._client is client  # pylint: disable=protected-access
+            assert transport.getcwd() == server.home
+            assert transport._client is not client  # pylint: disable=protected-access
+            assert transport.exec_command_wait('whoami')[1] == 'user\n'
+
+            # A connection found dropped during a transfer is not swapped under it, but replaced afterwards
+            local = tmp_path / 'payload'
+            local.write_bytes(os.urandom(1024 * 1024))
+            connections = []
+
+            def callback(sent, total):
+                if connections:
+                    return
+                connections.append((transport._client, transport._sftp))  # pylint: disable=protected-access
+                transport._connection_is_active = lambda: False  # pylint: disable=protected-access
+                checker = threading.Thread(target=monitor.check)
+                checker.start()
+                checker.join()
+                del transport._connection_is_active  # pylint: disable=protected-access
+                assert (transport._client, transport._sftp) == connections[0]  # pylint: disable=protected-access
+
+            transport.putfile(str(local), os.path.join(server.home, 'payload'), callback=callback)
+            assert monitor.dropped == 2
+            assert transport._client is connections[0][0]  # pylint: disable=protected-access
+            assert transport.get_attribute(os.path.join(server.home, 'payload')).st_size == 1024 * 1024
+            assert transport._client is not connections[0][0]  # pylint: disable=protected-access
+        assert not list(monitor._transports)  # pylint: disable=protected-access
+
+        # Without keepalive, nothing is watched
+        transport = env.make_transport()
+        transport.liveness_monitor = monitor
+        with transport:
+            assert not list(monitor._transports)  # pylint: disable=protected-access
+
+        # A wrong password is tried once, then refused without contacting the host
+        failures = transport.auth_failures
+        for _ in range(2):
+            transport = env.make_transport()
+            transport._connect_args['password'] = 'wrong'  # pylint: disable=protected-access
+            attempts = len(server.auth_attempts)
+            with pytest.raises(AuthenticationException) as excinfo:
+                transport.open()
+        assert isinstance(excinfo.value, AuthenticationBackoff)
+        assert len(server.auth_attempts) == attempts
+        assert failures.record_failure('127.0.0.1', 'user', 'wrong') == 120
+
+        # Another password is still tried
+        with env.make_transport():
+            pass
+
+
+def test_plugin_import():
+    """The plugins import quickly, paramiko is only loaded when a transport connects"""
+    from .benchmark import IMPORT_BUDGET, PLUGIN_MODULES, measure_import
+    from . import ssh_archer2
+    from .ssh_client import ARCHER24CSSHClient, KEY_CLASSES
+
+    for module, base in PLUGIN_MODULES.values():
+        seconds, modules = measure_import(module, base)
+        assert module in modules
+        assert not [name for name in modules if name.split('.')[0] == 'paramiko']
+        assert seconds < IMPORT_BUDGET
+
+    assert ssh_archer2.SshTransport4C.CLIENT_CLASS is ARCHER24CSSHClient
+    assert ssh_archer2.KEY_CLASSES is KEY_CLASSES
+    with pytest.raises(AttributeError):
+        ssh_archer2.NOT_AN_ATTRIBUTE  # pylint: disable=pointless-statement
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Layout of the ARCHER2 compute nodes, and placement of the processes on them
+
+An ARCHER2 node has two 64-core processors split in 8 NUMA regions of 16 cores, each core running up to two hardware
+threads. Under-populated jobs run much faster when their ranks are spread evenly across the NUMA regions, rather than
+packed onto the first cores, and OpenMP threads must be pinned next to their rank. The :class:`NodeModel` turns the
+number of ranks and threads per node into the environmental variables controlling ``srun`` and OpenMP.
+"""
+
+__all__ = ('NodeModel', 'STANDARD_NODE', 'HIGHMEM_NODE', 'NODE_MODELS')
+
+
+class NodeModel:
+    """Layout of a node type, subclass and override :meth:`placement` for a different placement policy"""
+
+    def __init__(self, name, cores=128, numa_regions=8, threads_per_core=2, memory_gb=256):
+        """
+        :param name: name of the node type
+        :param cores: number of physical cores
+        :param numa_regions: number of NUMA regions, each with the same number of cores
+        :param threads_per_core: number of hardware threads per core
+        :param memory_gb: memory available to jobs
+        """
+        if cores % numa_regions:
+            raise ValueError('The {} cores must be split evenly in the {} NUMA regions'.format(cores, numa_regions))
+        self.name = name
+        self.cores = cores
+        self.numa_regions = numa_regions
+        self.threads_per_core = threads_per_core
+        self.memory_gb = memory_gb
+
+    def __repr__(self):
+        return '<NodeModel {}: {} cores, {} NUMA regions, {}-way SMT>'.format(
+            self.name, self.cores, self.numa_regions, self.threads_per_core
+        )
+
+    @property
+    def cores_per_region(self):
+        return self.cores // self.numa_regions
+
+    def placement(self, num_mpiprocs, num_cores_per_mpiproc=None):
+        """
+        Return the environmental variables placing the processes of a node
+
+        :param num_mpiprocs: number of MPI ranks on the node
+        :param num_cores_per_mpiproc: number of cores, and OpenMP threads, of each rank
+        :return: dictionary of environmental variables, read by ``srun`` and the OpenMP runtime
+        :raises ValueError: if the processes do not fit on the node
+        """
+        threads = num_cores_per_mpiproc or 1
+        cpus = num_mpiprocs * threads
+        environment = {
+            'OMP_NUM_THREADS': str(threads),
+            'OMP_PLACES': 'cores',
+            'OMP_PROC_BIND': 'close',
+            'SLURM_DISTRIBUTION': 'block:block',
+        }
+        if cpus > self.cores * self.threads_per_core:
+            raise ValueError(
+                '{} ranks with {} threads each do not fit on a {} node with {} hardware threads'.format(
+                    num_mpiprocs, threads, self.name, self.cores * self.threads_per_core
+                )
+            )
+        if cpus > self.cores:
+            # Use the hardware threads
+            environment.update({
+                'SLURM_HINT': 'multithread',
+                'SRUN_CPUS_PER_TASK': str(threads),
+                'OMP_PLACES': 'threads',
+            })
+            return environment
+
+        # Give each rank an equal block of consecutive cores, so that the ranks are spread over the whole node. No
+        # explicit CPU binding is set, as srun refuses to combine one with a hint.
+        environment['SLURM_HINT'] = 'nomultithread'
+        environment['SRUN_CPUS_PER_TASK'] = str(self.cores // num_mpiprocs)
+        return environment
+
+
+#: Standard compute node
+STANDARD_NODE = NodeModel('standard')
+#: High memory compute node
+HIGHMEM_NODE = NodeModel('highmem', memory_gb=512)
+
+#: Node model of each partition
+NODE_MODELS = {'standard': STANDARD_NODE, 'highmem': HIGHMEM_NODE}
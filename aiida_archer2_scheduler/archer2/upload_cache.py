@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed store of uploaded files on the remote
+
+Many calculations upload byte-identical inputs (pseudopotentials, POTCARs, basis sets). When the upload cache is enabled,
+each such file is sent once into a store directory on the remote, keyed by its sha256, and later uploads of the same
+content only create a link to it. The local :class:`UploadCacheIndex` records what each remote store holds, so that
+no round trip is needed to find out whether a file has to be sent.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+__all__ = ('UploadCacheIndex', 'file_digest', 'store_path')
+
+#: Default location of the index, can be overridden with the ``ARCHER2_UPLOAD_CACHE_INDEX`` environmental variable
+DEFAULT_UPLOAD_CACHE_INDEX = os.path.join('~', '.cache', 'aiida-archer2-scheduler', 'upload_cache.sqlite')
+
+_DIGESTS = {}
+_DIGESTS_LOCK = threading.Lock()
+
+
+def file_digest(path):
+    """
+    Return the sha256 of a local file
+
+    Digests are remembered for the lifetime of the process, keyed by the path and the signature of the file.
+    """
+    stat = os.stat(path)
+    signature = (path, stat.st_mtime_ns, stat.st_size)
+    with _DIGESTS_LOCK:
+        digest = _DIGESTS.get(signature)
+    if digest is None:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as handle:
+            for chunk in iter(lambda: handle.read(1024 * 1024), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        with _DIGESTS_LOCK:
+            _DIGESTS[signature] = digest
+    return digest
+
+
+def store_path(store_dir, digest):
+    """Path of the file with the given digest in the remote store"""
+    return os.path.join(store_dir, digest[:2], digest)
+
+
+class UploadCacheIndex:
+    """Local index of the files held by each remote store, shared by all daemon workers through sqlite"""
+
+    def __init__(self, path=None):
+        """
+        :param path: the sqlite file. Defaults to ``ARCHER2_UPLOAD_CACHE_INDEX`` or :data:`DEFAULT_UPLOAD_CACHE_INDEX`.
+        """
+        if path is None:
+            path = os.environ.get('ARCHER2_UPLOAD_CACHE_INDEX', DEFAULT_UPLOAD_CACHE_INDEX)
+        self.path = os.path.expanduser(path)
+        self._initialised = False
+
+    def _connect(self):
+        if not self._initialised:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30)
+        if not self._initialised:
+            with connection:
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS entries ('
+                    'store TEXT NOT NULL, digest TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL, '
+                    'PRIMARY KEY (store, digest))'
+                )
+            self._initialised = True
+        return connection
+
+    def contains(self, store, digest):
+        """Return whether the store holds the given digest, marking it as recently used"""
+        connection = self._connect()
+        try:
+            with connection:
+                cursor = connection.execute(
+                    'UPDATE entries SET last_used = ? WHERE store = ? AND digest = ?', (time.time(), store, digest)
+                )
+                return cursor.rowcount > 0
+        finally:
+            connection.close()
+
+    def add(self, store, digest, size):
+        """Record that the store holds the given digest"""
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute(
+                    'INSERT OR REPLACE INTO entries (store, digest, size, last_used) VALUES (?, ?, ?, ?)',
+                    (store, digest, size, time.time())
+                )
+        finally:
+            connection.close()
+
+    def discard(self, store, digest):
+        """Forget a digest, e.g. because the file was found missing on the remote"""
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute('DELETE FROM entries WHERE store = ? AND digest = ?', (store, digest))
+        finally:
+            connection.close()
+
+    def total_size(self, store):
+        """Total size in bytes of the files held by a store"""
+        connection = self._connect()
+        try:
+            return connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries WHERE store = ?',
+                                      (store,)).fetchone()[0]
+        finally:
+            connection.close()
+
+    def eviction_candidates(self, store, max_size):
+        """
+        Return the digests to remove to bring the store under ``max_size`` bytes, least recently used first
+        """
+        connection = self._connect()
+        try:
+            rows = connection.execute(
+                'SELECT digest, size FROM entries WHERE store = ? ORDER BY last_used ASC', (store,)
+            ).fetchall()
+        finally:
+            connection.close()
+        excess = sum(size for _, size in rows) - max_size
+        candidates = []
+        for digest, size in rows:
+            if excess <= 0:
+                break
+            candidates.append(digest)
+            excess -= size
+        return candidates
+
+    def replace(self, store, entries):
+        """
+        Replace the content recorded for a store with what was found on the remote
+
+        :param entries: dictionary of digest to size
+        """
+        connection = self._connect()
+        try:
+            with connection:
+                known = dict(
+                    connection.execute('SELECT digest, last_used FROM entries WHERE store = ?', (store,)).fetchall()
+                )
+                connection.execute('DELETE FROM entries WHERE store = ?', (store,))
+                now = time.time()
+                connection.executemany(
+                    'INSERT INTO entries (store, digest, size, last_used) VALUES (?, ?, ?, ?)',
+                    [(store, digest, size, known.get(digest, now)) for digest, size in entries.items()]
+                )
+        finally:
+            connection.close()